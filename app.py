@@ -1,119 +1,398 @@
-import psycopg2
+import io
+import itertools
+import logging
 import os
-from flask import Flask, jsonify
-from urllib.parse import urlparse
-from dotenv import load_dotenv
+from datetime import date, datetime
+import pandas as pd
+import db
+from flask import Flask, Response, jsonify, request
+from metrics_cache import MetricsCache
+from metrics_engine import order_metrics_from_sessions
+from queries import get_order_metrics_query, get_order_metric_sketches_query, get_data_version_query, order_metrics_from_sketch_rows
+from db_creation import ROLLUP_BUCKET_SECONDS
+from instrumentation import timed_query, log_event, render_metrics
+from export import EXPORT_DATASETS, EXPORT_CONTENT_TYPES, stream_export
 
 app = Flask(__name__)
 
+# 'sql' computes the medians in PostgreSQL, 'engine' reads the session rows and computes them in-process
+METRICS_BACKEND = os.getenv('METRICS_BACKEND', 'sql')
 
-# Helper function to execute a query and fetch the first result
+# 'exact' computes the medians over all sessions, 'approx' reads them from the sketches the loader maintains.
+# Can be overridden per request with ?mode=
+METRICS_MODE = os.getenv('METRICS_MODE', 'exact')
+
+# Cache of metric results, invalidated when the loader publishes a new data version
+metrics_cache = MetricsCache(
+    max_entries=int(os.getenv('METRICS_CACHE_MAX_ENTRIES', 128)),
+    ttl=float(os.getenv('METRICS_CACHE_TTL', 300)),
+    version_check_interval=float(os.getenv('METRICS_CACHE_VERSION_CHECK_INTERVAL', 5)),
+)
+
+# Separate LRU cache for the per-customer lookups, so a burst of customers does not evict the metrics
+customer_cache = MetricsCache(
+    max_entries=int(os.getenv('CUSTOMER_CACHE_MAX_ENTRIES', 1024)),
+    ttl=float(os.getenv('CUSTOMER_CACHE_TTL', 60)),
+    version_check_interval=float(os.getenv('METRICS_CACHE_VERSION_CHECK_INTERVAL', 5)),
+)
+
+# Default and maximum number of sessions per page of the customer endpoints
+CUSTOMER_PAGE_SIZE = 50
+CUSTOMER_MAX_PAGE_SIZE = 500
+
+
+# Helper function to execute a query on a pooled connection and fetch the first result
 def fetch_single_value_from_db(query):
     try:
-        load_dotenv()
-        db_url = os.getenv('DATABASE_KEY')
-        url = urlparse(db_url)
-
-        conn_params = {
-                'dbname': url.path[1:],    
-                'user': url.username,       
-                'password': url.password,   
-                'host': url.hostname,       
-                'port': url.port           
-            }
-        conn = psycopg2.connect(**conn_params)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        result = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
+        with db.connection('DATABASE_KEY') as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            result = cursor.fetchone()[0]
+            cursor.close()
         return result
     except Exception as e:
+        # The error is still returned as the value, but now logged as well
+        log_event('query_error', level=logging.WARNING, query=query.strip().split('\n')[0], error=str(e))
         return str(e)
 
-# SQL query for median visits before order (using webshop_events table)
-def get_median_visits_before_order_query():
-    return """
-    WITH customer_sessions AS (
-        SELECT 
-            customer_id,
-            session_id,
-            MIN(timestamp) AS session_start_time
-        FROM webshop_events
-        GROUP BY customer_id, session_id
-    ),
-    first_purchase AS (
-        SELECT 
-            customer_id,
-            MIN(timestamp) AS first_purchase_time
-        FROM webshop_events
-        WHERE event_type = 'placed_order'
-        GROUP BY customer_id
-    ),
-    sessions_before_purchase AS (
-        SELECT 
-            cs.customer_id,
-            COUNT(cs.session_id) AS session_count
-        FROM customer_sessions cs
-        JOIN first_purchase fp 
-            ON cs.customer_id = fp.customer_id
-        WHERE cs.session_start_time < fp.first_purchase_time
-        GROUP BY cs.customer_id
+# Helper function to execute a parameterized query on a pooled connection and fetch all rows
+def fetch_rows_from_db(query, params=None):
+    with db.connection('DATABASE_KEY') as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+# Helper function to execute a query on a pooled connection and fetch the first row
+def fetch_row_from_db(query):
+    with db.connection('DATABASE_KEY') as conn:
+        cursor = conn.cursor()
+        cursor.execute(query)
+        row = cursor.fetchone()
+        cursor.close()
+    return row
+
+# Helper function to read a query result through COPY into a DataFrame, much faster than fetching row tuples
+def fetch_dataframe_from_db(query, parse_dates=None):
+    with db.connection('DATABASE_KEY') as conn:
+        cursor = conn.cursor()
+        csv_buffer = io.StringIO()
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", csv_buffer)
+        cursor.close()
+    csv_buffer.seek(0)
+    return pd.read_csv(csv_buffer, parse_dates=parse_dates, date_format='ISO8601')
+
+# Helper function to compute both order medians with the in-process metrics engine
+def fetch_order_metrics_with_engine():
+    sessions = fetch_dataframe_from_db("SELECT customer_id, session_start, duration_minutes FROM sessions", ['session_start'])
+    first_orders = fetch_dataframe_from_db("SELECT customer_id, first_order_time FROM customer_first_orders", ['first_order_time'])
+    return order_metrics_from_sessions(
+        sessions['customer_id'], sessions['session_start'], sessions['duration_minutes'],
+        first_orders['customer_id'], first_orders['first_order_time']
     )
-    SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY session_count) AS median_sessions_before_purchase
-    FROM sessions_before_purchase;
+
+# Helper function to answer both order medians from the persisted t-digests, without touching the sessions
+def fetch_order_metrics_from_sketches():
+    return order_metrics_from_sketch_rows(fetch_rows_from_db(get_order_metric_sketches_query()))
+
+# Helper function to read the data version the loader bumps after every successful load
+def fetch_data_version():
+    try:
+        with timed_query('data_version'):
+            row = fetch_row_from_db(get_data_version_query())
+        return row[0] if row else 0
+    except Exception:
+        # Without a version, results are still cached but only expire through the TTL
+        return None
+
+# Rollup dimension behind each breakdown; the per-day breakdown reads the 'all' rows
+SESSION_DURATION_BREAKDOWNS = {'referrer': 'referrer', 'event_type': 'event_type', 'day': 'all'}
+
+# SQL query reading a breakdown's duration histograms from the rollups (written by the loader),
+# merged into buckets of %(bucket_seconds)s seconds within the optional [start, end] day range
+def get_session_duration_rollups_query(by):
+    group_column = "day::TEXT" if by == 'day' else "value"
+    return f"""
+    SELECT
+        {group_column} AS value,
+        (FLOOR(bucket_seconds / %(bucket_seconds)s) * %(bucket_seconds)s / 60.0)::DOUBLE PRECISION AS bucket_start_minutes,
+        SUM(sessions)::BIGINT AS sessions,
+        SUM(duration_minutes_sum)::DOUBLE PRECISION AS duration_minutes_sum
+    FROM session_duration_rollups
+    WHERE dimension = %(dimension)s
+        AND (%(start)s::DATE IS NULL OR day >= %(start)s::DATE)
+        AND (%(end)s::DATE IS NULL OR day <= %(end)s::DATE)
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
+    """
+
+# Function to turn rollup rows into one histogram per group, with the mean duration and the median
+# interpolated within its bucket (so accurate to the bucket width)
+def build_session_duration_breakdown(rows, bucket_width):
+    groups = {}
+    for value, bucket_start, sessions, duration_minutes_sum in rows:
+        group = groups.setdefault(value, {"value": value, "sessions": 0, "duration_minutes_sum": 0.0, "histogram": []})
+        group["sessions"] += sessions
+        group["duration_minutes_sum"] += duration_minutes_sum
+        group["histogram"].append({"bucket_start_minutes": bucket_start, "sessions": sessions})
+
+    for group in groups.values():
+        duration_minutes_sum = group.pop("duration_minutes_sum")
+        group["mean_duration_minutes"] = duration_minutes_sum / group["sessions"]
+        half, below = group["sessions"] / 2, 0
+        for bucket in group["histogram"]:
+            if below + bucket["sessions"] >= half:
+                group["median_duration_minutes"] = bucket["bucket_start_minutes"] + bucket_width * (half - below) / bucket["sessions"]
+                break
+            below += bucket["sessions"]
+    return list(groups.values())
+
+# Endpoint with session duration distributions by referrer, event type or day, e.g.
+# /metrics/session-durations/referrer?start=2022-04-20&end=2022-04-27&bucket_width=0.5
+@app.route('/metrics/session-durations/<by>', methods=['GET'])
+def get_session_durations(by):
+    if by not in SESSION_DURATION_BREAKDOWNS:
+        return jsonify({"error": f"Unknown breakdown {by!r}, expected one of {', '.join(SESSION_DURATION_BREAKDOWNS)}"}), 400
+    try:
+        start = date.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = date.fromisoformat(request.args['end']) if 'end' in request.args else None
+        bucket_width = float(request.args.get('bucket_width', 1))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    bucket_seconds = bucket_width * 60
+    if bucket_seconds <= 0 or bucket_seconds % ROLLUP_BUCKET_SECONDS:
+        return jsonify({"error": f"bucket_width must be a positive multiple of {ROLLUP_BUCKET_SECONDS / 60} minutes"}), 400
+
+    # Served from memory while the data version has not changed, like the order metrics
+    cache_key = ('session-durations', by, start, end, bucket_width, metrics_cache.current_version(fetch_data_version))
+    found, breakdown = metrics_cache.get(cache_key)
+    if not found:
+        try:
+            with timed_query(f'session_durations_{by}'):
+                rows = fetch_rows_from_db(get_session_duration_rollups_query(by), {
+                    'dimension': SESSION_DURATION_BREAKDOWNS[by],
+                    'bucket_seconds': int(bucket_seconds),
+                    'start': start,
+                    'end': end,
+                })
+        except Exception as e:
+            # Errors are reported but never cached
+            return jsonify({"error": str(e)}), 500
+        breakdown = {
+            "by": by,
+            "start": start.isoformat() if start else None,
+            "end": end.isoformat() if end else None,
+            "bucket_width_minutes": bucket_width,
+            "groups": build_session_duration_breakdown(rows, bucket_width),
+        }
+        metrics_cache.put(cache_key, breakdown)
+    return jsonify(breakdown)
+
+# SQL query for one page of a customer's sessions after session %(after)s, in session order. Keyset
+# pagination: the (customer_id, session_id) index seeks straight to the page and answers it index-only,
+# however deep the page. One row more than the page is read to know whether there is a next page.
+def get_customer_sessions_query():
+    return """
+    SELECT session_id, session_start, session_end, duration_minutes, event_count, has_order
+    FROM sessions
+    WHERE customer_id = %(customer_id)s AND session_id > %(after)s
+    ORDER BY session_id
+    LIMIT %(limit)s + 1;
     """
 
-# SQL query for median session duration before order (using webshop_events table)
-def get_median_session_duration_before_order_query():
+# SQL query for one page of a customer's journey to the first order: the sessions starting at or before
+# the first order (all of them without an order), each with its events from the (customer_id, session_id, timestamp) index
+def get_customer_journey_query():
     return """
-    WITH session_durations AS (
-        SELECT 
-            customer_id,
-            session_id,
-            MIN(timestamp) AS session_start_time,
-            MAX(timestamp) AS session_end_time,
-            EXTRACT(EPOCH FROM (MAX(timestamp) - MIN(timestamp))) / 60 AS session_duration_minutes
-        FROM webshop_events
-        GROUP BY customer_id, session_id
-    ),
-    first_purchase AS (
-        SELECT 
-            customer_id,
-            MIN(timestamp) AS first_purchase_time
-        FROM webshop_events
-        WHERE event_type = 'placed_order'
-        GROUP BY customer_id
+    WITH first_order AS (
+        SELECT first_order_time FROM customer_first_orders WHERE customer_id = %(customer_id)s
     ),
-    durations_before_purchase AS (
-        SELECT 
-            sd.customer_id,
-            sd.session_duration_minutes
-        FROM session_durations sd
-        JOIN first_purchase fp 
-            ON sd.customer_id = fp.customer_id
-        WHERE sd.session_start_time < fp.first_purchase_time
+    journey_sessions AS (
+        SELECT session_id, session_start, session_end, duration_minutes, event_count, has_order
+        FROM sessions
+        WHERE customer_id = %(customer_id)s AND session_id > %(after)s
+            AND session_start <= COALESCE((SELECT first_order_time FROM first_order), 'infinity')
+        ORDER BY session_id
+        LIMIT %(limit)s + 1
     )
-    SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY session_duration_minutes) AS median_session_duration_before_purchase
-    FROM durations_before_purchase;
+    SELECT
+        s.session_id, s.session_start, s.session_end, s.duration_minutes, s.event_count, s.has_order,
+        (SELECT first_order_time FROM first_order) AS first_order_time,
+        e.timestamp, e.event_type::TEXT, NULLIF(e.page, ''), NULLIF(e.referrer, '')
+    FROM journey_sessions s
+    JOIN webshop_events e ON e.customer_id = %(customer_id)s AND e.session_id = s.session_id AND e.session_id > %(after)s
+    ORDER BY s.session_id, e.timestamp;
     """
 
+# Helper function to turn a session row into its JSON form
+def session_to_dict(session_id, session_start, session_end, duration_minutes, event_count, has_order):
+    return {
+        "session_id": session_id,
+        "session_start": session_start.isoformat(),
+        "session_end": session_end.isoformat(),
+        "duration_minutes": duration_minutes,
+        "event_count": event_count,
+        "has_order": has_order,
+    }
+
+# Function to group journey rows (one per event) into sessions with their events, and read the first order time
+def build_customer_journey(rows):
+    sessions = []
+    for row in rows:
+        if not sessions or sessions[-1]["session_id"] != row[0]:
+            sessions.append({**session_to_dict(*row[:6]), "events": []})
+        timestamp, event_type, page, referrer = row[7:]
+        sessions[-1]["events"].append({"timestamp": timestamp.isoformat(), "event_type": event_type, "page": page, "referrer": referrer})
+    first_order_time = rows[0][6] if rows else None
+    return sessions, first_order_time.isoformat() if first_order_time else None
+
+# Helper function to read the keyset pagination parameters: the last session id of the previous page and the page size
+def parse_customer_page_args():
+    after = int(request.args.get('after', 0))
+    limit = int(request.args.get('limit', CUSTOMER_PAGE_SIZE))
+    if after < 0 or not 1 <= limit <= CUSTOMER_MAX_PAGE_SIZE:
+        raise ValueError(f"after must be >= 0 and limit between 1 and {CUSTOMER_MAX_PAGE_SIZE}")
+    return after, limit
+
+# Helper function to serve a customer lookup from the customer cache, or run it and cache the result
+def cached_customer_lookup(name, customer_id, after, limit, lookup):
+    cache_key = (name, customer_id, after, limit, customer_cache.current_version(fetch_data_version))
+    found, result = customer_cache.get(cache_key)
+    if not found:
+        with timed_query(f'customer_{name}'):
+            result = lookup()
+        customer_cache.put(cache_key, result)
+    return result
+
+# Endpoint with one page of a customer's sessions, e.g. /customers/42/sessions?limit=20, followed by
+# /customers/42/sessions?limit=20&after=<next_after of the previous page>
+@app.route('/customers/<int:customer_id>/sessions', methods=['GET'])
+def get_customer_sessions(customer_id):
+    try:
+        after, limit = parse_customer_page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def lookup():
+        rows = fetch_rows_from_db(get_customer_sessions_query(), {'customer_id': customer_id, 'after': after, 'limit': limit})
+        sessions = [session_to_dict(*row) for row in rows[:limit]]
+        return {
+            "customer_id": customer_id,
+            "sessions": sessions,
+            "next_after": sessions[-1]["session_id"] if len(rows) > limit else None,
+        }
+
+    try:
+        return jsonify(cached_customer_lookup('sessions', customer_id, after, limit, lookup))
+    except Exception as e:
+        # Errors are reported but never cached
+        return jsonify({"error": str(e)}), 500
+
+# Endpoint with a customer's journey to their first order: the sessions up to and including the one with
+# the first order, with their events, paginated like /customers/<id>/sessions
+@app.route('/customers/<int:customer_id>/journey', methods=['GET'])
+def get_customer_journey(customer_id):
+    try:
+        after, limit = parse_customer_page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def lookup():
+        rows = fetch_rows_from_db(get_customer_journey_query(), {'customer_id': customer_id, 'after': after, 'limit': limit})
+        sessions, first_order_time = build_customer_journey(rows)
+        return {
+            "customer_id": customer_id,
+            "first_order_time": first_order_time,
+            "sessions": sessions[:limit],
+            "next_after": sessions[limit - 1]["session_id"] if len(sessions) > limit else None,
+        }
+
+    try:
+        return jsonify(cached_customer_lookup('journey', customer_id, after, limit, lookup))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Endpoint streaming sessionized events or session summaries of a time range as CSV, NDJSON or Arrow IPC, e.g.
+# /export/sessions?start=2022-04-20&end=2022-04-21T12:00&format=ndjson. The response is sent in chunks
+# as rows come from a server-side cursor, so exports of any size use constant memory.
+@app.route('/export/<dataset>', methods=['GET'])
+def export_dataset(dataset):
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({"error": f"Unknown dataset {dataset!r}, expected one of {', '.join(EXPORT_DATASETS)}"}), 400
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_CONTENT_TYPES:
+        return jsonify({"error": f"Unknown format {export_format!r}, expected one of {', '.join(EXPORT_CONTENT_TYPES)}"}), 400
+    try:
+        start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Start the query before answering, so connection and query errors still get an error status
+    chunks = stream_export(dataset, export_format, start, end)
+    try:
+        first_chunk = next(chunks)
+    except ImportError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log_event('export_error', level=logging.WARNING, dataset=dataset, error=str(e))
+        return jsonify({"error": str(e)}), 500
+
+    extension = {'csv': 'csv', 'ndjson': 'ndjson', 'arrow': 'arrows'}[export_format]
+    response = Response(itertools.chain([first_chunk], chunks), content_type=EXPORT_CONTENT_TYPES[export_format],
+                        headers={'Content-Disposition': f'attachment; filename="{dataset}.{extension}"'})
+    # The chain cannot be closed itself: close the export when the server closes the response, e.g. when the
+    # client disconnects, so its pooled connection is returned right away
+    response.call_on_close(chunks.close)
+    return response
+
 # Endpoint to get the metrics for orders
 @app.route('/metrics/orders', methods=['GET'])
 def get_order_metrics():
-    # Fetch the median visits before order
-    median_visits_query = get_median_visits_before_order_query()
-    median_visits_before_order = fetch_single_value_from_db(median_visits_query)
-    
-    # Fetch the median session duration before order
-    median_duration_query = get_median_session_duration_before_order_query()
-    median_session_duration_before_order = fetch_single_value_from_db(median_duration_query)
-    
+    mode = request.args.get('mode', METRICS_MODE)
+    if mode not in ('exact', 'approx'):
+        return jsonify({"error": f"Unknown mode {mode!r}, expected 'exact' or 'approx'"}), 400
+
+    # Serve from memory while the data version has not changed
+    cache_key = ('orders', mode, metrics_cache.current_version(fetch_data_version))
+    found, metrics = metrics_cache.get(cache_key)
+    if not found:
+        try:
+            if mode == 'approx':
+                with timed_query('order_metrics_sketches'):
+                    median_visits_before_order, median_session_duration_before_order = fetch_order_metrics_from_sketches()
+            elif METRICS_BACKEND == 'engine':
+                with timed_query('order_metrics_engine'):
+                    median_visits_before_order, median_session_duration_before_order = fetch_order_metrics_with_engine()
+            else:
+                # Fetch both medians with one query
+                with timed_query('order_metrics'):
+                    median_visits_before_order, median_session_duration_before_order = fetch_row_from_db(get_order_metrics_query())
+            metrics = {
+                "median_visits_before_order": median_visits_before_order,
+                "median_session_duration_minutes_before_order": median_session_duration_before_order
+            }
+            metrics_cache.put(cache_key, metrics)
+        except Exception as e:
+            # Errors are reported but never cached
+            metrics = {
+                "median_visits_before_order": str(e),
+                "median_session_duration_minutes_before_order": str(e)
+            }
+
     # Return the response in the required format
-    return jsonify({
-        "median_visits_before_order": median_visits_before_order,
-        "median_session_duration_minutes_before_order": median_session_duration_before_order
-    })
+    return jsonify(metrics)
+
+# Endpoint exposing the metrics and customer cache hit/miss counters
+@app.route('/metrics/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify({**metrics_cache.stats(), "customers": customer_cache.stats()})
+
+# Endpoint exposing stage timings, query latencies and pool wait times in the Prometheus text format
+@app.route('/metrics/internal', methods=['GET'])
+def get_internal_metrics():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 # Root endpoint
 @app.route('/')
@@ -121,4 +400,6 @@ def home():
     return "Session Analysis API is running."
 
 if __name__ == '__main__':
+    # Open the shared connection pool once at startup
+    db.configure_pool('DATABASE_KEY')
     app.run(debug=True)
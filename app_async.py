@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import time
+from urllib.parse import parse_qs
+from dotenv import load_dotenv
+from queries import get_order_metrics_query, get_order_metric_sketches_query, get_data_version_query, order_metrics_from_sketch_rows
+from metrics_cache import MetricsCache
+from instrumentation import registry, timed_query, render_metrics
+
+# asyncpg is only needed for the async serving mode
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+# 'exact' computes the medians over all sessions, 'approx' reads them from the sketches the loader maintains.
+# Can be overridden per request with ?mode=, like in app.py. The in-process engine backend of app.py
+# (METRICS_BACKEND=engine) is not served here: exact results always come from the SQL query.
+METRICS_MODE = os.getenv('METRICS_MODE', 'exact')
+
+# Cache of metric results, invalidated when the loader publishes a new data version
+metrics_cache = MetricsCache(
+    max_entries=int(os.getenv('METRICS_CACHE_MAX_ENTRIES', 128)),
+    ttl=float(os.getenv('METRICS_CACHE_TTL', 300)),
+    version_check_interval=float(os.getenv('METRICS_CACHE_VERSION_CHECK_INTERVAL', 5)),
+)
+
+# Pool of asyncpg connections, opened on ASGI startup
+pool = None
+
+
+# Runs concurrent calls with the same key as a single in-flight computation whose result all callers share
+class RequestCoalescer:
+
+    def __init__(self):
+        self.in_flight = {}
+        self.coalesced = 0
+
+    async def run(self, key, compute):
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # A disconnecting client must not cancel the computation the other callers are waiting for
+        return await asyncio.shield(task)
+
+
+coalescer = RequestCoalescer()
+
+
+# Function to open the asyncpg pool with the same DB_POOL_* settings as the synchronous pool
+async def open_pool(db_url_key='DATABASE_KEY'):
+    global pool
+    if asyncpg is None:
+        raise ImportError("asyncpg is required for the async metrics API")
+    load_dotenv()
+    pool = await asyncpg.create_pool(
+        os.getenv(db_url_key),
+        min_size=1,
+        max_size=int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        max_inactive_connection_lifetime=float(os.getenv('DB_POOL_IDLE_TIMEOUT', 300)),
+    )
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+# Helper function to execute a query on a pooled connection and fetch the first value
+async def fetch_value(query, name):
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        registry.observe('db_pool_wait_seconds', time.perf_counter() - start, database='asyncpg')
+        with timed_query(name):
+            return await conn.fetchval(query)
+
+
+# Helper function to execute a query on a pooled connection and fetch all rows
+async def fetch_rows(query, name):
+    start = time.perf_counter()
+    async with pool.acquire() as conn:
+        registry.observe('db_pool_wait_seconds', time.perf_counter() - start, database='asyncpg')
+        with timed_query(name):
+            return await conn.fetch(query)
+
+
+# Helper function to read the data version the loader bumps after every successful load
+async def fetch_data_version():
+    try:
+        version = await fetch_value(get_data_version_query(), 'data_version')
+        return version if version is not None else 0
+    except Exception:
+        # Without a version, results are still cached but only expire through the TTL
+        return None
+
+
+# Function to compute both order medians: one pass over the sessions, or the sketches for mode 'approx'
+async def compute_order_metrics(cache_key, mode):
+    try:
+        if mode == 'approx':
+            median_visits_before_order, median_session_duration_before_order = order_metrics_from_sketch_rows(
+                await fetch_rows(get_order_metric_sketches_query(), 'order_metrics_sketches'))
+        else:
+            rows = await fetch_rows(get_order_metrics_query(), 'order_metrics')
+            median_visits_before_order, median_session_duration_before_order = rows[0]
+    except Exception as e:
+        # Errors are reported but never cached
+        return {
+            "median_visits_before_order": str(e),
+            "median_session_duration_minutes_before_order": str(e)
+        }
+
+    metrics = {
+        "median_visits_before_order": median_visits_before_order,
+        "median_session_duration_minutes_before_order": median_session_duration_before_order
+    }
+    metrics_cache.put(cache_key, metrics)
+    return metrics
+
+
+async def get_order_metrics(mode):
+    fresh, version = metrics_cache.cached_version()
+    if not fresh:
+        version = await coalescer.run(('data_version',), fetch_data_version)
+        metrics_cache.set_version(version)
+
+    # Serve from memory while the data version has not changed, otherwise join or start the computation
+    cache_key = ('orders', mode, version)
+    found, metrics = metrics_cache.get(cache_key)
+    if not found:
+        metrics = await coalescer.run(cache_key, lambda: compute_order_metrics(cache_key, mode))
+    return metrics
+
+
+async def send_response(send, body, content_type, status=200):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200):
+    await send_response(send, json.dumps(data).encode(), b'application/json', status)
+
+
+# ASGI application serving the order metrics endpoints of app.py, e.g. with `uvicorn app_async:app`
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await open_pool()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_pool()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['method'] != 'GET':
+        await send_response(send, b'Method Not Allowed', b'text/plain', status=405)
+    elif scope['path'] == '/metrics/orders':
+        mode = parse_qs(scope.get('query_string', b'').decode()).get('mode', [METRICS_MODE])[0]
+        if mode not in ('exact', 'approx'):
+            await send_json(send, {"error": f"Unknown mode {mode!r}, expected 'exact' or 'approx'"}, status=400)
+        else:
+            await send_json(send, await get_order_metrics(mode))
+    elif scope['path'] == '/metrics/cache':
+        await send_json(send, {**metrics_cache.stats(), "coalesced": coalescer.coalesced})
+    elif scope['path'] == '/metrics/internal':
+        await send_response(send, render_metrics().encode(), b'text/plain; version=0.0.4; charset=utf-8')
+    elif scope['path'] == '/':
+        await send_response(send, b"Session Analysis API is running.", b'text/html; charset=utf-8')
+    else:
+        await send_response(send, b'Not Found', b'text/plain', status=404)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.getenv('HOST', '127.0.0.1'), port=int(os.getenv('PORT', 8000)))
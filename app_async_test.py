@@ -0,0 +1,109 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import patch
+import app_async
+from app_async import app, metrics_cache, coalescer, RequestCoalescer
+from sketches import TDigest
+
+
+# Helper function to send one GET request through the ASGI app and collect the response
+async def get(path, query_string=b''):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string}, receive, send)
+    return messages[0]['status'], messages[1]['body']
+
+
+class TestAsyncApp(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        metrics_cache.clear()
+        metrics_cache.version_check_interval = 5
+        coalescer.coalesced = 0
+
+    async def test_home(self):
+        status, body = await get('/')
+        self.assertEqual(status, 200)
+        self.assertEqual(body.decode(), "Session Analysis API is running.")
+
+    # Test that concurrent identical requests share one run of the single-pass query
+    @patch('app_async.fetch_data_version', return_value=1)
+    async def test_order_metrics_are_coalesced(self, mock_version):
+        calls = []
+
+        async def fake_fetch_rows(query, name):
+            calls.append(query)
+            await asyncio.sleep(0.01)
+            return [(3, 120)]
+
+        with patch('app_async.fetch_rows', side_effect=fake_fetch_rows):
+            responses = await asyncio.gather(*[get('/metrics/orders') for _ in range(20)])
+
+        expected = {"median_visits_before_order": 3, "median_session_duration_minutes_before_order": 120}
+        for status, body in responses:
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), expected)
+
+        # One version check and one run of the query, the other requests joined them
+        self.assertEqual(len(calls), 1)
+        self.assertIn('session_count', calls[0])
+        mock_version.assert_called_once()
+        self.assertEqual(coalescer.coalesced, 19 + 19)
+
+    # Test that a failing query is reported and not cached
+    @patch('app_async.fetch_data_version', return_value=1)
+    async def test_order_metrics_error_not_cached(self, mock_version):
+        with patch('app_async.fetch_rows', side_effect=Exception("connection refused")):
+            status, body = await get('/metrics/orders')
+        self.assertEqual(json.loads(body)["median_visits_before_order"], "connection refused")
+
+        with patch('app_async.fetch_rows', return_value=[(5, 60)]):
+            status, body = await get('/metrics/orders')
+        self.assertEqual(json.loads(body)["median_visits_before_order"], 5)
+
+    # Test that mode=approx answers from the sketches and is cached apart from the exact result
+    @patch('app_async.fetch_data_version', return_value=1)
+    async def test_order_metrics_approx_mode(self, mock_version):
+        visits, duration = TDigest(), TDigest()
+        visits.add([2, 4])
+        duration.add([60])
+        rows = [('sessions_before_order', json.dumps(visits.to_dict())),
+                ('session_duration_before_order', json.dumps(duration.to_dict()))]
+
+        with patch('app_async.fetch_rows', return_value=rows) as mock_fetch:
+            status, body = await get('/metrics/orders', b'mode=approx')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {"median_visits_before_order": 3.0, "median_session_duration_minutes_before_order": 60.0})
+        self.assertIn('order_metric_sketches', mock_fetch.call_args[0][0])
+
+        with patch('app_async.fetch_rows', return_value=[(5, 90)]):
+            status, body = await get('/metrics/orders')
+        self.assertEqual(json.loads(body)["median_visits_before_order"], 5)
+
+    async def test_order_metrics_unknown_mode(self):
+        status, body = await get('/metrics/orders', b'mode=fast')
+        self.assertEqual(status, 400)
+        self.assertIn('fast', json.loads(body)["error"])
+
+    async def test_coalescer_shares_exceptions_and_clears_keys(self):
+        coalescer = RequestCoalescer()
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(coalescer.run('key', fail), coalescer.run('key', fail), return_exceptions=True)
+        self.assertEqual([str(result) for result in results], ["boom", "boom"])
+        self.assertEqual(coalescer.coalesced, 1)
+        await asyncio.sleep(0)
+        self.assertEqual(coalescer.in_flight, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
 import unittest
+import db
 from unittest.mock import patch, MagicMock
-from app import app, get_median_visits_before_order_query, get_median_session_duration_before_order_query
+import pandas as pd
+from sketches import TDigest
+from datetime import datetime
+from app import app, metrics_cache, customer_cache, get_order_metrics_query
+from instrumentation import registry
 
 class TestApp(unittest.TestCase):
 
@@ -8,6 +13,13 @@ class TestApp(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.app.testing = True
+        metrics_cache.clear()
+        metrics_cache.version_check_interval = 5
+        customer_cache.clear()
+
+    # Drop pooled (mocked) connections between tests
+    def tearDown(self):
+        db.close_pools()
 
     # Test the root endpoint
     def test_home(self):
@@ -16,10 +28,11 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response.data.decode(), "Session Analysis API is running.")
 
     # Test the metrics endpoint by mocking the database query function
-    @patch('app.fetch_single_value_from_db')
-    def test_order_metrics(self, mock_fetch):
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_row_from_db')
+    def test_order_metrics(self, mock_fetch, mock_version):
         # Mock return values for the median visits and session duration
-        mock_fetch.side_effect = [3, 120]  # 3 visits, 120 minutes duration
+        mock_fetch.return_value = (3, 120)  # 3 visits, 120 minutes duration
         
         # Call the /metrics/orders endpoint
         response = self.app.get('/metrics/orders')
@@ -34,15 +47,44 @@ class TestApp(unittest.TestCase):
         }
         self.assertEqual(response.json, expected_data)
 
-        # Ensure the function was called twice (once for each query)
-        self.assertEqual(mock_fetch.call_count, 2)
+        # Ensure both medians come from a single query
+        mock_fetch.assert_called_once_with(get_order_metrics_query())
+
+    # Test that repeated polls are served from the cache until the data version changes
+    @patch('app.fetch_data_version')
+    @patch('app.fetch_row_from_db')
+    def test_order_metrics_cache(self, mock_fetch, mock_version):
+        mock_fetch.side_effect = [(3, 120), (4, 90)]
+        mock_version.return_value = 1
+        metrics_cache.version_check_interval = 0
+
+        first = self.app.get('/metrics/orders').json
+        second = self.app.get('/metrics/orders').json
+        self.assertEqual(first, second)
+        self.assertEqual(mock_fetch.call_count, 1)
+
+        # The loader published new data
+        mock_version.return_value = 2
+        third = self.app.get('/metrics/orders').json
+        self.assertEqual(third["median_visits_before_order"], 4)
+
+        stats = self.app.get('/metrics/cache').json
+        self.assertEqual((stats["hits"], stats["misses"], stats["data_version"]), (1, 2, 2))
+
+    # Test that errors are reported in the metrics but not cached
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_row_from_db')
+    def test_order_metrics_error_not_cached(self, mock_fetch, mock_version):
+        mock_fetch.side_effect = [Exception("relation \"sessions\" does not exist"), (3, 120)]
+
+        failed = self.app.get('/metrics/orders').json
+        self.assertEqual(failed["median_visits_before_order"], 'relation "sessions" does not exist')
 
-        # Verify that the correct queries were passed
-        mock_fetch.assert_any_call(get_median_visits_before_order_query())
-        mock_fetch.assert_any_call(get_median_session_duration_before_order_query())
+        recovered = self.app.get('/metrics/orders').json
+        self.assertEqual(recovered["median_visits_before_order"], 3)
 
     # Test database connection failure handling in fetch_single_value_from_db
-    @patch('app.psycopg2.connect', side_effect=Exception("Database connection failed"))
+    @patch('db.psycopg2.connect', side_effect=Exception("Database connection failed"))
     def test_db_connection_failure(self, mock_connect):
         from app import fetch_single_value_from_db
 
@@ -50,5 +92,133 @@ class TestApp(unittest.TestCase):
         result = fetch_single_value_from_db('SELECT 1')
         self.assertEqual(result, "Database connection failed")
 
+    # Test the in-process engine backend, which reads the session rows and computes the medians itself
+    @patch('app.METRICS_BACKEND', 'engine')
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_dataframe_from_db')
+    def test_order_metrics_engine_backend(self, mock_fetch, mock_version):
+        mock_fetch.side_effect = [
+            pd.DataFrame({
+                "customer_id": [1, 1, 2],
+                "session_start": pd.to_datetime(["2022-04-28 10:00", "2022-04-28 11:00", "2022-04-28 10:00"]),
+                "duration_minutes": [4.0, 6.0, 2.0],
+            }),
+            pd.DataFrame({"customer_id": [1, 2], "first_order_time": pd.to_datetime(["2022-04-28 12:00", "2022-04-28 10:30"])}),
+        ]
+
+        response = self.app.get('/metrics/orders')
+
+        self.assertEqual(response.json, {
+            "median_visits_before_order": 1.5,
+            "median_session_duration_minutes_before_order": 4.0
+        })
+
+    # Test that ?mode=approx answers from the persisted sketches and is cached apart from exact results
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_row_from_db', return_value=(3, 120))
+    @patch('app.db.connection')
+    def test_order_metrics_approx_mode(self, mock_connection, mock_fetch, mock_version):
+        mock_cursor = mock_connection.return_value.__enter__.return_value.cursor.return_value
+        mock_cursor.fetchall.return_value = [
+            ('sessions_before_order', TDigest().add([1, 2, 2, 5]).to_dict()),
+            ('session_duration_before_order', TDigest().add([4.0, 6.0]).to_dict()),
+        ]
+
+        approx = self.app.get('/metrics/orders?mode=approx').json
+        exact = self.app.get('/metrics/orders').json
+
+        self.assertEqual(approx, {"median_visits_before_order": 2.0, "median_session_duration_minutes_before_order": 5.0})
+        self.assertEqual(exact["median_visits_before_order"], 3)
+        self.assertEqual(self.app.get('/metrics/orders?mode=fast').status_code, 400)
+
+    # Test the session duration breakdowns read from the rollups, and their parameter validation
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_rows_from_db')
+    def test_session_durations_by_referrer(self, mock_fetch, mock_version):
+        mock_fetch.return_value = [
+            ('(direct)', 0.0, 3, 1.5),
+            ('(direct)', 2.0, 1, 3.0),
+            ('https://www.google.com', 4.0, 2, 9.0),
+        ]
+
+        response = self.app.get('/metrics/session-durations/referrer?start=2022-04-20&end=2022-04-21&bucket_width=2')
+
+        self.assertEqual(response.status_code, 200)
+        params = mock_fetch.call_args[0][1]
+        self.assertEqual((params['dimension'], params['bucket_seconds'], str(params['start'])), ('referrer', 120, '2022-04-20'))
+        direct, google = response.json['groups']
+        self.assertEqual((direct['value'], direct['sessions'], direct['mean_duration_minutes']), ('(direct)', 4, 1.125))
+        self.assertEqual(direct['histogram'], [{"bucket_start_minutes": 0.0, "sessions": 3}, {"bucket_start_minutes": 2.0, "sessions": 1}])
+        # Two of the four sessions fall in the first bucket, so the median is at 2/3 of its width
+        self.assertAlmostEqual(direct['median_duration_minutes'], 4 / 3)
+        self.assertEqual(google['median_duration_minutes'], 5.0)
+
+        # Served from the cache the second time
+        self.app.get('/metrics/session-durations/referrer?start=2022-04-20&end=2022-04-21&bucket_width=2')
+        mock_fetch.assert_called_once()
+
+        self.assertEqual(self.app.get('/metrics/session-durations/browser').status_code, 400)
+        self.assertEqual(self.app.get('/metrics/session-durations/day?bucket_width=0.1').status_code, 400)
+        self.assertEqual(self.app.get('/metrics/session-durations/day?start=yesterday').status_code, 400)
+
+    # Test that query latencies show up on the Prometheus-style internal metrics endpoint
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_row_from_db', return_value=(3, 120))
+    def test_internal_metrics(self, mock_fetch, mock_version):
+        registry.clear()
+        self.app.get('/metrics/orders')
+        response = self.app.get('/metrics/internal')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('api_query_duration_seconds_count{query="order_metrics"} 1', response.data.decode().splitlines())
+
+    # Test keyset pagination of a customer's sessions: one extra row tells there is a next page
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_rows_from_db')
+    def test_customer_sessions_pagination(self, mock_fetch, mock_version):
+        start = datetime(2022, 4, 20, 10, 0)
+        mock_fetch.return_value = [(session_id, start, start, 0.0, 1, False) for session_id in [4, 5, 6]]
+
+        page = self.app.get('/customers/7/sessions?after=3&limit=2').json
+        self.assertEqual([session['session_id'] for session in page['sessions']], [4, 5])
+        self.assertEqual(page['next_after'], 5)
+        self.assertEqual(page['sessions'][0]['session_start'], '2022-04-20T10:00:00')
+        self.assertEqual(mock_fetch.call_args[0][1], {'customer_id': 7, 'after': 3, 'limit': 2})
+
+        # Last page, then the same page again from the customer cache
+        mock_fetch.return_value = mock_fetch.return_value[2:]
+        self.assertIsNone(self.app.get('/customers/7/sessions?after=5&limit=2').json['next_after'])
+        self.app.get('/customers/7/sessions?after=5&limit=2')
+        self.assertEqual(mock_fetch.call_count, 2)
+        self.assertEqual(self.app.get('/metrics/cache').json['customers']['hits'], 1)
+
+        self.assertEqual(self.app.get('/customers/7/sessions?limit=501').status_code, 400)
+        self.assertEqual(self.app.get('/customers/7/sessions?after=-1').status_code, 400)
+
+    # Test that the journey groups the event rows per session
+    @patch('app.fetch_data_version', return_value=1)
+    @patch('app.fetch_rows_from_db')
+    def test_customer_journey(self, mock_fetch, mock_version):
+        start, order = datetime(2022, 4, 20, 10, 0), datetime(2022, 4, 20, 12, 1)
+        session_1 = (1, start, start, 0.0, 2, False, order)
+        session_2 = (2, order, order, 0.0, 1, True, order)
+        mock_fetch.return_value = [
+            session_1 + (start, 'page_view', 'https://xcc-webshop.com', 'https://www.google.com'),
+            session_1 + (start, 'search', None, None),
+            session_2 + (order, 'placed_order', None, None),
+        ]
+
+        journey = self.app.get('/customers/7/journey').json
+        self.assertEqual(journey['first_order_time'], '2022-04-20T12:01:00')
+        self.assertEqual([len(session['events']) for session in journey['sessions']], [2, 1])
+        self.assertEqual(journey['sessions'][0]['events'][0]['referrer'], 'https://www.google.com')
+        self.assertTrue(journey['sessions'][1]['has_order'])
+        self.assertIsNone(journey['next_after'])
+
+        # With a page of one session, the second session's rows mean there is a next page
+        page = self.app.get('/customers/7/journey?limit=1').json
+        self.assertEqual((len(page['sessions']), page['next_after']), (1, 1))
+
 if __name__ == '__main__':
     unittest.main()
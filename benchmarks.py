@@ -0,0 +1,750 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import tracemalloc
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
+from sessionization import sessionize_data, sessionize_data_iterrows, sweep_session_timeouts, sessionize_parallel
+import db
+from db_insert import copy_dataframe_to_db, copy_dataframe_in_batches
+from db_creation import EVENT_INDEXES, ORDER_EVENT_INDEXES, RETIRED_EVENT_INDEXES
+import ingestion
+from ingestion import compact_events, load_events
+from event_cache import EventCache
+from metrics_engine import compute_order_metrics
+from export import EXPORT_DATASETS, get_export_query, stream_export, build_encoder
+
+EVENT_TYPES = [
+    'page_view', 'search', 'add_product_to_cart', 'remove_product_from_cart', 'sign_up_success',
+    'visit_related_product', 'visit_recently_visited_product', 'visit_personal_recommendation', 'placed_order'
+]
+EVENT_TYPE_WEIGHTS = [0.45, 0.2, 0.1, 0.03, 0.01, 0.07, 0.06, 0.05, 0.03]
+USER_AGENTS = [
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 14_2 like Mac OS X) AppleWebKit/532.0 (KHTML, like Gecko) FxiOS/14.7g5052.0 Mobile/28A193 Safari/532.0',
+    'Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 5.01; Trident/5.0)',
+    'Mozilla/5.0 (Windows CE) AppleWebKit/535.0 (KHTML, like Gecko) Chrome/21.0.822.0 Safari/535.0',
+    'Opera/9.47.(X11; Linux x86_64; mai-IN) Presto/2.9.179 Version/10.00',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:1.9.6.20) Gecko/2019-09-06 09:51:12 Firefox/3.6.2',
+]
+PAGES = ['https://xcc-webshop.com', 'https://xcc-webshop.com/cart'] + [f'https://xcc-webshop.com/category/{i}' for i in range(1, 15)]
+REFERRERS = ['https://gonzalez.com', 'https://www.google.com', 'https://smith.biz']
+
+
+# Function to generate a seeded synthetic events DataFrame shaped like fetch_and_transform_data output.
+# customer_skew > 0 draws customers from a Zipf-like distribution (a few heavy customers, a long tail)
+# instead of uniformly, and mean_gap is the mean number of seconds between events within a visit.
+def generate_synthetic_events(n_events, events_per_customer=50, seed=42, customer_skew=0.0, mean_gap=60, first_customer_id=1, first_event_id=1):
+    rng = np.random.default_rng(seed)
+    n_customers = max(1, n_events // events_per_customer)
+
+    # Events of one customer arrive in bursts: mostly short gaps, occasionally a long pause
+    if customer_skew > 0:
+        weights = 1.0 / np.arange(1, n_customers + 1) ** customer_skew
+        customer_ids = np.sort(rng.choice(n_customers, size=n_events, p=weights / weights.sum())) + first_customer_id
+    else:
+        customer_ids = np.sort(rng.integers(first_customer_id, first_customer_id + n_customers, size=n_events))
+    short_gaps = rng.exponential(mean_gap, size=n_events)
+    long_gaps = rng.exponential(6 * 3600, size=n_events)
+    gaps = np.where(rng.random(n_events) < 0.85, short_gaps, long_gaps)
+    offsets = pd.Series(gaps).groupby(customer_ids).cumsum().to_numpy()
+    # Microsecond precision like the real feed (and PostgreSQL TIMESTAMP)
+    timestamps = (pd.Timestamp('2022-04-20') + pd.to_timedelta(offsets, unit='s')).floor('us')
+
+    event_types = rng.choice(EVENT_TYPES, size=n_events, p=EVENT_TYPE_WEIGHTS)
+    is_page_view = event_types == 'page_view'
+    has_referrer = is_page_view & (rng.random(n_events) < 0.2)
+    df = pd.DataFrame({
+        'id': rng.permutation(n_events) + first_event_id,
+        'type': event_types,
+        'timestamp': timestamps,
+        'customer_id': customer_ids,
+        'user_agent': rng.choice(USER_AGENTS, size=n_events),
+        'ip': [f'10.0.{c % 256}.{c // 256 % 256}' for c in customer_ids],
+        'query': np.where(event_types == 'search', 'Synchronized didactic task-force', None),
+        'page': np.where(is_page_view, rng.choice(PAGES, size=n_events), None),
+        'referrer': np.where(has_referrer, rng.choice(REFERRERS, size=n_events), None),
+    })
+
+    # Shuffle the rows so the feed is not already sorted
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+# Function to generate a large synthetic feed in seeded chunks of disjoint customers and event ids,
+# so feeds far bigger than memory can be written out chunk by chunk
+def iter_synthetic_event_chunks(n_events, chunk_size=1_000_000, seed=42, **options):
+    for index, start in enumerate(range(0, n_events, chunk_size)):
+        size = min(chunk_size, n_events - start)
+        yield generate_synthetic_events(size, seed=seed + index, first_customer_id=start + 1, first_event_id=start + 1, **options)
+
+
+# Function to time a callable and return the elapsed seconds
+def time_call(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+# Benchmark the vectorized sessionization engine against the original iterrows loop
+def benchmark_sessionize(sizes, session_timeout=8, loop_max_rows=1_000_000):
+    for size in sizes:
+        df = generate_synthetic_events(size)
+        vectorized = time_call(sessionize_data, df, session_timeout)
+        print(f"{size:>12,} events | vectorized: {vectorized:8.2f}s ({size / vectorized:>14,.0f} rows/s)")
+
+        if size <= loop_max_rows:
+            loop = time_call(sessionize_data_iterrows, df, session_timeout)
+            print(f"{'':>12}        | iterrows:   {loop:8.2f}s ({size / loop:>14,.0f} rows/s) -> {loop / vectorized:.0f}x speedup")
+        else:
+            print(f"{'':>12}        | iterrows:   skipped (above --loop-max-rows)")
+
+
+# Benchmark the single-pass timeout sweep against sessionizing once per timeout
+def benchmark_sweep(size, min_timeout=1, max_timeout=60):
+    df = generate_synthetic_events(size)
+    timeouts = range(min_timeout, max_timeout + 1)
+
+    sweep = time_call(sweep_session_timeouts, df, timeouts)
+    print(f"{size:>12,} events x {len(timeouts)} timeouts")
+    print(f"    single-pass sweep: {sweep:8.2f}s")
+
+    def sessionize_per_timeout():
+        for timeout in timeouts:
+            sessionized_df = sessionize_data(df, session_timeout=timeout)
+            sessionized_df.groupby(['customer_id', 'session_id'])['timestamp'].agg(['min', 'max'])
+
+    per_timeout = time_call(sessionize_per_timeout)
+    print(f"    per-timeout loop:  {per_timeout:8.2f}s -> {per_timeout / sweep:.1f}x speedup")
+
+
+# Benchmark how the multiprocess sessionization engine scales with the number of workers
+def benchmark_parallel(size, workers=(1, 2, 4, 8, 16, 32), session_timeout=8):
+    df = generate_synthetic_events(size)
+    baseline = time_call(sessionize_data, df, session_timeout)
+    print(f"{size:>12,} events | single process: {baseline:8.2f}s ({size / baseline:>14,.0f} rows/s)")
+    for worker_count in workers:
+        elapsed = time_call(sessionize_parallel, df, session_timeout, worker_count)
+        print(f"{'':>12}        | {worker_count:>3} workers:    {elapsed:8.2f}s ({size / elapsed:>14,.0f} rows/s) -> {baseline / elapsed:.1f}x")
+
+
+# Report the in-memory bytes per event of the parsed frame and of the compact representation
+def benchmark_compact(size):
+    df = generate_synthetic_events(size)
+    compact = compact_events(df)
+    before = df.memory_usage(deep=True, index=False) / size
+    after = compact.memory_usage(deep=True, index=False) / size
+
+    print(f"{size:>12,} events, bytes per event")
+    for column in df.columns:
+        print(f"    {column:<12} {before[column]:8.1f} -> {after[column]:8.1f}  ({compact[column].dtype.name})")
+    print(f"    {'total':<12} {before.sum():8.1f} -> {after.sum():8.1f}  ({before.sum() / after.sum():.1f}x smaller)")
+
+
+# Function to write events as JSON lines in the shape of the remote events.json feed
+def write_events_json(df, path, mode='w'):
+    with open(path, mode) as events_file:
+        for row in df.itertuples(index=False):
+            data = {'user-agent': row.user_agent, 'ip': row.ip, 'customer-id': int(row.customer_id), 'timestamp': row.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+            for field in ['query', 'page', 'referrer']:
+                value = getattr(row, field)
+                if isinstance(value, str):
+                    data[field] = value
+            events_file.write(json.dumps({'id': int(row.id), 'type': row.type, 'event': data}) + '\n')
+
+
+# Compare parsing the JSON lines feed (cold cache) with reading the Arrow entry back (warm cache)
+def benchmark_cache(size):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'events.json')
+        write_events_json(generate_synthetic_events(size), path)
+        cache = EventCache(os.path.join(directory, 'cache'))
+
+        cold = time_call(cache.load, path, loader=load_events)
+        warm = time_call(cache.load, path, loader=load_events)
+        print(f"{size:>12,} events | cold (parse + write) {cold:8.2f}s | warm (Arrow read) {warm:8.2f}s | {cold / warm:6.1f}x")
+
+
+# Compare events/sec of the parser backends on the same JSON lines file; 'json' is the previous stdlib path
+def benchmark_parse(size, chunk_size=100_000):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'events.json')
+        write_events_json(generate_synthetic_events(size), path)
+
+        baseline = None
+        for parser in ['json', 'orjson', 'pyarrow']:
+            if getattr(ingestion, parser if parser != 'pyarrow' else 'pa', True) is None:
+                print(f"{parser:<8} not installed")
+                continue
+            elapsed = time_call(load_events, path, chunk_size, parser)
+            baseline = baseline or elapsed
+            print(f"{parser:<8} {size / elapsed:12,.0f} events/s | {elapsed:8.2f}s | {baseline / elapsed:5.1f}x")
+
+
+# Time the in-process order metrics engine on sessionized events of increasing size
+def benchmark_metrics(sizes, session_timeout=8):
+    for size in sizes:
+        df = sessionize_data(generate_synthetic_events(size), session_timeout)
+        elapsed = time_call(compute_order_metrics, df)
+        print(f"{size:>12,} events | metrics engine {elapsed:8.2f}s | {size / elapsed:14,.0f} events/s")
+
+
+# Stand-in for a PostgreSQL connection whose COPY drains the file like the socket would
+class NullCopyConnection:
+    closed = 0
+
+    def get_transaction_status(self):
+        return 0
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, file, size=8192):
+        while file.read(size):
+            pass
+
+    def execute(self, sql):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Function to measure the peak traced allocation (Python objects and NumPy buffers) of a callable
+def peak_memory(func, *args, **kwargs):
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+# Function to run one variant of benchmark_copy: the single-buffer COPY (workers=0) or the batched loader with
+# that many workers. Meant to run in a fresh interpreter (see benchmark_copy), so the peak RSS belongs to this
+# variant alone. Where the peak can be reset, it only covers the load and not the generation of the events.
+def run_copy_variant(size, workers=0, batch_size=50_000, db_url_key=None, table_name='webshop_events'):
+    df = sessionize_data(generate_synthetic_events(size), session_timeout=8)
+    loader_key = db_url_key or 'DATABASE_KEY'
+    if workers:
+        # Atomic loads use a single connection, several workers commit batch by batch
+        variant = lambda: copy_dataframe_in_batches(loader_key, df, table_name, batch_size, workers, atomic=workers == 1)
+    else:
+        variant = lambda: copy_dataframe_to_db(loader_key, df, table_name)
+
+    if db_url_key:
+        # Start from an empty table on the real database
+        with db.connection(db_url_key) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"TRUNCATE {table_name};")
+            conn.commit()
+            cursor.close()
+        setup_rss = peak_rss()
+        load_only = reset_peak_rss()
+        elapsed = time_call(variant)
+    else:
+        setup_rss = peak_rss()
+        load_only = reset_peak_rss()
+        with patch('psycopg2.connect', side_effect=lambda **kwargs: NullCopyConnection()):
+            try:
+                elapsed = time_call(variant)
+            finally:
+                db.close_pools()
+    return {'rows': size, 'seconds': elapsed, 'setup_peak_rss_bytes': setup_rss, 'peak_rss_bytes': peak_rss(),
+            'peak_rss_includes_setup': not load_only}
+
+
+# Benchmark the single-buffer COPY against the batched, pipelined loader, every variant in its own process
+def benchmark_copy(size, batch_size=50_000, workers=(1, 4), db_url_key=None, table_name='webshop_events'):
+    target = db_url_key or 'null COPY stand-in'
+    print(f"{size:>12,} events into {target}")
+    for worker_count in [0, *workers]:
+        name = f'copy_dataframe_in_batches workers={worker_count}' if worker_count else 'copy_dataframe_to_db'
+        command = [sys.executable, os.path.abspath(__file__), 'copy-variant', str(size), '--workers', str(worker_count),
+                   '--batch-size', str(batch_size), '--table', table_name] + (['--db-url-key', db_url_key] if db_url_key else [])
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"    {name:<40} failed:\n{completed.stderr}")
+            continue
+
+        # The variant prints its measurements as the last line of its output
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"    {name:<40} {size / result['seconds']:>12,.0f} rows/s | peak RSS {result['peak_rss_bytes'] / 2**20:8.1f} MiB"
+              f"{' (including the setup)' if result['peak_rss_includes_setup'] else ''} | setup {result['setup_peak_rss_bytes'] / 2**20:8.1f} MiB")
+
+
+# Function to fire total requests from concurrency threads and return per-request latencies and wall time
+def load_test(send_request, total=500, concurrency=8):
+    def timed_request(_):
+        start = time.perf_counter()
+        send_request()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed_request, range(total)))
+    return latencies, time.perf_counter() - start
+
+
+# Function to print throughput and latency percentiles of a load test
+def report_latencies(name, latencies, elapsed):
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    print(f"    {name:<40} {len(latencies) / elapsed:>8,.1f} req/s | p50 {p50:8.1f} ms | p99 {p99:8.1f} ms")
+
+
+# Load test /metrics/orders, either on running servers (e.g. app.py next to app_async.py) or
+# in-process with and without connection pooling
+def benchmark_serve(urls=None, total=500, concurrency=8, path='/metrics/orders'):
+    if urls:
+        import requests
+        print(f"{path}, {total} requests, {concurrency} concurrent clients")
+        for url in urls:
+            latencies, elapsed = load_test(lambda: requests.get(url + path).raise_for_status(), total, concurrency)
+            report_latencies(url, latencies, elapsed)
+        return
+
+    from app import app, metrics_cache
+    client = app.test_client()
+    print(f"{path} in-process against DATABASE_KEY, {total} requests, {concurrency} threads")
+
+    def uncached_request():
+        # Every request queries the database instead of hitting the metrics cache
+        metrics_cache.clear()
+        client.get(path)
+
+    # idle_timeout=0 closes every connection on release, i.e. one new connection per query as before
+    for name, idle_timeout in [('new connection per query', 0), ('pooled connections', None)]:
+        db.configure_pool('DATABASE_KEY', max_size=concurrency, idle_timeout=idle_timeout)
+        latencies, elapsed = load_test(uncached_request, total, concurrency)
+        report_latencies(name, latencies, elapsed)
+    db.close_pools()
+
+
+# Function to export a dataset the naive way: fetchall into memory, then encode everything at once
+def export_fetchall(dataset, export_format, db_url_key='DATABASE_KEY'):
+    encoder = build_encoder(dataset, export_format)
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor()
+        cursor.execute(get_export_query(dataset), {'start': None, 'end': None})
+        rows = cursor.fetchall()
+        conn.rollback()
+    return len(encoder.header() + encoder.encode(rows) + encoder.footer())
+
+
+# Function to export a dataset through the streaming generator, returning the bytes produced
+def export_streaming(dataset, export_format, db_url_key='DATABASE_KEY', batch_rows=None):
+    return sum(len(chunk) for chunk in stream_export(dataset, export_format, batch_rows=batch_rows, db_url_key=db_url_key))
+
+
+# Benchmark streaming exports of what is loaded in the database against fetchall, in rows/s and peak memory
+def benchmark_export(datasets=tuple(EXPORT_DATASETS), formats=('csv', 'ndjson', 'arrow'), db_url_key='DATABASE_KEY', batch_rows=None):
+    for dataset in datasets:
+        with db.connection(db_url_key) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM {EXPORT_DATASETS[dataset]['table']};")
+            rows = cursor.fetchone()[0]
+        print(f"{dataset}: {rows:,} rows")
+        for export_format in formats:
+            for name, export in [('fetchall', export_fetchall), ('streaming', export_streaming)]:
+                kwargs = {'batch_rows': batch_rows} if export is export_streaming else {}
+                start = time.perf_counter()
+                nbytes = export(dataset, export_format, db_url_key, **kwargs)
+                elapsed = time.perf_counter() - start
+                peak = peak_memory(export, dataset, export_format, db_url_key, **kwargs)
+                print(f"    {export_format:<7} {name:<10} {rows / elapsed:>12,.0f} rows/s | {nbytes / 2**20:8.1f} MiB out | peak {peak / 2**20:8.1f} MiB")
+
+
+EXPLAIN_QUERIES = {
+    'session aggregates': """
+        SELECT customer_id, session_id, MIN(timestamp), MAX(timestamp), COUNT(*), BOOL_OR(event_type = 'placed_order')
+        FROM webshop_events
+        GROUP BY customer_id, session_id;
+    """,
+    'first orders': """
+        SELECT customer_id, MIN(timestamp)
+        FROM webshop_events
+        WHERE event_type = 'placed_order'
+        GROUP BY customer_id;
+    """,
+    'one customer': """
+        SELECT session_id, MIN(timestamp), MAX(timestamp)
+        FROM webshop_events
+        WHERE customer_id = (SELECT MIN(customer_id) FROM webshop_events)
+        GROUP BY session_id;
+    """,
+}
+
+
+# Function to run EXPLAIN ANALYZE on a query and summarize the plan by its scan nodes
+def explain_query(cursor, query):
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query)
+    plan = cursor.fetchone()[0][0]
+    root = plan['Plan']
+    buffers = root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0)
+
+    nodes = [root]
+    scans = []
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        if 'Scan' in node['Node Type'] and node['Node Type'] not in scans:
+            scans.append(node['Node Type'])
+    return plan['Execution Time'], ', '.join(scans), buffers
+
+
+# Benchmark the webshop_events access paths with and without the indexes from db_creation
+def benchmark_explain(db_url_key='DATABASE_KEY'):
+    with db.connection(db_url_key) as conn:
+        # Refresh statistics and the visibility map so index-only scans are possible
+        conn.autocommit = True
+        conn.cursor().execute("VACUUM ANALYZE webshop_events;")
+        conn.autocommit = False
+
+        cursor = conn.cursor()
+        results = {}
+        for variant in ['without indexes', 'with indexes']:
+            if variant == 'without indexes':
+                # Dropped inside the transaction and restored by the rollback below
+                for index_name in [*EVENT_INDEXES, *ORDER_EVENT_INDEXES, *RETIRED_EVENT_INDEXES]:
+                    cursor.execute(f"DROP INDEX IF EXISTS {index_name};")
+            for name, query in EXPLAIN_QUERIES.items():
+                results[(name, variant)] = explain_query(cursor, query)
+            conn.rollback()
+        cursor.close()
+
+    for name in EXPLAIN_QUERIES:
+        print(name)
+        for variant in ['without indexes', 'with indexes']:
+            elapsed, node, buffers = results[(name, variant)]
+            print(f"    {variant:<16} {elapsed:10.1f} ms | {buffers:>10,} buffers | {node}")
+
+
+SUITE_STAGES = ['parse', 'sessionize', 'load', 'serve']
+
+# Stages that empty and refill webshop_events; they only run against BENCHMARK_DATABASE_KEY, never the
+# database of the loader and the API
+SUITE_DATABASE_STAGES = ['load', 'serve']
+
+
+# Stand-in for the requests.get response in fetch_and_transform_data, serving a local JSON lines file
+class FileResponse:
+    status_code = 200
+
+    def __init__(self, path):
+        with open(path, 'rb') as events_file:
+            self.content = events_file.read()
+        self.text = self.content.decode()
+
+
+# Helper function to read the peak resident set size of this process in bytes
+def peak_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+# Helper function to restart the peak resident set size from the current one, so peak_rss only covers
+# what runs afterwards. Only Linux supports this (through /proc/self/clear_refs); returns whether it did.
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Stage timing fetch_and_transform_data on the feed, without the download
+def suite_parse(events_path, session_timeout, requests_count):
+    from ingestion import fetch_and_transform_data
+    response = FileResponse(events_path)
+    setup_rss = peak_rss()
+    with patch('ingestion.requests.get', return_value=response):
+        start = time.perf_counter()
+        df = fetch_and_transform_data()
+        elapsed = time.perf_counter() - start
+    return {'rows': len(df), 'seconds': elapsed, 'setup_peak_rss_bytes': setup_rss}
+
+
+# Stage timing sessionize_data on the parsed feed
+def suite_sessionize(events_path, session_timeout, requests_count):
+    df = load_events(events_path)
+    setup_rss = peak_rss()
+    elapsed = time_call(sessionize_data, df, session_timeout)
+    return {'rows': len(df), 'seconds': elapsed, 'setup_peak_rss_bytes': setup_rss}
+
+
+# Stage timing copy_dataframe_to_db of the sessionized feed into an emptied webshop_events on the
+# benchmark database (see run_suite_stage)
+def suite_load(events_path, session_timeout, requests_count):
+    from db_creation import create_db_table, create_session_tables
+    df = sessionize_data(load_events(events_path), session_timeout)
+    create_db_table()
+    create_session_tables()
+    with db.connection('DATABASE_KEY') as conn:
+        cursor = conn.cursor()
+        cursor.execute("TRUNCATE webshop_events;")
+        conn.commit()
+        cursor.close()
+    setup_rss = peak_rss()
+
+    elapsed = time_call(copy_dataframe_to_db, 'DATABASE_KEY', df, 'webshop_events')
+    with db.connection('DATABASE_KEY') as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM webshop_events;")
+        rows = cursor.fetchone()[0]
+        cursor.close()
+    return {'rows': rows, 'seconds': elapsed, 'setup_peak_rss_bytes': setup_rss}
+
+
+# Stage timing uncached /metrics/orders requests on the events the load stage left in the benchmark database
+def suite_serve(events_path, session_timeout, requests_count):
+    from db_insert import refresh_session_tables
+    from app import app, metrics_cache
+    refresh_session_tables('DATABASE_KEY', session_timeout)
+    client = app.test_client()
+    setup_rss = peak_rss()
+
+    def uncached_request():
+        # Every request computes the medians again instead of hitting the metrics cache
+        metrics_cache.clear()
+        client.get('/metrics/orders').get_json()
+
+    latencies, elapsed = load_test(uncached_request, requests_count, concurrency=1)
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    db.close_pools()
+    return {'rows': requests_count, 'seconds': elapsed, 'setup_peak_rss_bytes': setup_rss, 'p50_ms': p50, 'p99_ms': p99}
+
+
+SUITE_STAGE_FUNCTIONS = {
+    'parse': suite_parse,
+    'sessionize': suite_sessionize,
+    'load': suite_load,
+    'serve': suite_serve,
+}
+
+
+# Function to run one suite stage and add throughput and the peak RSS of the whole process. Meant to run
+# in a fresh interpreter (see benchmark_suite), so the peak belongs to this stage alone.
+def run_suite_stage(stage, events_path, session_timeout=8, requests_count=50):
+    if stage in SUITE_DATABASE_STAGES:
+        if not os.getenv('BENCHMARK_DATABASE_KEY'):
+            raise ValueError(f"The {stage} stage empties webshop_events, set BENCHMARK_DATABASE_KEY to a scratch database URL")
+        # The table setup, the loader and the API all read DATABASE_KEY, so this process points it at the scratch database
+        os.environ['DATABASE_KEY'] = os.environ['BENCHMARK_DATABASE_KEY']
+    result = SUITE_STAGE_FUNCTIONS[stage](events_path, session_timeout, requests_count)
+    result['per_second'] = result['rows'] / result['seconds'] if result['seconds'] else None
+    result['peak_rss_bytes'] = peak_rss()
+    return {'stage': stage, **result}
+
+
+# Run the whole suite: per size, write a seeded feed once and run every stage in its own process,
+# then record throughput and peak RSS as JSON so runs can be compared for regressions
+def benchmark_suite(sizes, output, stages=SUITE_STAGES, session_timeout=8, requests_count=50, seed=42, events_per_customer=50, customer_skew=0.0, mean_gap=60):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f'events-{size}.json')
+            open(path, 'w').close()
+            for chunk in iter_synthetic_event_chunks(size, seed=seed, events_per_customer=events_per_customer, customer_skew=customer_skew, mean_gap=mean_gap):
+                write_events_json(chunk, path, mode='a')
+
+            for stage in stages:
+                if stage in SUITE_DATABASE_STAGES and not os.getenv('BENCHMARK_DATABASE_KEY'):
+                    print(f"{size:>12,} events | {stage:<10} skipped, BENCHMARK_DATABASE_KEY is not set")
+                    continue
+                command = [sys.executable, os.path.abspath(__file__), 'stage', stage, path,
+                           '--session-timeout', str(session_timeout), '--requests', str(requests_count)]
+                completed = subprocess.run(command, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(f"{size:>12,} events | {stage:<10} failed:\n{completed.stderr}")
+                    results.append({'size': size, 'stage': stage, 'error': completed.stderr.strip().splitlines()[-1:]})
+                    continue
+
+                # The stage prints its measurements as the last line of its output
+                result = {'size': size, **json.loads(completed.stdout.strip().splitlines()[-1])}
+                results.append(result)
+                print(f"{size:>12,} events | {stage:<10} {result['seconds']:8.2f}s | {result['per_second']:>14,.0f} /s | peak RSS {result['peak_rss_bytes'] / 2**20:8.1f} MiB")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'seed': seed, 'events_per_customer': events_per_customer, 'customer_skew': customer_skew,
+            'mean_gap': mean_gap, 'session_timeout': session_timeout, 'requests': requests_count,
+        },
+        'results': results,
+    }
+    with open(output, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Results written to {output}")
+    return report
+
+
+# Modules of the loader and the API, which must stay importable without the plotting libraries
+CORE_MODULES = ['ingestion', 'sessionization', 'event_cache', 'db_insert', 'app', 'cli', 'exploratory_data_analysis']
+HEAVY_MODULES = ['matplotlib', 'tqdm']
+
+
+# Function to measure the cold import of a module in a fresh interpreter with -X importtime: the best
+# cumulative time over repeat runs, and which of the heavy modules the import pulled in
+def measure_import(module, repeat=5):
+    code = f"import sys, {module}; print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        # Lines look like "import time:  self [us] | cumulative | imported package"
+        for line in completed.stderr.splitlines():
+            fields = line.split('|')
+            if line.startswith('import time:') and len(fields) == 3 and fields[2].strip() == module:
+                seconds = int(fields[1]) / 1e6
+                best = seconds if best is None else min(best, seconds)
+    heavy = [name for name in completed.stdout.strip().split(',') if name]
+    return best, heavy
+
+
+# Benchmark the cold-start import time of the core modules. With a budget, fails (exit status 1) when a
+# module takes longer or imports a plotting library, so it can guard against regressions in CI.
+def benchmark_imports(modules=CORE_MODULES, repeat=5, budget=None):
+    failures = []
+    for module in modules:
+        seconds, heavy = measure_import(module, repeat)
+        over_budget = budget is not None and seconds > budget
+        if over_budget or heavy:
+            failures.append(module)
+        print(f"{module:<28} {seconds * 1000:8.1f} ms | heavy modules: {', '.join(heavy) or 'none'}{' | over budget' if over_budget else ''}")
+    if failures:
+        print(f"Import regressions in: {', '.join(failures)}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the sessionization pipeline")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    sessionize_parser = subparsers.add_parser('sessionize', help="Vectorized sessionization vs the iterrows loop")
+    sessionize_parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000, 10_000_000])
+    sessionize_parser.add_argument('--session-timeout', type=int, default=8)
+    sessionize_parser.add_argument('--loop-max-rows', type=int, default=1_000_000)
+
+    sweep_parser = subparsers.add_parser('sweep', help="Single-pass timeout sweep vs one sessionization per timeout")
+    sweep_parser.add_argument('--size', type=int, default=1_000_000)
+    sweep_parser.add_argument('--min-timeout', type=int, default=1)
+    sweep_parser.add_argument('--max-timeout', type=int, default=60)
+
+    parallel_parser = subparsers.add_parser('parallel', help="Multiprocess sessionization scaling across worker counts")
+    parallel_parser.add_argument('--size', type=int, default=10_000_000)
+    parallel_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+
+    compact_parser = subparsers.add_parser('compact', help="Bytes per event of the parsed vs the compact representation")
+    compact_parser.add_argument('--size', type=int, default=1_000_000)
+
+    cache_parser = subparsers.add_parser('cache', help="Cold vs warm load through the on-disk event cache")
+    cache_parser.add_argument('--size', type=int, default=1_000_000)
+
+    parse_parser = subparsers.add_parser('parse', help="Events/sec of the JSON lines parser backends")
+    parse_parser.add_argument('--size', type=int, default=1_000_000)
+
+    metrics_parser = subparsers.add_parser('metrics', help="In-process order metrics engine on sessionized events")
+    metrics_parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000, 10_000_000])
+
+    copy_parser = subparsers.add_parser('copy', help="Single-buffer COPY vs batched, pipelined COPY loader")
+    copy_parser.add_argument('--size', type=int, default=1_000_000)
+    copy_parser.add_argument('--batch-size', type=int, default=50_000)
+    copy_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    copy_parser.add_argument('--db-url-key', default=None, help="Environment variable with a PostgreSQL URL; omit to use the stand-in")
+    copy_parser.add_argument('--table', default='webshop_events')
+
+    copy_variant_parser = subparsers.add_parser('copy-variant', help="Run a single copy benchmark variant and print its measurements as JSON")
+    copy_variant_parser.add_argument('size', type=int)
+    copy_variant_parser.add_argument('--workers', type=int, default=0, help="Workers of the batched loader; 0 runs the single-buffer COPY")
+    copy_variant_parser.add_argument('--batch-size', type=int, default=50_000)
+    copy_variant_parser.add_argument('--db-url-key', default=None)
+    copy_variant_parser.add_argument('--table', default='webshop_events')
+
+    serve_parser = subparsers.add_parser('serve', help="Load test /metrics/orders (p50/p99 latency, throughput)")
+    serve_parser.add_argument('--url', nargs='+', default=None, help="Base URLs of running servers to compare; omit to compare pooled vs unpooled in-process")
+    serve_parser.add_argument('--requests', type=int, default=500)
+    serve_parser.add_argument('--concurrency', type=int, default=8)
+
+    suite_parser = subparsers.add_parser('suite', help="Parse, sessionize, load and serve on a seeded feed, recorded as JSON (load and serve empty webshop_events of BENCHMARK_DATABASE_KEY)")
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    suite_parser.add_argument('--stages', nargs='+', choices=SUITE_STAGES, default=SUITE_STAGES)
+    suite_parser.add_argument('--output', default='benchmark-results.json')
+    suite_parser.add_argument('--session-timeout', type=int, default=8)
+    suite_parser.add_argument('--requests', type=int, default=50)
+    suite_parser.add_argument('--seed', type=int, default=42)
+    suite_parser.add_argument('--events-per-customer', type=int, default=50)
+    suite_parser.add_argument('--customer-skew', type=float, default=0.0, help="Zipf exponent of the events per customer; 0 is uniform")
+    suite_parser.add_argument('--mean-gap', type=float, default=60, help="Mean seconds between events within a visit")
+
+    stage_parser = subparsers.add_parser('stage', help="Run a single suite stage on a JSON lines file and print its measurements as JSON")
+    stage_parser.add_argument('stage', choices=SUITE_STAGES)
+    stage_parser.add_argument('events_path')
+    stage_parser.add_argument('--session-timeout', type=int, default=8)
+    stage_parser.add_argument('--requests', type=int, default=50)
+
+    imports_parser = subparsers.add_parser('imports', help="Cold-start import time of the core modules, optionally against a budget")
+    imports_parser.add_argument('--modules', nargs='+', default=CORE_MODULES)
+    imports_parser.add_argument('--repeat', type=int, default=5)
+    imports_parser.add_argument('--budget', type=float, default=None, help="Maximum seconds per module import")
+
+    export_parser = subparsers.add_parser('export', help="Streaming export of the loaded events and sessions vs fetchall (rows/s, peak memory)")
+    export_parser.add_argument('--datasets', nargs='+', choices=list(EXPORT_DATASETS), default=list(EXPORT_DATASETS))
+    export_parser.add_argument('--formats', nargs='+', choices=['csv', 'ndjson', 'arrow'], default=['csv', 'ndjson', 'arrow'])
+    export_parser.add_argument('--db-url-key', default='DATABASE_KEY')
+    export_parser.add_argument('--batch-rows', type=int, default=None)
+
+    explain_parser = subparsers.add_parser('explain', help="EXPLAIN ANALYZE of webshop_events queries without and with the indexes")
+    explain_parser.add_argument('--db-url-key', default='DATABASE_KEY')
+
+    args = parser.parse_args()
+    if args.benchmark == 'sessionize':
+        benchmark_sessionize(args.sizes, args.session_timeout, args.loop_max_rows)
+    elif args.benchmark == 'sweep':
+        benchmark_sweep(args.size, args.min_timeout, args.max_timeout)
+    elif args.benchmark == 'parallel':
+        benchmark_parallel(args.size, args.workers)
+    elif args.benchmark == 'compact':
+        benchmark_compact(args.size)
+    elif args.benchmark == 'cache':
+        benchmark_cache(args.size)
+    elif args.benchmark == 'parse':
+        benchmark_parse(args.size)
+    elif args.benchmark == 'metrics':
+        benchmark_metrics(args.sizes)
+    elif args.benchmark == 'copy':
+        benchmark_copy(args.size, args.batch_size, args.workers, args.db_url_key, args.table)
+    elif args.benchmark == 'copy-variant':
+        print(json.dumps(run_copy_variant(args.size, args.workers, args.batch_size, args.db_url_key, args.table)))
+    elif args.benchmark == 'serve':
+        benchmark_serve(args.url, args.requests, args.concurrency)
+    elif args.benchmark == 'suite':
+        benchmark_suite(args.sizes, args.output, args.stages, args.session_timeout, args.requests, args.seed,
+                        args.events_per_customer, args.customer_skew, args.mean_gap)
+    elif args.benchmark == 'stage':
+        print(json.dumps(run_suite_stage(args.stage, args.events_path, args.session_timeout, args.requests)))
+    elif args.benchmark == 'imports':
+        sys.exit(benchmark_imports(args.modules, args.repeat, args.budget))
+    elif args.benchmark == 'export':
+        benchmark_export(args.datasets, args.formats, args.db_url_key, args.batch_rows)
+    elif args.benchmark == 'explain':
+        benchmark_explain(args.db_url_key)
+
+
+if __name__ == "__main__":
+    main()
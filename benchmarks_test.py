@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+from benchmarks import generate_synthetic_events, iter_synthetic_event_chunks, write_events_json, run_suite_stage, run_copy_variant
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_chunked_feed_is_seeded_and_follows_the_events_schema(self):
+        chunks = list(iter_synthetic_event_chunks(2500, chunk_size=1000, events_per_customer=20, customer_skew=1.1))
+        again = pd.concat(iter_synthetic_event_chunks(2500, chunk_size=1000, events_per_customer=20, customer_skew=1.1), ignore_index=True)
+        df = pd.concat(chunks, ignore_index=True)
+
+        # The same seed gives the same feed, and chunks never share event ids or customers
+        pd.testing.assert_frame_equal(df, again)
+        self.assertTrue(df['id'].is_unique)
+        customers = [set(chunk['customer_id']) for chunk in chunks]
+        self.assertFalse(customers[0] & customers[1] or customers[1] & customers[2])
+
+        # Skewed customers: the heaviest customer has several times the average number of events
+        self.assertGreater(chunks[0]['customer_id'].value_counts().iloc[0], 3 * 20)
+
+        # The JSON lines written from it parse back through fetch_and_transform_data
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.json')
+            for chunk in chunks:
+                write_events_json(chunk, path, mode='a')
+            result = run_suite_stage('parse', path)
+        self.assertEqual(result['rows'], 2500)
+        self.assertGreater(result['peak_rss_bytes'], 0)
+
+    def test_default_generator_is_unchanged_by_the_new_options(self):
+        df = generate_synthetic_events(1000, events_per_customer=20)
+        explicit = generate_synthetic_events(1000, events_per_customer=20, customer_skew=0.0, mean_gap=60, first_customer_id=1, first_event_id=1)
+        pd.testing.assert_frame_equal(df, explicit)
+        self.assertEqual(df['customer_id'].min(), 1)
+        self.assertEqual(sorted(df['id']), list(range(1, 1001)))
+
+
+    # Test that a copy variant runs against the null COPY stand-in and reports the peak RSS of the process
+    def test_copy_variant_reports_peak_rss(self):
+        for workers in [0, 2]:
+            with self.subTest(workers=workers):
+                result = run_copy_variant(1000, workers=workers, batch_size=300)
+                self.assertEqual(result['rows'], 1000)
+                self.assertGreater(result['peak_rss_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
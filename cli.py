@@ -0,0 +1,124 @@
+import argparse
+import sys
+
+# Each subcommand imports what it needs when it runs, so `--help` and the light subcommands
+# never import the database driver or the plotting libraries
+
+
+# Helper function to write events to CSV, or to an Arrow IPC file for any other extension
+def write_events(df, path):
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(path)
+    print(f"Wrote {len(df)} events to {path}.")
+
+
+# Helper function to load the events of --source (the remote feed by default) through the on-disk cache
+def load_source_events(args):
+    from ingestion import EVENTS_URL
+    from event_cache import load_cached_events
+    df = load_cached_events(args.source or EVENTS_URL)
+    if df is None:
+        print("No events were loaded.")
+    return df
+
+
+# Download and parse the feed through the on-disk cache
+def fetch(args):
+    df = load_source_events(args)
+    if df is None:
+        return 1
+    print(f"Loaded {len(df)} events with a customer-id and an IP address.")
+    if args.output:
+        write_events(df, args.output)
+    return 0
+
+
+# Sessionize the feed and report the number of sessions
+def sessionize(args):
+    from sessionization import sessionize_data
+    df = load_source_events(args)
+    if df is None:
+        return 1
+    sessionized_df = sessionize_data(df, args.session_timeout, args.device_merge_window)
+    sessions = sessionized_df.groupby(['customer_id', 'session_id']).ngroups
+    print(f"{len(sessionized_df)} events in {sessions} sessions of {sessionized_df['customer_id'].nunique()} customers.")
+    if args.device_merge_window is not None:
+        device_sessions = sessionized_df.groupby(['customer_id', 'device_session_id']).ngroups
+        print(f"{device_sessions} sessions when split per device and merged within {args.device_merge_window} minutes.")
+    if args.output:
+        write_events(sessionized_df, args.output)
+    return 0
+
+
+# Load the feed into the database, creating the tables first when asked to
+def load(args):
+    import db_insert
+    if args.create_tables:
+        from db_creation import create_db_table, create_session_tables
+        create_db_table()
+        create_session_tables()
+    db_insert.main(args.incremental, args.stream, args.idempotent, args.device_merge_window)
+    return 0
+
+
+# Run the session timeout analysis, with the plots only when asked for
+def analyze(args):
+    from exploratory_data_analysis import analyze_time_differences, session_timeout_analysis
+    df = load_source_events(args)
+    if df is None:
+        return 1
+    if args.plot:
+        analyze_time_differences(df)
+    session_timeout_analysis(df, args.min_timeout, args.max_timeout, plot=args.plot)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Webshop session analysis pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch_parser = subparsers.add_parser('fetch', help="Download and parse the events feed into the local cache")
+    fetch_parser.add_argument('--source', help="URL or local JSON lines file, the remote events feed by default")
+    fetch_parser.add_argument('--output', help="Also write the events to this .csv or Arrow file")
+    fetch_parser.set_defaults(run=fetch)
+
+    sessionize_parser = subparsers.add_parser('sessionize', help="Sessionize the events and report the sessions")
+    sessionize_parser.add_argument('--source', help="URL or local JSON lines file, the remote events feed by default")
+    sessionize_parser.add_argument('--session-timeout', type=int, default=8)
+    sessionize_parser.add_argument('--device-merge-window', type=float, default=None,
+                                   help="Also split sessions per device, merging device switches within this many minutes")
+    sessionize_parser.add_argument('--output', help="Also write the sessionized events to this .csv or Arrow file")
+    sessionize_parser.set_defaults(run=sessionize)
+
+    load_parser = subparsers.add_parser('load', help="Sessionize and load the events into the database")
+    load_mode = load_parser.add_mutually_exclusive_group()
+    load_mode.add_argument('--incremental', action='store_true', help="Only load events after the ingestion watermark")
+    load_mode.add_argument('--stream', action='store_true', help="Sessionize and load the feed in micro-batches while downloading it")
+    load_mode.add_argument('--idempotent', action='store_true', help="Stage the events and skip ids that are already loaded, so reruns do not fail")
+    load_parser.add_argument('--create-tables', action='store_true', help="Create the tables first if they do not exist")
+    load_parser.add_argument('--device-merge-window', type=float, default=None,
+                             help="Also store cross-device session ids, merging device switches within this many minutes")
+    load_parser.set_defaults(run=load)
+
+    analyze_parser = subparsers.add_parser('analyze', help="Session timeout analysis, optionally with plots")
+    analyze_parser.add_argument('--source', help="URL or local JSON lines file, the remote events feed by default")
+    analyze_parser.add_argument('--min-timeout', type=int, default=5)
+    analyze_parser.add_argument('--max-timeout', type=int, default=10)
+    analyze_parser.add_argument('--plot', action='store_true', help="Save the time difference and session duration plots")
+    analyze_parser.set_defaults(run=analyze)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # Incremental and streaming loads cannot store cross-device session ids
+    if args.command == 'load' and args.device_merge_window is not None and (args.incremental or args.stream):
+        parser.error("--device-merge-window cannot be combined with --incremental or --stream")
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import pandas as pd
+from cli import main
+from benchmarks import generate_synthetic_events, write_events_json, measure_import, CORE_MODULES
+
+
+class TestCli(unittest.TestCase):
+
+    # Guard against the loader, the API or the CLI importing the plotting libraries again
+    def test_core_modules_do_not_import_plotting_libraries(self):
+        for module in CORE_MODULES:
+            with self.subTest(module=module):
+                seconds, heavy = measure_import(module, repeat=1)
+                self.assertEqual(heavy, [])
+                self.assertIsNotNone(seconds)
+
+    def test_sessionize_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'events.json')
+            output = os.path.join(directory, 'sessions.csv')
+            write_events_json(generate_synthetic_events(500, events_per_customer=25), source)
+
+            with patch.dict(os.environ, {'EVENT_CACHE_DIR': os.path.join(directory, 'cache')}):
+                status = main(['sessionize', '--source', source, '--session-timeout', '8', '--output', output])
+
+            self.assertEqual(status, 0)
+            sessionized_df = pd.read_csv(output)
+            self.assertEqual(len(sessionized_df), 500)
+            self.assertIn('session_id', sessionized_df.columns)
+
+    def test_load_rejects_device_merge_window_with_incremental_or_stream(self):
+        for mode in ['--incremental', '--stream']:
+            with self.subTest(mode=mode), patch('db_insert.main') as mock_main, \
+                    patch('sys.stderr'), self.assertRaises(SystemExit):
+                main(['load', mode, '--device-merge-window', '30'])
+            mock_main.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from dotenv import load_dotenv
+from instrumentation import registry
+
+
+# Helper function to read the connection parameters from the URL behind an environment variable
+def get_connection_params(db_url_key):
+    # Load environment variables from the .env file
+    load_dotenv()
+
+    db_url = os.getenv(db_url_key)
+    url = urlparse(db_url)
+    return {
+        'dbname': url.path[1:],
+        'user': url.username,
+        'password': url.password,
+        'host': url.hostname,
+        'port': url.port
+    }
+
+
+# Thread-safe pool of psycopg2 connections with a size limit, idle eviction and health checks
+class ConnectionPool:
+
+    def __init__(self, conn_params, max_size=10, idle_timeout=300, health_check_interval=30, acquire_timeout=30):
+        self.conn_params = conn_params
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, returned_at) pairs, most recently returned last
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise psycopg2.pool.PoolError(f"No connection available within {self.acquire_timeout}s (max_size={self.max_size})")
+        try:
+            conn = self.take_idle_connection()
+            return conn if conn is not None else psycopg2.connect(**self.conn_params)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def take_idle_connection(self):
+        now = time.monotonic()
+        with self.lock:
+            # Close connections that have been idle for too long
+            expired = [conn for conn, returned_at in self.idle if now - returned_at > self.idle_timeout]
+            self.idle = [(conn, returned_at) for conn, returned_at in self.idle if now - returned_at <= self.idle_timeout]
+            entry = self.idle.pop() if self.idle else None
+        for conn in expired:
+            conn.close()
+
+        if entry is None:
+            return None
+        conn, returned_at = entry
+        if now - returned_at > self.health_check_interval and not self.is_healthy(conn):
+            conn.close()
+            return None
+        return conn
+
+    def is_healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def release(self, conn, discard=False):
+        try:
+            # Never hand out a connection that is still inside a transaction
+            if not discard and not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if discard or conn.closed or self.idle_timeout <= 0:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+# Helper function to build a pool from explicit settings or the DB_POOL_* environment variables
+def build_pool(db_url_key, max_size=None, idle_timeout=None, health_check_interval=None):
+    return ConnectionPool(
+        get_connection_params(db_url_key),
+        max_size=max_size or int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        idle_timeout=idle_timeout if idle_timeout is not None else float(os.getenv('DB_POOL_IDLE_TIMEOUT', 300)),
+        health_check_interval=health_check_interval if health_check_interval is not None else float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', 30)),
+    )
+
+
+# Function to configure the process-wide pool for a database, normally called once at startup
+def configure_pool(db_url_key='DATABASE_KEY', max_size=None, idle_timeout=None, health_check_interval=None):
+    pool = build_pool(db_url_key, max_size, idle_timeout, health_check_interval)
+    with pools_lock:
+        previous = pools.get(db_url_key)
+        pools[db_url_key] = pool
+    if previous is not None:
+        previous.close()
+    return pool
+
+
+# Function to get the pool of a database, configuring it with the defaults on first use
+def get_pool(db_url_key='DATABASE_KEY'):
+    with pools_lock:
+        if db_url_key not in pools:
+            pools[db_url_key] = build_pool(db_url_key)
+        return pools[db_url_key]
+
+
+# Context manager that borrows a pooled connection and returns it afterwards
+@contextmanager
+def connection(db_url_key='DATABASE_KEY'):
+    pool = get_pool(db_url_key)
+    start = time.perf_counter()
+    try:
+        conn = pool.acquire()
+    except Exception:
+        registry.inc('db_pool_errors_total', database=db_url_key)
+        raise
+    finally:
+        registry.observe('db_pool_wait_seconds', time.perf_counter() - start, database=db_url_key)
+    try:
+        yield conn
+    except Exception:
+        # A failed connection is dropped instead of being reused
+        pool.release(conn, discard=bool(conn.closed))
+        raise
+    except BaseException:
+        # Unwound by a closed generator (e.g. an aborted streaming response) or an interrupt: the state
+        # of the connection is unknown, drop it but always give its slot back
+        pool.release(conn, discard=True)
+        raise
+    else:
+        pool.release(conn)
+
+
+# Function to close every pooled connection, e.g. at shutdown or between tests
+def close_pools():
+    with pools_lock:
+        closing = list(pools.values())
+        pools.clear()
+    for pool in closing:
+        pool.close()
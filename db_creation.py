@@ -1,64 +1,188 @@
-import psycopg2
-from urllib.parse import urlparse
-from dotenv import load_dotenv
-import os
+import db
+import pandas as pd
 
 # Helper function to handle database connections and execute queries
 def manage_database(db_url_key, create_table_sql, drop_table_sql=None):
-    # Load environment variables from the .env file
-    load_dotenv()
-
-    # Connect to the database
-    db_url = os.getenv(db_url_key)
-    url = urlparse(db_url)
-    conn_params = {
-        'dbname': url.path[1:],   
-        'user': url.username,       
-        'password': url.password,   
-        'host': url.hostname,       
-        'port': url.port            
-    }
-
-    conn = psycopg2.connect(**conn_params)
-    print(f"Connection to {db_url_key} established successfully!")
-
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    cursor.execute(create_table_sql)
-
-    # Save changes
-    conn.commit()
-    print("Table created successfully!")
-
-    # Drop the table if necessary
-    if drop_table_sql:
-        cursor.execute(drop_table_sql)
+    # Borrow a connection from the shared pool
+    with db.connection(db_url_key) as conn:
+        print(f"Connection to {db_url_key} established successfully!")
+
+        # Create a cursor object to execute SQL queries
+        cursor = conn.cursor()
+        cursor.execute(create_table_sql)
+
+        # Save changes
         conn.commit()
-        print("Table dropped successfully!")
+        print("Table created successfully!")
 
-    # Close the cursor and connection
-    cursor.close()
-    conn.close()
+        # Drop the table if necessary
+        if drop_table_sql:
+            cursor.execute(drop_table_sql)
+            conn.commit()
+            print("Table dropped successfully!")
 
-# Function to create a database table for the JSON event data
-def create_db_table():
-    create_table_sql = """
+        # Close the cursor
+        cursor.close()
+
+EVENT_TYPES = [
+    'page_view', 'search', 'add_product_to_cart', 'remove_product_from_cart', 'sign_up_success',
+    'visit_related_product', 'visit_recently_visited_product', 'visit_personal_recommendation', 'placed_order'
+]
+
+# Resolution of the session duration rollups: durations are counted in buckets of this many seconds,
+# which the API merges into wider buckets on request
+ROLLUP_BUCKET_SECONDS = 15
+
+# Indexes matching the access paths of the loader, the metric queries and the per-customer journey,
+# which reads page and referrer from the index as well
+EVENT_INDEXES = {
+    'webshop_events_customer_journey_idx':
+        "CREATE INDEX IF NOT EXISTS webshop_events_customer_journey_idx ON webshop_events (customer_id, session_id, timestamp) INCLUDE (event_type, page, referrer);",
+}
+# Indexes replaced by one of the above under a new name, dropped from existing databases.
+# CREATE INDEX IF NOT EXISTS never changes an existing index, so a changed definition needs a new name.
+RETIRED_EVENT_INDEXES = ['webshop_events_customer_session_idx']
+ORDER_EVENT_INDEXES = {
+    'webshop_events_orders_idx':
+        "CREATE INDEX IF NOT EXISTS webshop_events_orders_idx ON webshop_events (customer_id, timestamp) WHERE event_type = 'placed_order';",
+}
+
+# Columns whose type changed since the first schema (VARCHAR customer ids, event types and IP addresses),
+# with the type and the conversion of the stored values. CREATE TABLE IF NOT EXISTS leaves an existing
+# table as it is, so these are converted in place when their type differs.
+EVENT_COLUMN_MIGRATIONS = {
+    'customer_id': ('bigint', "customer_id::BIGINT"),
+    'event_type': ('webshop_event_type', "event_type::TEXT::webshop_event_type"),
+    'ip': ('inet', "ip::TEXT::INET"),
+}
+
+
+# SQL converting the columns of an events table created by an earlier schema, a no-op on current tables
+def get_migrate_events_table_sql():
+    statements = ["ALTER TABLE webshop_events ALTER COLUMN timestamp SET NOT NULL;"]
+    for column, (column_type, conversion) in EVENT_COLUMN_MIGRATIONS.items():
+        statements.append(f"""
+        DO $$ BEGIN
+            IF (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = 'webshop_events'::regclass AND attname = '{column}') <> '{column_type}' THEN
+                ALTER TABLE webshop_events ALTER COLUMN {column} TYPE {column_type} USING {conversion};
+            END IF;
+        END $$;""")
+    return "\n".join(statements)
+
+
+# SQL for the events table: fixed-width columns first (widest alignment first) to avoid padding,
+# an enum for the event type and integer/inet types for customer ids and IP addresses
+def get_create_events_table_sql(partitioned=False, order_index=True):
+    event_types = ', '.join(f"'{event_type}'" for event_type in EVENT_TYPES)
+    # A partitioned table needs the partition key in its primary key, so the id alone is no longer unique:
+    # an id repeated with another timestamp is stored twice, and ON CONFLICT (idempotent loads) only skips
+    # repeats of the same (id, timestamp)
+    primary_key = "PRIMARY KEY (id, timestamp)" if partitioned else "PRIMARY KEY (id)"
+    partition_clause = " PARTITION BY RANGE (timestamp)" if partitioned else ""
+    indexes = {**EVENT_INDEXES, **(ORDER_EVENT_INDEXES if order_index else {})}
+    return f"""
+        DO $$ BEGIN
+            CREATE TYPE webshop_event_type AS ENUM ({event_types});
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$;
         CREATE TABLE IF NOT EXISTS webshop_events (
-            id INT PRIMARY KEY,
-            event_type VARCHAR(50),
-            timestamp TIMESTAMP,
-            customer_id VARCHAR(255),
+            timestamp TIMESTAMP NOT NULL,
+            customer_id BIGINT,
+            id INT NOT NULL,
+            session_id INT,
+            device_session_id INT,
+            event_type webshop_event_type,
+            ip INET,
             user_agent TEXT,
-            ip VARCHAR(50),
             query TEXT,
             page TEXT,
             referrer TEXT,
-            session_id INT
-        );
+            {primary_key}
+        ){partition_clause};
+        ALTER TABLE webshop_events ADD COLUMN IF NOT EXISTS device_session_id INT;
+        {chr(10).join(f"DROP INDEX IF EXISTS {index_name};" for index_name in RETIRED_EVENT_INDEXES)}
+        {get_migrate_events_table_sql()}
+        {chr(10).join(indexes.values())}
     """
+
+
+# SQL creating one partition per day between start_date and end_date plus a default partition
+def get_create_event_partitions_sql(start_date, end_date):
+    statements = []
+    for day in pd.date_range(start_date, end_date, freq='D'):
+        next_day = day + pd.Timedelta(days=1)
+        statements.append(
+            f"CREATE TABLE IF NOT EXISTS webshop_events_{day:%Y%m%d} PARTITION OF webshop_events "
+            f"FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{next_day:%Y-%m-%d}');"
+        )
+    statements.append("CREATE TABLE IF NOT EXISTS webshop_events_default PARTITION OF webshop_events DEFAULT;")
+    return "\n".join(statements)
+
+
+# Function to create a database table for the JSON event data.
+# With partitioned=True the table is range partitioned by event day between partition_start and partition_end.
+def create_db_table(partitioned=False, order_index=True, partition_start=None, partition_end=None):
+    if partitioned and (partition_start is None or partition_end is None):
+        raise ValueError("A partitioned events table needs partition_start and partition_end")
+    create_table_sql = get_create_events_table_sql(partitioned, order_index)
+    if partitioned:
+        create_table_sql += get_create_event_partitions_sql(partition_start, partition_end)
     drop_table_sql = "" # DROP TABLE IF EXISTS webshop_events; Optional table drop logic
     manage_database("DATABASE_KEY", create_table_sql, drop_table_sql)
 
 
+# Function to create the session summary tables maintained by the loader
+def create_session_tables():
+    create_table_sql = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            customer_id BIGINT,
+            session_start TIMESTAMP,
+            session_end TIMESTAMP,
+            duration_minutes DOUBLE PRECISION,
+            session_id INT,
+            event_count INT,
+            has_order BOOLEAN,
+            PRIMARY KEY (customer_id, session_id)
+        );
+        CREATE INDEX IF NOT EXISTS sessions_customer_start_idx ON sessions (customer_id, session_start) INCLUDE (duration_minutes);
+        CREATE INDEX IF NOT EXISTS sessions_customer_session_covering_idx ON sessions (customer_id, session_id)
+            INCLUDE (session_start, session_end, duration_minutes, event_count, has_order);
+        CREATE TABLE IF NOT EXISTS customer_first_orders (
+            customer_id BIGINT PRIMARY KEY,
+            first_order_time TIMESTAMP,
+            sketched BOOLEAN NOT NULL DEFAULT FALSE
+        );
+        ALTER TABLE customer_first_orders ADD COLUMN IF NOT EXISTS sketched BOOLEAN NOT NULL DEFAULT FALSE;
+        CREATE TABLE IF NOT EXISTS order_metric_sketches (
+            name TEXT PRIMARY KEY,
+            sketch JSONB NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS session_duration_rollups (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            day DATE NOT NULL,
+            bucket_seconds INT NOT NULL,
+            sessions BIGINT NOT NULL,
+            duration_minutes_sum DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (dimension, value, day, bucket_seconds)
+        );
+        CREATE TABLE IF NOT EXISTS ingestion_watermark (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            last_timestamp TIMESTAMP NOT NULL,
+            last_event_id INT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS data_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """
+    manage_database("DATABASE_KEY", create_table_sql)
+
+
 if __name__ == "__main__":
-    create_db_table()
\ No newline at end of file
+    create_db_table()
+    create_session_tables()
\ No newline at end of file
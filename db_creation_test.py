@@ -1,10 +1,15 @@
 import unittest
+import db
 from unittest.mock import patch, MagicMock
 import psycopg2
-from db_creation import create_db_table, manage_database
+from db_creation import create_db_table, create_session_tables, manage_database, get_create_events_table_sql
 
 
 class TestDBCreation(unittest.TestCase):
+
+    # Drop pooled (mocked) connections between tests
+    def tearDown(self):
+        db.close_pools()
     
     @patch('psycopg2.connect')
     def test_db_connection_success(self, mock_connect):
@@ -18,18 +23,39 @@ class TestDBCreation(unittest.TestCase):
         # Check if psycopg2.connect() was called
         mock_connect.assert_called_once()
         # Verify that the correct SQL query is executed for creating the table
-        mock_cursor.execute.assert_called_with("""CREATE TABLE IF NOT EXISTS webshop_events (
-            id INT PRIMARY KEY,
-            event_type VARCHAR(50),
-            timestamp TIMESTAMP,
-            customer_id VARCHAR(255),
-            user_agent TEXT,
-            ip VARCHAR(50),
-            query TEXT,
-            page TEXT,
-            referrer TEXT,
-            session_id INT
-        );""")
+        mock_cursor.execute.assert_called_with(get_create_events_table_sql())
+        executed_sql = mock_cursor.execute.call_args[0][0]
+        self.assertIn("CREATE TABLE IF NOT EXISTS webshop_events (", executed_sql)
+        self.assertIn("customer_id BIGINT", executed_sql)
+        self.assertIn("event_type webshop_event_type", executed_sql)
+        self.assertIn("ip INET", executed_sql)
+        self.assertIn("ON webshop_events (customer_id, session_id, timestamp)", executed_sql)
+        self.assertIn("DROP INDEX IF EXISTS webshop_events_customer_session_idx;", executed_sql)
+        # Tables created by the first schema get their VARCHAR columns converted
+        self.assertIn("ALTER COLUMN customer_id TYPE bigint USING customer_id::BIGINT", executed_sql)
+        self.assertIn("ALTER COLUMN ip TYPE inet USING ip::TEXT::INET", executed_sql)
+        self.assertIn("WHERE event_type = 'placed_order'", executed_sql)
+        self.assertNotIn("PARTITION BY", executed_sql)
+
+    @patch('psycopg2.connect')
+    def test_partitioned_table(self, mock_connect):
+        mock_cursor = mock_connect.return_value.cursor.return_value
+
+        create_db_table(partitioned=True, order_index=False, partition_start='2022-04-27', partition_end='2022-04-28')
+
+        executed_sql = mock_cursor.execute.call_args[0][0]
+        self.assertIn("PRIMARY KEY (id, timestamp)", executed_sql)
+        self.assertIn("PARTITION BY RANGE (timestamp)", executed_sql)
+        self.assertIn("webshop_events_20220427 PARTITION OF webshop_events FOR VALUES FROM ('2022-04-27') TO ('2022-04-28')", executed_sql)
+        self.assertIn("webshop_events_20220428 PARTITION OF webshop_events FOR VALUES FROM ('2022-04-28') TO ('2022-04-29')", executed_sql)
+        self.assertIn("webshop_events_default PARTITION OF webshop_events DEFAULT", executed_sql)
+        self.assertNotIn("webshop_events_orders_idx", executed_sql)
+
+    @patch('psycopg2.connect')
+    def test_partitioned_table_requires_partition_range(self, mock_connect):
+        with self.assertRaises(ValueError):
+            create_db_table(partitioned=True, partition_start='2022-04-27')
+        mock_connect.assert_not_called()
         
     @patch('psycopg2.connect')
     def test_table_drop(self, mock_connect):
@@ -44,6 +70,17 @@ class TestDBCreation(unittest.TestCase):
         # Ensure the drop table SQL was executed
         mock_cursor.execute.assert_called_with(drop_sql)
 
+    @patch('psycopg2.connect')
+    def test_create_session_tables(self, mock_connect):
+        mock_cursor = mock_connect.return_value.cursor.return_value
+
+        create_session_tables()
+
+        # Both summary tables are created in one statement batch
+        executed_sql = mock_cursor.execute.call_args[0][0]
+        self.assertIn("CREATE TABLE IF NOT EXISTS sessions", executed_sql)
+        self.assertIn("CREATE TABLE IF NOT EXISTS customer_first_orders", executed_sql)
+
     @patch('psycopg2.connect', side_effect=psycopg2.OperationalError)
     def test_db_connection_failure(self, mock_connect):
         with self.assertRaises(psycopg2.OperationalError):
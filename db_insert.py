@@ -1,68 +1,753 @@
-import requests
+import argparse
 import json
-import os
 import io
+import os
+import itertools
+import queue
+import threading
 import pandas as pd
-import psycopg2
-from urllib.parse import urlparse
-from dotenv import load_dotenv
-from exploratory_data_analysis import fetch_and_transform_data, sessionize_data
+import db
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from sessionization import sessionize_data, sessionize_incremental, sessionize_parallel, StreamingSessionizer, SESSION_COLUMNS
+from ingestion import EVENTS_URL, compact_events, expand_events, stream_event_chunks
+from event_cache import load_cached_events
+from sketches import TDigest, compression_for_rank_error
+from db_creation import ROLLUP_BUCKET_SECONDS
+from instrumentation import stage, registry
+
+COPY_COLUMNS = ['id', 'event_type', 'timestamp', 'customer_id', 'user_agent', 'ip', 'query', 'page', 'referrer', 'session_id']
+
+
+# Helper function to list the columns a sessionized frame fills, in frame order: the cross-device
+# session id follows the session id when the events were sessionized with a device merge window
+def copy_columns(dataframe):
+    return COPY_COLUMNS + (['device_session_id'] if 'device_session_id' in dataframe.columns else [])
+
+
+# Helper function to build the COPY statement for the events table
+def get_copy_sql(table_name, columns=COPY_COLUMNS):
+    return f"""
+        COPY {table_name} ({', '.join(columns)})
+        FROM stdin WITH CSV DELIMITER ',' NULL 'None' ESCAPE '\\';
+        """
+
+
+# File-like adapter that encodes a DataFrame to CSV one row batch at a time, as COPY reads it.
+# Compact frames (see ingestion.compact_events) are expanded batch by batch.
+# With prefetch > 0 a background thread encodes the next batches while the current one is sent.
+class DataFrameCSVReader:
+
+    def __init__(self, dataframe, batch_size=50_000, prefetch=0, ranges=None):
+        self.dataframe = dataframe
+        self.ranges = ranges or [(start, start + batch_size) for start in range(0, len(dataframe), batch_size)]
+        self.buffer = ''
+        self.offset = 0
+        self.batches = self.encode_batches()
+        self.closed = threading.Event()
+        if prefetch:
+            self.queue = queue.Queue(maxsize=prefetch)
+            threading.Thread(target=self.fill_queue, daemon=True).start()
+            self.batches = self.drain_queue()
+
+    def encode_batches(self):
+        for start, stop in self.ranges:
+            batch = expand_events(self.dataframe.iloc[start:stop]).to_csv(index=False, header=False)
+            registry.inc('pipeline_stage_bytes_total', len(batch), stage='copy')
+            yield batch
+
+    def fill_queue(self):
+        # A trailing None tells the reader that every batch has been encoded; an encoding error is
+        # handed over instead, so the reader raises it rather than waiting for batches forever
+        try:
+            for batch in itertools.chain(self.encode_batches(), [None]):
+                if not self.put(batch):
+                    return
+        except Exception as e:
+            self.put(e)
+
+    # Helper function to queue an item, giving up (and returning False) once the reader was closed
+    # before COPY consumed everything
+    def put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def drain_queue(self):
+        for item in iter(self.queue.get, None):
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self.closed.set()
+
+    def read(self, size=-1):
+        # Move on to the next encoded batch once the current one has been consumed
+        if self.offset >= len(self.buffer):
+            self.buffer = next(self.batches, '')
+            self.offset = 0
+
+        if size is None or size < 0:
+            data = self.buffer[self.offset:] + ''.join(self.batches)
+        else:
+            data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
 
 # Helper function to handle database connections and bulk insert using COPY
 def copy_dataframe_to_db(db_url_key, dataframe, table_name):
-    # Load environment variables from the .env file
-    load_dotenv()
-
-    # Connect to the database
-    db_url = os.getenv(db_url_key)
-    url = urlparse(db_url)
-    conn_params = {
-        'dbname': url.path[1:],    
-        'user': url.username,       
-        'password': url.password,   
-        'host': url.hostname,       
-        'port': url.port           
-    }
+    # Borrow a connection from the shared pool
+    with db.connection(db_url_key) as conn:
+        print(f"Connection to {db_url_key} established successfully!")
 
-    conn = psycopg2.connect(**conn_params)
-    print(f"Connection to {db_url_key} established successfully!")
+        # Create a cursor object to execute SQL queries
+        cursor = conn.cursor()
 
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
+        # Use an in-memory string buffer to hold CSV data
+        csv_buffer = io.StringIO()
+        # Convert the dataframe to CSV format in the buffer
+        dataframe.to_csv(csv_buffer, index=False, header=False)
+        csv_size = csv_buffer.tell()
+        csv_buffer.seek(0)  # Move the buffer cursor to the beginning
+
+        # Perform the COPY operation
+        try:
+            with stage('copy', rows=len(dataframe), nbytes=csv_size):
+                cursor.copy_expert(get_copy_sql(table_name, copy_columns(dataframe)), csv_buffer)
+                conn.commit()
+            print(f"Data copied successfully to {table_name}!")
+        except Exception as e:
+            print(f"Error copying data: {e}")
+            conn.rollback()
+        finally:
+            # Close the cursor
+            cursor.close()
 
-    # Use an in-memory string buffer to hold CSV data
-    csv_buffer = io.StringIO()
-    # Convert the dataframe to CSV format in the buffer
-    dataframe.to_csv(csv_buffer, index=False, header=False)
-    csv_buffer.seek(0)  # Move the buffer cursor to the beginning
 
-    # Perform the COPY operation
+# Helper function for one loader connection: COPY its row ranges, committing per batch or once at the end
+def copy_batches_on_connection(conn, dataframe, table_name, ranges, atomic):
+    cursor = conn.cursor()
+    rows = 0
     try:
-        copy_sql = f"""
-        COPY {table_name} (id, event_type, timestamp, customer_id, user_agent, ip, query, page, referrer, session_id)
-        FROM stdin WITH CSV DELIMITER ',' NULL 'None' ESCAPE '\\';
+        if atomic:
+            # One COPY streams every batch of this connection, committed by the caller
+            reader = DataFrameCSVReader(dataframe, prefetch=2, ranges=ranges)
+            try:
+                cursor.copy_expert(get_copy_sql(table_name, copy_columns(dataframe)), reader)
+            finally:
+                reader.close()
+            rows = sum(stop - start for start, stop in ranges)
+        else:
+            for start, stop in ranges:
+                cursor.copy_expert(get_copy_sql(table_name, copy_columns(dataframe)), DataFrameCSVReader(dataframe, ranges=[(start, stop)]))
+                conn.commit()
+                rows += stop - start
+    finally:
+        cursor.close()
+    return rows
+
+
+# Bulk insert using COPY in row batches, optionally spread over several connections.
+# atomic=True loads everything or nothing in a single transaction, so it always uses one connection:
+# commits on several connections are separate, and a failing one would leave the others' batches loaded.
+# atomic=False commits every batch on its own and can use several connections.
+def copy_dataframe_in_batches(db_url_key, dataframe, table_name, batch_size=50_000, workers=1, atomic=True):
+    ranges = [(start, min(start + batch_size, len(dataframe))) for start in range(0, len(dataframe), batch_size)]
+    if not ranges:
+        print("No rows to copy.")
+        return 0
+    if atomic:
+        workers = 1
+
+    # Never ask for more connections than there are batches or pool slots
+    workers = max(1, min(workers, len(ranges), db.get_pool(db_url_key).max_size))
+    rows = 0
+    with ExitStack() as stack:
+        # Encoded bytes are counted by DataFrameCSVReader as the batches are produced
+        record = stack.enter_context(stage('copy'))
+        connections = [stack.enter_context(db.connection(db_url_key)) for _ in range(workers)]
+
+        # Deal the batches out round-robin, one worker thread per connection
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(copy_batches_on_connection, conn, dataframe, table_name, ranges[i::workers], atomic)
+                for i, conn in enumerate(connections)
+            ]
+            errors = []
+            for future in futures:
+                try:
+                    rows += future.result()
+                except Exception as e:
+                    errors.append(e)
+
+        if errors:
+            print(f"Error copying data: {errors[0]}")
+            for conn in connections:
+                conn.rollback()
+            return 0 if atomic else rows
+
+        if atomic:
+            # Only commit once every batch has been copied
+            connections[0].commit()
+        record['rows'] = rows
+        print(f"Data copied successfully to {table_name}! ({rows} rows, {len(ranges)} batches, {workers} connections)")
+        return rows
+
+
+# SQL that moves staged events into the events table, skipping ids that are already loaded
+# (or repeated in the staging table), so reruns and overlapping feeds never fail on the primary key.
+# Returns the number of new events per customer.
+def get_merge_staged_events_sql(table_name, staging_table, columns=COPY_COLUMNS):
+    return f"""
+        WITH inserted AS (
+            INSERT INTO {table_name} ({', '.join(columns)})
+            SELECT {', '.join(columns)} FROM {staging_table}
+            ON CONFLICT DO NOTHING
+            RETURNING customer_id
+        )
+        SELECT customer_id, COUNT(*) FROM inserted GROUP BY customer_id;
+        """
+
+
+# SQL selecting the customers that had events before the merge as well as new ones, given the
+# number of new events per customer
+def get_customers_with_earlier_events_sql(table_name):
+    return f"""
+        SELECT e.customer_id
+        FROM {table_name} e
+        JOIN UNNEST(%s::BIGINT[], %s::BIGINT[]) AS a(customer_id, inserted) ON e.customer_id = a.customer_id
+        GROUP BY e.customer_id, a.inserted
+        HAVING COUNT(*) > a.inserted;
         """
-        cursor.copy_expert(copy_sql, csv_buffer)
+
+
+# Function to sessionize all stored events of the given customers again and write back the session ids
+# that changed. A feed sessionized on its own numbers every customer's sessions from 1, which clashes
+# with the sessions of the events loaded before it.
+def resessionize_customers(cursor, table_name, customer_ids, session_timeout=8, device_merge_window=None):
+    cursor.execute(f"SELECT id, customer_id, timestamp, user_agent FROM {table_name} WHERE customer_id = ANY(%s::BIGINT[]);",
+                   ([int(customer_id) for customer_id in customer_ids],))
+    events = sessionize_data(pd.DataFrame(cursor.fetchall(), columns=['id', 'customer_id', 'timestamp', 'user_agent']),
+                             session_timeout, device_merge_window)
+    if device_merge_window is None:
+        cursor.execute(f"""
+            UPDATE {table_name} e SET session_id = u.session_id
+            FROM UNNEST(%s::INT[], %s::INT[]) AS u(id, session_id)
+            WHERE e.id = u.id AND e.session_id IS DISTINCT FROM u.session_id;
+        """, (events['id'].tolist(), events['session_id'].tolist()))
+    else:
+        cursor.execute(f"""
+            UPDATE {table_name} e SET session_id = u.session_id, device_session_id = u.device_session_id
+            FROM UNNEST(%s::INT[], %s::INT[], %s::INT[]) AS u(id, session_id, device_session_id)
+            WHERE e.id = u.id AND (e.session_id IS DISTINCT FROM u.session_id OR e.device_session_id IS DISTINCT FROM u.device_session_id);
+        """, (events['id'].tolist(), events['session_id'].tolist(), events['device_session_id'].tolist()))
+    return cursor.rowcount
+
+
+# Idempotent bulk insert: COPY into a temporary staging table, then merge it into the events table in
+# the same transaction. Customers that already had events are sessionized again over all their events,
+# so the new events continue their sessions. Returns the number of new rows, or None when the load failed.
+def copy_dataframe_idempotent(db_url_key, dataframe, table_name, batch_size=50_000, session_timeout=8, device_merge_window=None):
+    staging_table = f"{table_name}_staging"
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor()
+        try:
+            with stage('copy', rows=len(dataframe)):
+                cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP;")
+                reader = DataFrameCSVReader(dataframe, batch_size, prefetch=2)
+                try:
+                    cursor.copy_expert(get_copy_sql(staging_table, copy_columns(dataframe)), reader)
+                finally:
+                    reader.close()
+                cursor.execute(get_merge_staged_events_sql(table_name, staging_table, copy_columns(dataframe)))
+                inserted_per_customer = cursor.fetchall()
+                inserted = sum(count for _, count in inserted_per_customer)
+
+                resessionized = 0
+                if inserted_per_customer:
+                    cursor.execute(get_customers_with_earlier_events_sql(table_name), (
+                        [int(customer_id) for customer_id, _ in inserted_per_customer],
+                        [int(count) for _, count in inserted_per_customer],
+                    ))
+                    customer_ids = [customer_id for customer_id, in cursor.fetchall()]
+                    if customer_ids:
+                        resessionized = resessionize_customers(cursor, table_name, customer_ids, session_timeout, device_merge_window)
+                conn.commit()
+            print(f"Data merged successfully into {table_name}! ({inserted} new rows, {len(dataframe) - inserted} already loaded, "
+                  f"{resessionized} rows renumbered to continue earlier sessions)")
+            return inserted
+        except Exception as e:
+            print(f"Error copying data: {e}")
+            conn.rollback()
+            return None
+        finally:
+            cursor.close()
+
+
+def register_event_types(db_url_key, event_types):
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor()
+        for event_type in sorted(set(event_types)):
+            cursor.execute("ALTER TYPE webshop_event_type ADD VALUE IF NOT EXISTS %s;", (event_type,))
+        # New enum values only become usable once committed
         conn.commit()
-        print(f"Data copied successfully to {table_name}!")
-    except Exception as e:
-        print(f"Error copying data: {e}")
-        conn.rollback()
+        cursor.close()
+
+
+# SQL that rebuilds the per-session summary and per-customer first order tables from webshop_events,
+# records the ingestion watermark and bumps the data version, so API caches refresh only once the new data is queryable
+def get_refresh_session_tables_sql():
+    return """
+    TRUNCATE sessions, customer_first_orders;
+    DELETE FROM order_metric_sketches;
+
+    INSERT INTO sessions (customer_id, session_id, session_start, session_end, duration_minutes, event_count, has_order)
+    SELECT
+        customer_id,
+        session_id,
+        MIN(timestamp),
+        MAX(timestamp),
+        EXTRACT(EPOCH FROM (MAX(timestamp) - MIN(timestamp))) / 60,
+        COUNT(*),
+        BOOL_OR(event_type = 'placed_order')
+    FROM webshop_events
+    GROUP BY customer_id, session_id;
+
+    INSERT INTO customer_first_orders (customer_id, first_order_time)
+    SELECT
+        customer_id,
+        MIN(timestamp)
+    FROM webshop_events
+    WHERE event_type = 'placed_order'
+    GROUP BY customer_id;
+
+    INSERT INTO ingestion_watermark (id, last_timestamp, last_event_id)
+    SELECT TRUE, timestamp, id
+    FROM webshop_events
+    ORDER BY timestamp DESC, id DESC
+    LIMIT 1
+    ON CONFLICT (id) DO UPDATE SET
+        last_timestamp = EXCLUDED.last_timestamp,
+        last_event_id = EXCLUDED.last_event_id,
+        updated_at = NOW();
+
+    INSERT INTO data_version (id, version) VALUES (TRUE, 1)
+    ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1, updated_at = NOW();
+    """
+
+
+# SQL that rebuilds the session duration rollups of every day from %(since)s on (all days when it is NULL):
+# per dimension value and day, the number of sessions and summed duration in each ROLLUP_BUCKET_SECONDS bucket.
+# A session counts once for its referrer (the first one in the session), once for every event type it
+# contains and once under 'all'; it belongs to the day it started.
+def get_refresh_duration_rollups_sql():
+    return f"""
+    DELETE FROM session_duration_rollups WHERE %(since)s::DATE IS NULL OR day >= %(since)s::DATE;
+
+    WITH rolled_sessions AS (
+        SELECT
+            customer_id,
+            session_id,
+            session_start::DATE AS day,
+            duration_minutes,
+            (FLOOR(duration_minutes * 60 / {ROLLUP_BUCKET_SECONDS}) * {ROLLUP_BUCKET_SECONDS})::INT AS bucket_seconds
+        FROM sessions
+        WHERE %(since)s::DATE IS NULL OR session_start >= %(since)s::DATE
+    ),
+    session_attributes AS (
+        SELECT
+            e.customer_id,
+            e.session_id,
+            ARRAY_AGG(DISTINCT e.event_type::TEXT) AS event_types,
+            (ARRAY_AGG(e.referrer ORDER BY e.timestamp) FILTER (WHERE NULLIF(e.referrer, '') IS NOT NULL))[1] AS referrer
+        FROM webshop_events e
+        JOIN rolled_sessions s
+            ON e.customer_id = s.customer_id AND e.session_id = s.session_id
+        GROUP BY e.customer_id, e.session_id
+    ),
+    session_dimensions AS (
+        SELECT customer_id, session_id, 'all' AS dimension, 'all' AS value FROM rolled_sessions
+        UNION ALL
+        SELECT customer_id, session_id, 'referrer', COALESCE(referrer, '(direct)') FROM session_attributes
+        UNION ALL
+        SELECT customer_id, session_id, 'event_type', UNNEST(event_types) FROM session_attributes
+    )
+    INSERT INTO session_duration_rollups (dimension, value, day, bucket_seconds, sessions, duration_minutes_sum)
+    SELECT d.dimension, d.value, s.day, s.bucket_seconds, COUNT(*), SUM(s.duration_minutes)
+    FROM rolled_sessions s
+    JOIN session_dimensions d
+        ON d.customer_id = s.customer_id AND d.session_id = s.session_id
+    GROUP BY d.dimension, d.value, s.day, s.bucket_seconds;
+    """
+
+
+# Function to rebuild the duration rollups from the day of since on, or all of them when since is None
+def refresh_duration_rollups(cursor, since=None):
+    cursor.execute(get_refresh_duration_rollups_sql(), {'since': since})
+
+
+# Function to rebuild the session summary tables (and the order metric sketches) after a load, in a single transaction
+def refresh_session_tables(db_url_key, session_timeout=8):
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(get_refresh_session_tables_sql())
+            refresh_duration_rollups(cursor)
+            update_order_metric_sketches(cursor, session_timeout)
+            conn.commit()
+            print("Session tables refreshed successfully!")
+        except Exception as e:
+            print(f"Error refreshing session tables: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+
+
+SKETCH_NAMES = ['sessions_before_order', 'session_duration_before_order']
+
+
+# SQL that finds the ordering customers whose sessions before the first order can no longer change and
+# are not in the sketches yet, with the durations of those sessions. That is the case once the session
+# covering the first order is stored and ended more than session_timeout before the ingestion watermark.
+def get_settled_first_orders_sql():
+    return """
+    WITH pending AS (
+        SELECT customer_id, first_order_time
+        FROM customer_first_orders
+        WHERE NOT sketched
+    ),
+    candidates AS (
+        SELECT
+            p.customer_id,
+            p.first_order_time,
+            s.session_start < p.first_order_time AS before_order,
+            s.session_end,
+            s.duration_minutes
+        FROM pending p
+        JOIN sessions s
+            ON s.customer_id = p.customer_id AND s.session_start <= p.first_order_time
+    ),
+    settled AS (
+        SELECT customer_id
+        FROM candidates
+        GROUP BY customer_id, first_order_time
+        HAVING MAX(session_end) >= first_order_time
+            AND MAX(session_end) < (SELECT last_timestamp FROM ingestion_watermark) - %(session_timeout)s * INTERVAL '1 minute'
+    )
+    SELECT s.customer_id, c.duration_minutes
+    FROM settled s
+    LEFT JOIN candidates c
+        ON c.customer_id = s.customer_id AND c.before_order;
+    """
+
+
+# Function to add the settled customers to the persisted t-digests of sessions before the first order
+# and of their durations, so approximate metrics never need the full sort. Each customer is added once.
+def update_order_metric_sketches(cursor, session_timeout=8):
+    cursor.execute(get_settled_first_orders_sql(), {'session_timeout': session_timeout})
+    rows = pd.DataFrame(cursor.fetchall(), columns=['customer_id', 'duration_minutes'])
+    if len(rows) == 0:
+        return 0
+
+    # Customers whose first order opened their first session have no sessions before it and are only marked
+    before_order = rows.dropna()
+    values = {
+        'sessions_before_order': before_order.groupby('customer_id').size().to_numpy(),
+        'session_duration_before_order': before_order['duration_minutes'].to_numpy(dtype=float),
+    }
+
+    cursor.execute("SELECT name, sketch FROM order_metric_sketches FOR UPDATE;")
+    stored = dict(cursor.fetchall())
+    compression = compression_for_rank_error(float(os.getenv('METRICS_SKETCH_RANK_ERROR', 0.005)))
+    for name in SKETCH_NAMES:
+        sketch = TDigest(compression).add(values[name])
+        if name in stored:
+            sketch = TDigest.from_dict(stored[name]).merge(sketch)
+        cursor.execute("""
+            INSERT INTO order_metric_sketches (name, sketch) VALUES (%s, %s)
+            ON CONFLICT (name) DO UPDATE SET sketch = EXCLUDED.sketch, updated_at = NOW();
+        """, (name, json.dumps(sketch.to_dict())))
+
+    customer_ids = [int(customer_id) for customer_id in rows['customer_id'].unique()]
+    cursor.execute("UPDATE customer_first_orders SET sketched = TRUE WHERE customer_id = ANY(%s::BIGINT[]);", (customer_ids,))
+    return len(customer_ids)
+
+
+# SQL that upserts the summary rows of the sessions touched by an incremental load, advances the
+# ingestion watermark and bumps the data version
+def get_upsert_session_tables_sql():
+    return """
+    WITH affected AS (
+        SELECT * FROM UNNEST(%(customer_ids)s::BIGINT[], %(first_session_ids)s::INT[]) AS a(customer_id, first_session_id)
+    )
+    INSERT INTO sessions (customer_id, session_id, session_start, session_end, duration_minutes, event_count, has_order)
+    SELECT
+        e.customer_id,
+        e.session_id,
+        MIN(e.timestamp),
+        MAX(e.timestamp),
+        EXTRACT(EPOCH FROM (MAX(e.timestamp) - MIN(e.timestamp))) / 60,
+        COUNT(*),
+        BOOL_OR(e.event_type = 'placed_order')
+    FROM webshop_events e
+    JOIN affected a
+        ON e.customer_id = a.customer_id AND e.session_id >= a.first_session_id
+    GROUP BY e.customer_id, e.session_id
+    ON CONFLICT (customer_id, session_id) DO UPDATE SET
+        session_start = EXCLUDED.session_start,
+        session_end = EXCLUDED.session_end,
+        duration_minutes = EXCLUDED.duration_minutes,
+        event_count = EXCLUDED.event_count,
+        has_order = EXCLUDED.has_order;
+
+    INSERT INTO customer_first_orders (customer_id, first_order_time)
+    SELECT
+        customer_id,
+        MIN(timestamp)
+    FROM webshop_events
+    WHERE event_type = 'placed_order' AND customer_id = ANY(%(customer_ids)s::BIGINT[])
+    GROUP BY customer_id
+    ON CONFLICT (customer_id) DO UPDATE SET
+        first_order_time = LEAST(customer_first_orders.first_order_time, EXCLUDED.first_order_time);
+
+    INSERT INTO ingestion_watermark (id, last_timestamp, last_event_id) VALUES (TRUE, %(last_timestamp)s, %(last_event_id)s)
+    ON CONFLICT (id) DO UPDATE SET
+        last_timestamp = EXCLUDED.last_timestamp,
+        last_event_id = EXCLUDED.last_event_id,
+        updated_at = NOW();
+
+    INSERT INTO data_version (id, version) VALUES (TRUE, 1)
+    ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1, updated_at = NOW();
+    """
+
+
+# Function to keep only the events after the (timestamp, id) watermark
+def filter_after_watermark(df, watermark):
+    if watermark is None:
+        return df
+    last_timestamp, last_event_id = watermark
+    newer = (df['timestamp'] > last_timestamp) | ((df['timestamp'] == last_timestamp) & (df['id'] > last_event_id))
+    return df[newer]
+
+
+# Helper function to read the latest session of each of the given customers
+def fetch_last_sessions(cursor, customer_ids):
+    cursor.execute("""
+        SELECT DISTINCT ON (customer_id) customer_id, session_id, session_end
+        FROM sessions
+        WHERE customer_id = ANY(%s::BIGINT[])
+        ORDER BY customer_id, session_id DESC;
+    """, ([int(customer_id) for customer_id in customer_ids],))
+    return pd.DataFrame(cursor.fetchall(), columns=['customer_id', 'session_id', 'session_end'])
+
+
+# Incremental load: only events after the watermark are sessionized and copied, continuing each
+# customer's last session when it is still within the timeout. COPY, session upserts and the new
+# watermark are committed in one transaction, so a failed run can simply be retried.
+def load_incremental(db_url_key, df, table_name='webshop_events', session_timeout=8):
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT last_timestamp, last_event_id FROM ingestion_watermark;")
+            df = filter_after_watermark(df, cursor.fetchone())
+            if len(df) == 0:
+                print("No new events after the watermark.")
+                return 0
+
+            last_sessions = fetch_last_sessions(cursor, df['customer_id'].unique())
+            sessionized_df = sessionize_incremental(df, last_sessions, session_timeout)
+
+            copy_batches_on_connection(conn, sessionized_df, table_name, [(0, len(sessionized_df))], atomic=True)
+
+            first_sessions = sessionized_df.groupby('customer_id')['session_id'].min()
+            last_event = sessionized_df.sort_values(['timestamp', 'id']).iloc[-1]
+            cursor.execute(get_upsert_session_tables_sql(), {
+                'customer_ids': [int(customer_id) for customer_id in first_sessions.index],
+                'first_session_ids': [int(session_id) for session_id in first_sessions.values],
+                'last_timestamp': last_event['timestamp'].to_pydatetime(),
+                'last_event_id': int(last_event['id']),
+            })
+
+            # Only the days of the touched sessions need new rollups
+            cursor.execute("""
+                SELECT MIN(s.session_start)
+                FROM sessions s
+                JOIN UNNEST(%s::BIGINT[], %s::INT[]) AS a(customer_id, first_session_id)
+                    ON s.customer_id = a.customer_id AND s.session_id >= a.first_session_id;
+            """, ([int(customer_id) for customer_id in first_sessions.index], [int(session_id) for session_id in first_sessions.values]))
+            refresh_duration_rollups(cursor, cursor.fetchone()[0])
+            update_order_metric_sketches(cursor, session_timeout)
+            conn.commit()
+            print(f"Incrementally loaded {len(sessionized_df)} new events into {table_name}!")
+            return len(sessionized_df)
+        except Exception as e:
+            print(f"Error loading new events: {e}")
+            conn.rollback()
+            return 0
+        finally:
+            cursor.close()
+
+
+# SQL that merges the closed sessions staged by a streaming flush into the sessions table. A session
+# that continues one already stored (loaded before the stream started) is extended instead of replaced.
+def get_merge_stream_sessions_sql():
+    return """
+    INSERT INTO sessions (customer_id, session_id, session_start, session_end, duration_minutes, event_count, has_order)
+    SELECT customer_id, session_id, session_start, session_end, duration_minutes, event_count, has_order
+    FROM stream_sessions
+    ON CONFLICT (customer_id, session_id) DO UPDATE SET
+        session_start = LEAST(sessions.session_start, EXCLUDED.session_start),
+        session_end = GREATEST(sessions.session_end, EXCLUDED.session_end),
+        duration_minutes = EXTRACT(EPOCH FROM (GREATEST(sessions.session_end, EXCLUDED.session_end) - LEAST(sessions.session_start, EXCLUDED.session_start))) / 60,
+        event_count = sessions.event_count + EXCLUDED.event_count,
+        has_order = sessions.has_order OR EXCLUDED.has_order;
+    """
+
+
+# SQL that records the first orders seen in a streaming step, first orders only ever move earlier
+def get_merge_stream_first_orders_sql():
+    return """
+    INSERT INTO customer_first_orders (customer_id, first_order_time)
+    SELECT * FROM UNNEST(%s::BIGINT[], %s::TIMESTAMP[])
+    ON CONFLICT (customer_id) DO UPDATE SET
+        first_order_time = LEAST(customer_first_orders.first_order_time, EXCLUDED.first_order_time);
+    """
+
+
+# SQL that moves the ingestion watermark to the last event of a streaming step
+def get_stream_watermark_sql():
+    return """
+    INSERT INTO ingestion_watermark (id, last_timestamp, last_event_id) VALUES (TRUE, %s, %s)
+    ON CONFLICT (id) DO UPDATE SET
+        last_timestamp = EXCLUDED.last_timestamp,
+        last_event_id = EXCLUDED.last_event_id,
+        updated_at = NOW();
+    """
+
+
+# Function to write one streaming step on a connection: the events that got their session id go through
+# the COPY loader, the closed sessions are copied into a staging table and merged into sessions.
+# The caller commits.
+def flush_stream_output(conn, events, sessions, table_name='webshop_events'):
+    cursor = conn.cursor()
+    try:
+        if len(events):
+            copy_batches_on_connection(conn, events, table_name, [(0, len(events))], atomic=True)
+            orders = events[events['type'] == 'placed_order'].groupby('customer_id')['timestamp'].min()
+            if len(orders):
+                cursor.execute(get_merge_stream_first_orders_sql(), (
+                    [int(customer_id) for customer_id in orders.index],
+                    [timestamp.to_pydatetime() for timestamp in orders],
+                ))
+
+        if len(sessions):
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS stream_sessions (LIKE sessions) ON COMMIT DELETE ROWS;")
+            csv_buffer = io.StringIO()
+            sessions[SESSION_COLUMNS].to_csv(csv_buffer, index=False, header=False)
+            csv_buffer.seek(0)
+            cursor.copy_expert(f"COPY stream_sessions ({', '.join(SESSION_COLUMNS)}) FROM stdin WITH CSV;", csv_buffer)
+            cursor.execute(get_merge_stream_sessions_sql())
+
+            # Sessions are closed roughly in time order, so usually only the latest day is rolled up again
+            cursor.execute("SELECT MIN(s.session_start) FROM sessions s JOIN stream_sessions USING (customer_id, session_id);")
+            refresh_duration_rollups(cursor, cursor.fetchone()[0])
+        return len(events), len(sessions)
     finally:
-        # Close the cursor and connection
         cursor.close()
-        conn.close()
 
 
-def main():
-    # Fetch and transform the data 
-    df = fetch_and_transform_data()
+# Streaming load: micro-batches of events (possibly allowed_lateness minutes out of order) are
+# sessionized as they arrive and every step is committed, so closed sessions are queryable right away.
+# Customers' earlier sessions are looked up in the sessions table instead of being kept in memory.
+def load_stream(db_url_key, batches, table_name='webshop_events', session_timeout=8, allowed_lateness=5):
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor()
+        sessionizer = StreamingSessionizer(session_timeout, allowed_lateness, lambda customer_ids: fetch_last_sessions(cursor, customer_ids))
+        rows = 0
+        try:
+            cursor.execute("SELECT last_timestamp, last_event_id FROM ingestion_watermark;")
+            watermark = cursor.fetchone()
+            for batch in itertools.chain(batches, [None]):
+                if batch is None:
+                    events, sessions = sessionizer.close()
+                else:
+                    register_event_types(db_url_key, batch['type'].unique())
+                    events, sessions = sessionizer.add(filter_after_watermark(batch, watermark))
+                flushed_events, flushed_sessions = flush_stream_output(conn, events, sessions, table_name)
+                if flushed_events:
+                    # Events become final in timestamp order, so the latest flushed one is the new watermark
+                    last_event = events.sort_values(['timestamp', 'id']).iloc[-1]
+                    cursor.execute(get_stream_watermark_sql(), (last_event['timestamp'].to_pydatetime(), int(last_event['id'])))
+                if flushed_events or flushed_sessions:
+                    update_order_metric_sketches(cursor, session_timeout)
+                    cursor.execute("""
+                        INSERT INTO data_version (id, version) VALUES (TRUE, 1)
+                        ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1, updated_at = NOW();
+                    """)
+                conn.commit()
+                rows += flushed_events
+            print(f"Streamed {rows} events into {table_name} ({sessionizer.late_events} late events dropped)!")
+            return rows
+        except Exception as e:
+            print(f"Error streaming events: {e}")
+            conn.rollback()
+            return rows
+        finally:
+            cursor.close()
+
+
+# With a device_merge_window (minutes, DEVICE_MERGE_WINDOW by default) a full load also stores the
+# cross-device session id of every event. Incremental and streaming loads do not support it.
+def main(incremental=False, stream=False, idempotent=False, device_merge_window=None):
+    if (incremental or stream) and device_merge_window is not None:
+        raise ValueError("A device merge window is only supported by full and idempotent loads")
+    if (incremental or stream) and os.getenv('DEVICE_MERGE_WINDOW'):
+        print("DEVICE_MERGE_WINDOW is ignored by incremental and streaming loads, cross-device session ids are left empty")
+    elif device_merge_window is None and os.getenv('DEVICE_MERGE_WINDOW'):
+        device_merge_window = float(os.getenv('DEVICE_MERGE_WINDOW'))
+    if stream:
+        # Sessionize and load the feed chunk by chunk while it is being downloaded
+        load_stream("DATABASE_KEY", stream_event_chunks(EVENTS_URL, chunk_size=10_000), "webshop_events", session_timeout=8)
+        return
+
+    # Fetch and transform the data, reusing the on-disk cache when it is fresh
+    df = load_cached_events()
 
     # Insert the df into the database
     if df is not None:
-        sessionized_df = sessionize_data(df, session_timeout=8)
-        copy_dataframe_to_db("DATABASE_KEY", sessionized_df, "webshop_events")
+        register_event_types("DATABASE_KEY", df['type'].unique())
+        if incremental:
+            load_incremental("DATABASE_KEY", df, "webshop_events", session_timeout=8)
+            return
+
+        # Keep only the compact representation in memory while sessionizing and copying
+        df = compact_events(df)
+
+        # SESSIONIZE_WORKERS > 1 shards the sessionization by customer over worker processes
+        sessionized_df = sessionize_parallel(df, session_timeout=8, workers=int(os.getenv('SESSIONIZE_WORKERS', 1)),
+                                             device_merge_window=device_merge_window)
+        if idempotent:
+            # Events that are already loaded are skipped; the summary tables are rebuilt even when nothing
+            # was new, in case an earlier run stopped between the load and the refresh
+            if copy_dataframe_idempotent("DATABASE_KEY", sessionized_df, "webshop_events", session_timeout=8, device_merge_window=device_merge_window) is not None:
+                refresh_session_tables("DATABASE_KEY", session_timeout=8)
+        elif copy_dataframe_in_batches("DATABASE_KEY", sessionized_df, "webshop_events"):
+            refresh_session_tables("DATABASE_KEY", session_timeout=8)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Load the sessionized webshop events into the database")
+    parser.add_argument('--incremental', action='store_true', help="Only load events after the ingestion watermark")
+    parser.add_argument('--stream', action='store_true', help="Sessionize and load the feed in micro-batches while downloading it")
+    parser.add_argument('--idempotent', action='store_true', help="Stage the events and skip ids that are already loaded, so reruns do not fail")
+    parser.add_argument('--device-merge-window', type=float, default=None, help="Also store cross-device session ids, merging device sessions less than this many minutes apart")
+    args = parser.parse_args()
+    if args.device_merge_window is not None and (args.incremental or args.stream):
+        parser.error("--device-merge-window cannot be combined with --incremental or --stream")
+    main(args.incremental, args.stream, args.idempotent, args.device_merge_window)
@@ -1,11 +1,20 @@
 import unittest
+import db
 from unittest.mock import patch, MagicMock
 import io
+import itertools
+import json
 import pandas as pd
-from db_insert import copy_dataframe_to_db
+from sketches import TDigest
+from ingestion import compact_events
+from db_insert import copy_dataframe_to_db, copy_dataframe_idempotent, get_merge_staged_events_sql, copy_dataframe_in_batches, DataFrameCSVReader, refresh_session_tables, get_refresh_session_tables_sql, get_settled_first_orders_sql, get_refresh_duration_rollups_sql, get_upsert_session_tables_sql, update_order_metric_sketches, filter_after_watermark, load_incremental, load_stream
 
 class TestDBInsert(unittest.TestCase):
 
+    # Drop pooled (mocked) connections between tests
+    def tearDown(self):
+        db.close_pools()
+
     @patch('psycopg2.connect')
     def test_copy_dataframe_to_db(self, mock_connect):
         mock_conn = MagicMock()
@@ -32,5 +41,205 @@ class TestDBInsert(unittest.TestCase):
         # Verify that the COPY SQL was executed
         mock_cursor.copy_expert.assert_called_once()
 
+    @patch('psycopg2.connect')
+    def test_copy_dataframe_idempotent(self, mock_connect):
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value
+        mock_connect.return_value = mock_conn
+        # One of the three events was loaded by an earlier run; its customer has no other earlier events
+        mock_cursor.fetchall.side_effect = [[(123, 2)], []]
+        df = pd.DataFrame({"id": [1, 2, 3], "type": ["page_view"] * 3, "customer_id": [123] * 3, "session_id": [1, 1, 2]})
+
+        inserted = copy_dataframe_idempotent("DATABASE_KEY", df, "webshop_events")
+
+        # COPY goes to a temporary staging table that is merged with ON CONFLICT DO NOTHING in the same transaction
+        self.assertEqual(inserted, 2)
+        self.assertIn("CREATE TEMP TABLE webshop_events_staging (LIKE webshop_events", mock_cursor.execute.call_args_list[0][0][0])
+        self.assertIn("COPY webshop_events_staging", mock_cursor.copy_expert.call_args[0][0])
+        self.assertEqual(mock_cursor.execute.call_args_list[1][0][0], get_merge_staged_events_sql("webshop_events", "webshop_events_staging"))
+        self.assertEqual(mock_cursor.execute.call_args_list[2][0][1], ([123], [2]))
+        self.assertEqual(mock_cursor.execute.call_count, 3)
+        mock_conn.commit.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_copy_dataframe_idempotent_continues_earlier_sessions(self, mock_connect):
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value
+        mock_connect.return_value = mock_conn
+        timestamps = pd.to_datetime(["2022-04-28 10:00:00", "2022-04-28 11:00:00", "2022-04-28 12:00:00"])
+        # Events 1 and 2 were loaded as sessions 1 and 2. The overlapping feed has events 2 and 3, which it
+        # numbered 1 and 2 on its own; only event 3 is new.
+        feed = pd.DataFrame({"id": [2, 3], "type": ["page_view"] * 2, "timestamp": timestamps[1:], "customer_id": [7, 7], "session_id": [1, 2]})
+        stored = [(1, 7, timestamps[0], "Mozilla"), (2, 7, timestamps[1], "Mozilla"), (3, 7, timestamps[2], "Mozilla")]
+        mock_cursor.fetchall.side_effect = [[(7, 1)], [(7,)], stored]
+
+        self.assertEqual(copy_dataframe_idempotent("DATABASE_KEY", feed, "webshop_events", session_timeout=8), 1)
+
+        # The customer's stored events are sessionized again, so event 3 gets session 3 instead of clashing with session 2
+        update_sql, (ids, session_ids) = mock_cursor.execute.call_args_list[-1][0]
+        self.assertIn("UPDATE webshop_events", update_sql)
+        self.assertEqual(dict(zip(ids, session_ids)), {1: 1, 2: 2, 3: 3})
+        mock_conn.commit.assert_called_once()
+
+    def test_csv_reader_matches_single_buffer(self):
+        df = pd.DataFrame({"id": range(10), "page": ["/home", None] * 5})
+
+        for prefetch in [0, 2]:
+            reader = DataFrameCSVReader(df, batch_size=3, prefetch=prefetch)
+            chunks = iter(lambda: reader.read(7), '')
+
+            # Reading in small pieces gives exactly the CSV of the whole frame
+            self.assertEqual(''.join(chunks), df.to_csv(index=False, header=False))
+
+    def test_csv_reader_raises_prefetch_errors(self):
+        df = pd.DataFrame({"id": range(10)})
+
+        # A batch that fails to encode in the prefetch thread fails the read instead of blocking it
+        with patch('db_insert.expand_events', side_effect=[df.iloc[:3], ValueError("bad batch")]):
+            reader = DataFrameCSVReader(df, batch_size=3, prefetch=2)
+            self.assertEqual(reader.read(8192), '0\n1\n2\n')
+            with self.assertRaisesRegex(ValueError, "bad batch"):
+                reader.read(8192)
+
+    def test_csv_reader_expands_compact_events(self):
+        df = pd.DataFrame({
+            "id": [1, 2],
+            "type": ["page_view", "placed_order"],
+            "timestamp": pd.to_datetime(["2022-04-28 10:00:00.123456", "2022-04-28 10:05:00.000001"]),
+            "customer_id": [1234, 1234],
+            "user_agent": ["Mozilla", "Mozilla"],
+            "ip": ["127.0.0.1", "200.15.173.55"],
+            "query": [None, None],
+            "page": ["/home", None],
+            "referrer": [None, None],
+            "session_id": [1, 1],
+        })
+
+        # The loader writes the same CSV for the compact representation
+        reader = DataFrameCSVReader(compact_events(df), batch_size=1)
+        self.assertEqual(''.join(iter(lambda: reader.read(8192), '')), df.to_csv(index=False, header=False))
+
+    @patch('psycopg2.connect')
+    def test_copy_in_batches_per_batch_commit(self, mock_connect):
+        connections = [MagicMock(), MagicMock()]
+        mock_connect.side_effect = connections
+        df = pd.DataFrame({"id": range(10)})
+
+        rows = copy_dataframe_in_batches("DATABASE_KEY", df, "webshop_events", batch_size=3, workers=2, atomic=False)
+
+        # Four batches dealt over two connections, each batch committed on its own
+        self.assertEqual(rows, 10)
+        self.assertEqual(connections[0].cursor.return_value.copy_expert.call_count, 2)
+        self.assertEqual(connections[1].cursor.return_value.copy_expert.call_count, 2)
+        self.assertEqual(connections[0].commit.call_count, 2)
+
+    @patch('psycopg2.connect')
+    def test_copy_in_batches_atomic_rolls_back_all(self, mock_connect):
+        connections = [MagicMock(), MagicMock()]
+        connections[0].cursor.return_value.copy_expert.side_effect = Exception("duplicate key")
+        mock_connect.side_effect = connections
+        df = pd.DataFrame({"id": range(10)})
+
+        rows = copy_dataframe_in_batches("DATABASE_KEY", df, "webshop_events", batch_size=3, workers=2, atomic=True)
+
+        # An atomic load is one transaction on one connection, so a failure leaves nothing committed
+        self.assertEqual(rows, 0)
+        self.assertEqual(mock_connect.call_count, 1)
+        connections[0].commit.assert_not_called()
+        connections[0].rollback.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_refresh_session_tables(self, mock_connect):
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value
+        mock_connect.return_value = mock_conn
+
+        refresh_session_tables("DATABASE_KEY")
+
+        # The summary tables are rebuilt in one committed statement batch, then every day's rollups and the sketches
+        self.assertEqual(mock_cursor.execute.call_args_list[0][0][0], get_refresh_session_tables_sql())
+        self.assertEqual(mock_cursor.execute.call_args_list[1][0], (get_refresh_duration_rollups_sql(), {'since': None}))
+        self.assertEqual(mock_cursor.execute.call_args_list[2][0][0], get_settled_first_orders_sql())
+        mock_conn.commit.assert_called_once()
+
+    def test_filter_after_watermark(self):
+        df = pd.DataFrame({
+            "id": [1, 2, 3, 4],
+            "timestamp": pd.to_datetime(["2022-04-28 10:00", "2022-04-28 10:05", "2022-04-28 10:05", "2022-04-28 10:06"]),
+        })
+
+        # Ties on the watermark timestamp are broken by the event id
+        newer = filter_after_watermark(df, (pd.Timestamp("2022-04-28 10:05"), 2))
+        self.assertEqual(newer['id'].tolist(), [3, 4])
+        self.assertEqual(len(filter_after_watermark(df, None)), 4)
+
+    @patch('psycopg2.connect')
+    def test_load_incremental_continues_last_session(self, mock_connect):
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value
+        mock_connect.return_value = mock_conn
+        # Watermark, then customer 7's last session (session 3, ended at 10:00), then the earliest touched session start
+        mock_cursor.fetchone.side_effect = [(pd.Timestamp("2022-04-28 10:00"), 10), (pd.Timestamp("2022-04-28 09:30"),)]
+        mock_cursor.fetchall.side_effect = [[(7, 3, pd.Timestamp("2022-04-28 10:00"))], []]
+        df = pd.DataFrame({
+            "id": [10, 11, 12], "type": ["page_view"] * 3,
+            "timestamp": pd.to_datetime(["2022-04-28 10:00", "2022-04-28 10:04", "2022-04-28 11:00"]),
+            "customer_id": [7, 7, 7],
+        })
+
+        rows = load_incremental("DATABASE_KEY", df, session_timeout=8)
+
+        # Event 10 is at the watermark, 11 reopens session 3 and 12 starts session 4
+        self.assertEqual(rows, 2)
+        mock_cursor.copy_expert.assert_called_once()
+        calls = [call[0] for call in mock_cursor.execute.call_args_list]
+        params = next(args[1] for args in calls if args[0] == get_upsert_session_tables_sql())
+        self.assertEqual((params['customer_ids'], params['first_session_ids'], params['last_event_id']), ([7], [3], 12))
+        # Only the rollups from the day of the touched sessions on are rebuilt
+        self.assertIn((get_refresh_duration_rollups_sql(), {'since': pd.Timestamp("2022-04-28 09:30")}), calls)
+        mock_conn.commit.assert_called_once()
+
+    @patch('psycopg2.connect')
+    def test_load_stream_commits_every_step(self, mock_connect):
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value
+        mock_connect.return_value = mock_conn
+        # No watermark yet and no earlier sessions, then the earliest merged session start of every step
+        mock_cursor.fetchone.side_effect = itertools.chain([None], itertools.repeat((pd.Timestamp("2022-04-28 10:00"),)))
+        mock_cursor.fetchall.return_value = []
+        df = pd.DataFrame({
+            "id": [1, 2, 3], "type": ["page_view", "placed_order", "page_view"],
+            "timestamp": pd.to_datetime(["2022-04-28 10:00", "2022-04-28 10:04", "2022-04-28 11:00"]),
+            "customer_id": [7, 7, 7],
+        })
+
+        rows = load_stream("DATABASE_KEY", [df.iloc[:2], df.iloc[2:]], session_timeout=8, allowed_lateness=0)
+
+        self.assertEqual(rows, 3)
+        copies = [call[0][0] for call in mock_cursor.copy_expert.call_args_list]
+        # Events 1-2 are final right away, event 3 closes the first session and the end of the stream the second
+        self.assertEqual(sum('webshop_events' in sql for sql in copies), 2)
+        self.assertEqual(sum('stream_sessions' in sql for sql in copies), 2)
+        # Two register_event_types commits plus one commit per step, including the final flush
+        self.assertEqual(mock_conn.commit.call_count, 5)
+
+    def test_update_order_metric_sketches(self):
+        mock_cursor = MagicMock()
+        # Settled customers with the durations of their sessions before the first order; customer 9
+        # ordered in its first session. Then the stored sketches: only the counts exist so far.
+        mock_cursor.fetchall.side_effect = [
+            [(7, 4.0), (7, 6.0), (8, 1.0), (9, None)],
+            [('sessions_before_order', TDigest().add([3]).to_dict())],
+        ]
+
+        self.assertEqual(update_order_metric_sketches(mock_cursor, session_timeout=8), 3)
+
+        saved = {call[0][1][0]: TDigest.from_dict(json.loads(call[0][1][1])) for call in mock_cursor.execute.call_args_list if 'order_metric_sketches (name' in call[0][0]}
+        self.assertEqual(saved['sessions_before_order'].count, 3)
+        self.assertEqual(saved['sessions_before_order'].quantile(0.5), 2.0)
+        self.assertEqual(saved['session_duration_before_order'].quantile(0.5), 4.0)
+        # Every settled customer is marked, so later loads do not add it again
+        self.assertEqual(mock_cursor.execute.call_args_list[-1][0][1], ([7, 8, 9],))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import db
+
+
+# Helper function to build a mocked connection that looks open and idle
+def make_connection():
+    conn = MagicMock()
+    conn.closed = 0
+    conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def tearDown(self):
+        db.close_pools()
+
+    @patch('db.psycopg2.connect')
+    def test_connection_is_reused(self, mock_connect):
+        mock_connect.side_effect = lambda **kwargs: make_connection()
+
+        with db.connection('DATABASE_KEY') as first:
+            pass
+        with db.connection('DATABASE_KEY') as second:
+            pass
+
+        # Only one handshake for two borrows
+        self.assertIs(first, second)
+        mock_connect.assert_called_once()
+
+    @patch('db.psycopg2.connect')
+    def test_max_size_limits_open_connections(self, mock_connect):
+        mock_connect.side_effect = lambda **kwargs: make_connection()
+        pool = db.ConnectionPool({}, max_size=1, acquire_timeout=0.01)
+
+        conn = pool.acquire()
+        with self.assertRaises(psycopg2.pool.PoolError):
+            pool.acquire()
+
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn)
+
+    @patch('db.psycopg2.connect')
+    def test_idle_and_unhealthy_connections_are_replaced(self, mock_connect):
+        mock_connect.side_effect = lambda **kwargs: make_connection()
+
+        # Idle longer than idle_timeout: closed and replaced
+        pool = db.ConnectionPool({}, idle_timeout=0.0001)
+        stale = pool.acquire()
+        pool.release(stale)
+        with patch('db.time.monotonic', return_value=10**9):
+            fresh = pool.acquire()
+        self.assertIsNot(fresh, stale)
+        stale.close.assert_called_once()
+
+        # Fails the health check: closed and replaced
+        pool = db.ConnectionPool({}, health_check_interval=0)
+        broken = pool.acquire()
+        broken.cursor.return_value.execute.side_effect = psycopg2.OperationalError
+        pool.release(broken)
+        self.assertIsNot(pool.acquire(), broken)
+        broken.close.assert_called_once()
+
+    @patch('db.psycopg2.connect')
+    def test_open_transaction_is_rolled_back_on_release(self, mock_connect):
+        conn = make_connection()
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        mock_connect.return_value = conn
+
+        with db.connection('DATABASE_KEY'):
+            pass
+
+        conn.rollback.assert_called_once()
+        conn.close.assert_not_called()
+
+    @patch('db.psycopg2.connect')
+    def test_interrupted_borrow_discards_connection_and_frees_slot(self, mock_connect):
+        conn = make_connection()
+        mock_connect.return_value = conn
+        pool = db.configure_pool('DATABASE_KEY', max_size=1)
+        pool.acquire_timeout = 0.01
+
+        with self.assertRaises(KeyboardInterrupt):
+            with db.connection('DATABASE_KEY'):
+                raise KeyboardInterrupt
+
+        conn.close.assert_called_once()
+        pool.release(pool.acquire())
+
+if __name__ == '__main__':
+    unittest.main()
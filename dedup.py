@@ -0,0 +1,72 @@
+import time
+import numpy as np
+from instrumentation import record_stage, registry
+
+CHUNK_BITS = 16
+CHUNK_IDS = 1 << CHUNK_BITS
+
+
+# Exact set of integer event ids stored as a bitmap of one bit per id. The bitmap is split into chunks
+# of 65536 ids (8 KiB) that are only allocated once an id in their range shows up, so dense ids cost
+# about 1.25 MB per 10 million and sparse ids only pay for the ranges they touch.
+class EventIdSet:
+
+    def __init__(self):
+        self.slots = {}  # id >> CHUNK_BITS -> row of the bitmap
+        self.bitmap = np.zeros((0, CHUNK_IDS // 8), dtype=np.uint8)
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return len(self.slots) * CHUNK_IDS // 8
+
+    def __len__(self):
+        return self.count
+
+    # Helper function to map chunk numbers to bitmap rows, allocating rows (doubling the capacity) for new chunks
+    def rows_for(self, highs):
+        rows = np.empty(len(highs), dtype=np.int64)
+        for i, high in enumerate(highs.tolist()):
+            row = self.slots.get(high)
+            if row is None:
+                row = self.slots[high] = len(self.slots)
+                if row == len(self.bitmap):
+                    grown = np.zeros((max(1, 2 * len(self.bitmap)), CHUNK_IDS // 8), dtype=np.uint8)
+                    grown[:len(self.bitmap)] = self.bitmap
+                    self.bitmap = grown
+            rows[i] = row
+        return rows
+
+    # Function to add a batch of ids and return the mask of the rows to keep: ids never seen before,
+    # and only the first row of an id repeated within the batch
+    def add_new(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        keep = np.zeros(len(ids), dtype=bool)
+        unique_ids, first_rows = np.unique(ids, return_index=True)
+        chunks, chunk_of_id = np.unique(unique_ids >> CHUNK_BITS, return_inverse=True)
+        lows = unique_ids & (CHUNK_IDS - 1)
+
+        # Byte offset and bit of every id in the flattened bitmap
+        positions = self.rows_for(chunks)[chunk_of_id] * (CHUNK_IDS // 8) + (lows >> 3)
+        bits = np.left_shift(1, lows & 7).astype(np.uint8)
+        flat = self.bitmap.reshape(-1)
+        new = (flat[positions] & bits) == 0
+        # Several ids can share a byte, so the bits are set unbuffered
+        np.bitwise_or.at(flat, positions[new], bits[new])
+
+        keep[first_rows[new]] = True
+        self.count += int(new.sum())
+        return keep
+
+
+# Function to drop events whose id was already seen, in this chunk or an earlier one
+def deduplicate_events(df, id_set):
+    start = time.perf_counter()
+    keep = id_set.add_new(df['id'].to_numpy())
+    duplicates = len(df) - int(keep.sum())
+    record_stage('dedup', time.perf_counter() - start, int(keep.sum()))
+    if duplicates:
+        registry.inc('pipeline_duplicate_events_total', duplicates)
+        print(f"Dropped {duplicates} duplicate events.")
+        df = df[keep].reset_index(drop=True)
+    return df
@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+import pandas as pd
+from dedup import EventIdSet, deduplicate_events
+
+
+class TestDedup(unittest.TestCase):
+
+    def test_ids_are_kept_once_across_and_within_batches(self):
+        id_set = EventIdSet()
+
+        first = id_set.add_new([5, 3, 5, 70000, 3, 1 << 40])
+        second = id_set.add_new([3, 4, 1 << 40, 70001])
+
+        self.assertEqual(first.tolist(), [True, True, False, True, False, True])
+        self.assertEqual(second.tolist(), [False, True, False, True])
+        self.assertEqual(len(id_set), 6)
+        # Only the three 65536-id ranges that were touched are allocated
+        self.assertEqual(id_set.nbytes, 3 * 8192)
+
+    def test_matches_an_exact_set_on_random_ids(self):
+        rng = np.random.default_rng(7)
+        id_set = EventIdSet()
+        seen = set()
+        for _ in range(5):
+            ids = rng.integers(0, 300_000, size=20_000)
+            expected = []
+            for event_id in ids.tolist():
+                expected.append(event_id not in seen)
+                seen.add(event_id)
+            self.assertEqual(id_set.add_new(ids).tolist(), expected)
+        self.assertEqual(len(id_set), len(seen))
+
+    def test_deduplicate_events_keeps_the_first_row(self):
+        id_set = EventIdSet()
+        df = pd.DataFrame({'id': [1, 2, 1], 'type': ['page_view', 'search', 'placed_order']})
+
+        deduplicated = deduplicate_events(df, id_set)
+        again = deduplicate_events(pd.DataFrame({'id': [2, 3], 'type': ['search', 'search']}), id_set)
+
+        self.assertEqual(deduplicated['type'].tolist(), ['page_view', 'search'])
+        self.assertEqual(again['id'].tolist(), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
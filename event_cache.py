@@ -0,0 +1,146 @@
+import hashlib
+import os
+import tempfile
+import time
+import requests
+from ingestion import EVENTS_URL, load_events
+
+# Arrow is optional: without it the cache is disabled and every run parses the feed again
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+
+# Version of what load_events returns (columns, dtypes, filtering, deduplication). It is part of every
+# cache key, so bump it whenever the parse pipeline changes and entries written before are not served.
+CACHE_FORMAT_VERSION = 3
+
+
+# On-disk cache of parsed, filtered events stored as uncompressed Arrow IPC files, so a hit skips the
+# download and the JSON parsing and only converts the columns back into a DataFrame.
+# Entries are keyed by the cache format version, the source URL and its ETag (or a content hash
+# when there is no ETag) and evicted least recently used first once the cache grows beyond max_bytes.
+class EventCache:
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or os.getenv('EVENT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'webshop-event-cache'))
+        self.max_bytes = max_bytes or int(os.getenv('EVENT_CACHE_MAX_BYTES', 2 * 1024**3))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.arrow")
+
+    # Helper function to hash a file's content in blocks
+    def hash_file(self, path, source):
+        digest = hashlib.sha256(f"{CACHE_FORMAT_VERSION}|{source}".encode())
+        with open(path, 'rb') as events_file:
+            for block in iter(lambda: events_file.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def etag_key(self, source, etag):
+        return hashlib.sha256(f"{CACHE_FORMAT_VERSION}|{source}|{etag}".encode()).hexdigest()
+
+    # Helper function to ask the server for the ETag without downloading; None when it has none or the request fails
+    def head_etag(self, source):
+        try:
+            response = requests.head(source, allow_redirects=True)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Could not check {source} for changes ({e}), downloading it.")
+            return None
+        return response.headers.get('ETag')
+
+    # Function to resolve a source to a cache key and a local file to parse on a miss.
+    # A URL whose ETag is already cached is served without downloading; otherwise the body is downloaded
+    # once and keyed by the ETag of that download, or by its hash when it has no ETag. None when the
+    # download fails.
+    def resolve(self, source):
+        if not source.startswith(('http://', 'https://')):
+            return self.hash_file(source, source), source, False
+
+        etag = self.head_etag(source)
+        if etag and os.path.exists(self.path_for(self.etag_key(source, etag))):
+            return self.etag_key(source, etag), source, False
+
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.json', delete=False) as download:
+            try:
+                with requests.get(source, stream=True) as response:
+                    response.raise_for_status()
+                    etag = response.headers.get('ETag')
+                    for block in response.iter_content(1024 * 1024):
+                        download.write(block)
+            except requests.RequestException as e:
+                print(f"Failed to fetch data: {e}")
+                download.close()
+                os.remove(download.name)
+                return None
+        key = self.etag_key(source, etag) if etag else self.hash_file(download.name, source)
+        return key, download.name, True
+
+    def read(self, key):
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return None
+        # Mark the entry as recently used for eviction
+        os.utime(path)
+        # The file is memory-mapped, to_pandas copies the columns into the DataFrame
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    def write(self, key, df):
+        # Write to a temporary name first so readers never see a partial file
+        path = self.path_for(key)
+        partial = f"{path}.{os.getpid()}.partial"
+        feather.write_feather(df, partial, compression='uncompressed')
+        os.replace(partial, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.arrow'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+        # Drop the least recently used entries until the cache fits, always keeping the newest one
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def load(self, source=EVENTS_URL, loader=load_events):
+        resolved = self.resolve(source)
+        if resolved is None:
+            return None
+        key, local_source, temporary = resolved
+        try:
+            df = self.read(key)
+            if df is not None:
+                print(f"Loaded {len(df)} events from the cache ({key[:12]}).")
+                return df
+
+            start = time.perf_counter()
+            df = loader(local_source)
+            print(f"Parsed {len(df)} events in {time.perf_counter() - start:.1f}s, caching them ({key[:12]}).")
+            if len(df):
+                self.write(key, df)
+            return df
+        finally:
+            if temporary:
+                os.remove(local_source)
+
+
+# Function to load the events of a source through the cache when Arrow is installed
+def load_cached_events(source=EVENTS_URL):
+    if pa is None:
+        print("pyarrow is not installed, the event cache is disabled.")
+        df = load_events(source)
+    else:
+        df = EventCache().load(source)
+
+    # Same contract as fetch_and_transform_data: None when nothing could be loaded
+    return df if df is not None and len(df) else None
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import requests
+import event_cache
+from event_cache import EventCache
+from benchmarks import generate_synthetic_events
+
+
+@unittest.skipIf(event_cache.pa is None, "pyarrow is not installed")
+class TestEventCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.events_path = os.path.join(self.directory.name, 'events.json')
+        with open(self.events_path, 'w') as events_file:
+            events_file.write('{"id": 1}\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_second_load_is_served_from_cache(self):
+        cache = EventCache(os.path.join(self.directory.name, 'cache'))
+        loader = MagicMock(return_value=generate_synthetic_events(500))
+
+        first = cache.load(self.events_path, loader=loader)
+        second = cache.load(self.events_path, loader=loader)
+
+        # Parsed once, then read back from the Arrow file with the same content
+        loader.assert_called_once_with(self.events_path)
+        self.assertEqual(second['id'].tolist(), first['id'].tolist())
+        self.assertTrue((second['timestamp'] == first['timestamp']).all())
+
+        # A changed file has a different content hash and is parsed again
+        with open(self.events_path, 'a') as events_file:
+            events_file.write('{"id": 2}\n')
+        cache.load(self.events_path, loader=loader)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_url_is_keyed_by_the_downloaded_etag_and_format_version(self):
+        cache = EventCache(os.path.join(self.directory.name, 'cache'))
+        loader = MagicMock(return_value=generate_synthetic_events(500))
+        download = MagicMock(headers={'ETag': '"v2"'})
+        download.__enter__.return_value = download
+        download.iter_content.return_value = [b'{"id": 1}\n']
+        url = 'https://example.com/events.json'
+
+        # HEAD fails: the feed is downloaded and cached under the ETag of the download
+        with patch('event_cache.requests.head', side_effect=requests.ConnectionError("timed out")), \
+                patch('event_cache.requests.get', return_value=download):
+            cache.load(url, loader=loader)
+        self.assertTrue(os.path.exists(cache.path_for(cache.etag_key(url, '"v2"'))))
+
+        # The same ETag on HEAD is served from the cache without downloading
+        with patch('event_cache.requests.head', return_value=MagicMock(headers={'ETag': '"v2"'})), \
+                patch('event_cache.requests.get') as mock_get:
+            cache.load(url, loader=loader)
+        mock_get.assert_not_called()
+        loader.assert_called_once()
+
+        # Entries written by an older parse pipeline are not served
+        with patch('event_cache.CACHE_FORMAT_VERSION', event_cache.CACHE_FORMAT_VERSION + 1):
+            self.assertIsNone(cache.read(cache.etag_key(url, '"v2"')))
+
+    # Test that a failing download is reported and loads nothing, like the loader without the cache
+    def test_failed_download_returns_none(self):
+        cache = EventCache(os.path.join(self.directory.name, 'cache'))
+        loader = MagicMock()
+        download = MagicMock()
+        download.__enter__.return_value = download
+        download.raise_for_status.side_effect = requests.HTTPError("503 Server Error")
+
+        with patch('event_cache.requests.head', return_value=MagicMock(headers={})), \
+                patch('event_cache.requests.get', return_value=download), \
+                patch('event_cache.EventCache', return_value=cache):
+            self.assertIsNone(cache.load('https://example.com/events.json', loader=loader))
+            self.assertIsNone(event_cache.load_cached_events('https://example.com/events.json'))
+
+        loader.assert_not_called()
+        self.assertEqual([name for name in os.listdir(cache.directory) if name.endswith('.json')], [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = EventCache(os.path.join(self.directory.name, 'cache'), max_bytes=1)
+        df = generate_synthetic_events(500)
+
+        cache.write('old', df)
+        os.utime(cache.path_for('old'), (0, 0))
+        cache.write('new', df)
+
+        # Only the newest entry is kept, even though it alone exceeds max_bytes
+        self.assertFalse(os.path.exists(cache.path_for('old')))
+        self.assertIsNone(cache.read('old'))
+        self.assertEqual(len(cache.read('new')), len(df))
+
+if __name__ == '__main__':
+    unittest.main()
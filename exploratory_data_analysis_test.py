@@ -1,11 +1,12 @@
 import unittest
 from unittest.mock import patch
-from exploratory_data_analysis import fetch_and_transform_data, sessionize_data
+from ingestion import fetch_and_transform_data
+from sessionization import sessionize_data
 import pandas as pd
 
 class TestExploratoryDataAnalysis(unittest.TestCase):
     
-    @patch('exploratory_data_analysis.requests.get')
+    @patch('ingestion.requests.get')
     def test_fetch_data(self, mock_get):
         # Mock the response to return status code 200 and valid json data
         mock_get.return_value.status_code = 200
@@ -0,0 +1,178 @@
+import csv
+import io
+import json
+import os
+import uuid
+import db
+from instrumentation import stage
+
+# Arrow IPC output is optional
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Rows fetched from the server-side cursor per round trip, and encoded into one response chunk
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', 10_000))
+
+# Columns of every exportable dataset with their SQL expression and Arrow type name, plus the table,
+# the timestamp the time range applies to and the order rows are streamed in (the primary key or index order)
+EXPORT_DATASETS = {
+    'events': {
+        'columns': [
+            ('id', 'id', 'int64'),
+            ('event_type', 'event_type::TEXT', 'string'),
+            ('timestamp', 'timestamp', 'timestamp'),
+            ('customer_id', 'customer_id', 'int64'),
+            ('session_id', 'session_id', 'int32'),
+            ('device_session_id', 'device_session_id', 'int32'),
+            ('user_agent', 'user_agent', 'string'),
+            ('ip', 'host(ip)', 'string'),
+            ('query', "NULLIF(query, '')", 'string'),
+            ('page', "NULLIF(page, '')", 'string'),
+            ('referrer', "NULLIF(referrer, '')", 'string'),
+        ],
+        'table': 'webshop_events',
+        'time_column': 'timestamp',
+        'order_by': 'customer_id, session_id, timestamp',
+    },
+    'sessions': {
+        'columns': [
+            ('customer_id', 'customer_id', 'int64'),
+            ('session_id', 'session_id', 'int32'),
+            ('session_start', 'session_start', 'timestamp'),
+            ('session_end', 'session_end', 'timestamp'),
+            ('duration_minutes', 'duration_minutes', 'float64'),
+            ('event_count', 'event_count', 'int32'),
+            ('has_order', 'has_order', 'bool'),
+        ],
+        'table': 'sessions',
+        'time_column': 'session_start',
+        'order_by': 'customer_id, session_id',
+    },
+}
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+# SQL query selecting a dataset within the optional [start, end) time range
+def get_export_query(dataset):
+    spec = EXPORT_DATASETS[dataset]
+    columns = ', '.join(f"{expression} AS {name}" for name, expression, _ in spec['columns'])
+    return f"""
+    SELECT {columns}
+    FROM {spec['table']}
+    WHERE (%(start)s::TIMESTAMP IS NULL OR {spec['time_column']} >= %(start)s::TIMESTAMP)
+        AND (%(end)s::TIMESTAMP IS NULL OR {spec['time_column']} < %(end)s::TIMESTAMP)
+    ORDER BY {spec['order_by']};
+    """
+
+
+# CSV encoder: a header, then one block of lines per batch
+class CSVEncoder:
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def header(self):
+        return self.encode([self.columns])
+
+    def encode(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+        return buffer.getvalue().encode()
+
+    def footer(self):
+        return b''
+
+
+# Newline-delimited JSON encoder: one object per row, timestamps in ISO 8601
+class NDJSONEncoder:
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def header(self):
+        return b''
+
+    def encode(self, rows):
+        return ''.join(json.dumps(dict(zip(self.columns, row)), default=lambda value: value.isoformat()) + '\n' for row in rows).encode()
+
+    def footer(self):
+        return b''
+
+
+# Arrow IPC stream encoder: the schema first, then one record batch per batch of rows, then the end marker
+class ArrowEncoder:
+
+    def __init__(self, columns, types):
+        self.schema = pa.schema([(name, pa.timestamp('us') if type_name == 'timestamp' else pa.type_for_alias(type_name))
+                                 for name, type_name in zip(columns, types)])
+        self.sink = io.BytesIO()
+        self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    # Helper function to hand over what the writer produced so far
+    def take(self):
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def header(self):
+        return self.take()
+
+    def encode(self, rows):
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        return self.take()
+
+    def footer(self):
+        self.writer.close()
+        return self.take()
+
+
+def build_encoder(dataset, export_format):
+    columns = [name for name, _, _ in EXPORT_DATASETS[dataset]['columns']]
+    if export_format == 'csv':
+        return CSVEncoder(columns)
+    if export_format == 'ndjson':
+        return NDJSONEncoder(columns)
+    if pa is None:
+        raise ImportError("pyarrow is required for the arrow export format")
+    return ArrowEncoder(columns, [type_name for _, _, type_name in EXPORT_DATASETS[dataset]['columns']])
+
+
+# Generator streaming a dataset as encoded chunks through a server-side (named) cursor, so only one
+# batch of rows is in memory at a time. It holds a pooled connection until it is exhausted or closed.
+def stream_export(dataset, export_format, start=None, end=None, batch_rows=None, db_url_key='DATABASE_KEY'):
+    batch_rows = batch_rows or EXPORT_BATCH_ROWS
+    encoder = build_encoder(dataset, export_format)
+    with db.connection(db_url_key) as conn:
+        cursor = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+        cursor.itersize = batch_rows
+        try:
+            with stage('export') as record:
+                cursor.execute(get_export_query(dataset), {'start': start, 'end': end})
+                record['rows'] = record['bytes'] = 0
+                chunk = encoder.header()
+                yield chunk
+                record['bytes'] += len(chunk)
+                while True:
+                    rows = cursor.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    chunk = encoder.encode(rows)
+                    yield chunk
+                    record['rows'] += len(rows)
+                    record['bytes'] += len(chunk)
+                chunk = encoder.footer()
+                yield chunk
+                record['bytes'] += len(chunk)
+        finally:
+            cursor.close()
+            # The export only reads, end its transaction before the connection goes back to the pool
+            conn.rollback()
@@ -0,0 +1,103 @@
+import io
+import json
+import unittest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+import pandas as pd
+import pyarrow as pa
+import db
+from app import app
+from export import stream_export
+
+SESSION_ROWS = [
+    (1, 1, datetime(2022, 4, 20, 10, 0), datetime(2022, 4, 20, 10, 5), 5.0, 3, False),
+    (1, 2, datetime(2022, 4, 20, 12, 0), datetime(2022, 4, 20, 12, 1), 1.0, 2, True),
+    (2, 1, datetime(2022, 4, 21, 9, 0), datetime(2022, 4, 21, 9, 0), 0.0, 1, False),
+]
+
+
+class TestExport(unittest.TestCase):
+
+    def tearDown(self):
+        db.close_pools()
+
+    # Helper function to mock a connection whose named cursor returns the rows in batches
+    def mock_connection(self, mock_connect, rows, batch_rows):
+        mock_conn = MagicMock()
+        mock_cursor = mock_conn.cursor.return_value
+        mock_cursor.fetchmany.side_effect = [rows[i:i + batch_rows] for i in range(0, len(rows), batch_rows)] + [[]]
+        mock_connect.return_value = mock_conn
+        return mock_conn, mock_cursor
+
+    @patch('psycopg2.connect')
+    def test_stream_export_formats_round_trip(self, mock_connect):
+        for export_format in ['csv', 'ndjson', 'arrow']:
+            mock_conn, mock_cursor = self.mock_connection(mock_connect, SESSION_ROWS, batch_rows=2)
+            chunks = list(stream_export('sessions', export_format, start=datetime(2022, 4, 20), batch_rows=2))
+            data = b''.join(chunks)
+
+            # One server-side cursor, read in batches, with the time range as parameters
+            self.assertTrue(mock_conn.cursor.call_args.kwargs['name'].startswith('export_'))
+            self.assertEqual(mock_cursor.fetchmany.call_count, 3)
+            self.assertEqual(mock_cursor.execute.call_args.args[1], {'start': datetime(2022, 4, 20), 'end': None})
+            mock_cursor.close.assert_called_once()
+
+            if export_format == 'csv':
+                df = pd.read_csv(io.BytesIO(data), parse_dates=['session_start', 'session_end'])
+            elif export_format == 'ndjson':
+                df = pd.DataFrame([json.loads(line) for line in data.splitlines()])
+                df['session_start'] = pd.to_datetime(df['session_start'])
+            else:
+                df = pa.ipc.open_stream(data).read_all().to_pandas()
+            self.assertEqual(len(df), 3, export_format)
+            self.assertEqual(df['session_id'].tolist(), [1, 2, 1])
+            self.assertEqual(df['has_order'].tolist(), [False, True, False])
+            self.assertEqual(df['session_start'].iloc[1], pd.Timestamp('2022-04-20 12:00'))
+
+    @patch('psycopg2.connect')
+    def test_export_endpoint(self, mock_connect):
+        client = app.test_client()
+        mock_conn, mock_cursor = self.mock_connection(mock_connect, SESSION_ROWS, batch_rows=10)
+
+        response = client.get('/export/sessions?format=ndjson&start=2022-04-20&end=2022-04-21T00:00')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        self.assertEqual(len(response.data.splitlines()), 3)
+        self.assertEqual(mock_cursor.execute.call_args.args[1], {'start': datetime(2022, 4, 20), 'end': datetime(2022, 4, 21)})
+
+        # Bad parameters are rejected before touching the database
+        mock_connect.reset_mock()
+        self.assertEqual(client.get('/export/orders').status_code, 400)
+        self.assertEqual(client.get('/export/events?format=xml').status_code, 400)
+        self.assertEqual(client.get('/export/events?start=yesterday').status_code, 400)
+        mock_connect.assert_not_called()
+
+        # Query errors surface as an error status instead of a truncated body
+        db.close_pools()
+        mock_connect.return_value.cursor.return_value.execute.side_effect = Exception("relation does not exist")
+        response = client.get('/export/events')
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("relation does not exist", response.json['error'])
+
+
+    # Test that an export closed partway, e.g. by a disconnecting client, gives its pooled connection back
+    @patch('psycopg2.connect')
+    def test_closed_export_returns_pool_slot(self, mock_connect):
+        self.mock_connection(mock_connect, SESSION_ROWS, batch_rows=1)
+        pool = db.configure_pool('DATABASE_KEY', max_size=1)
+        pool.acquire_timeout = 0.01
+
+        chunks = stream_export('sessions', 'csv', batch_rows=1)
+        next(chunks)
+        next(chunks)
+        chunks.close()
+        pool.release(pool.acquire())
+
+        response = app.test_client().get('/export/sessions', buffered=False)
+        self.assertTrue(next(response.response).startswith(b'customer_id,session_id'))
+        response.close()
+        pool.release(pool.acquire())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,301 @@
+import io
+import json
+import os
+import time
+import requests
+import numpy as np
+import pandas as pd
+from instrumentation import stage, record_stage, registry
+from dedup import EventIdSet, deduplicate_events
+
+# Faster JSON decoders are optional, the stdlib parser is always available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json as pa_json
+except ImportError:
+    pa = None
+
+EVENTS_URL = 'https://storage.googleapis.com/xcc-de-assessment/events.json'
+EVENT_COLUMNS = ['id', 'type', 'timestamp', 'customer_id', 'user_agent', 'ip', 'query', 'page', 'referrer']
+
+# Where each column lives in a raw event: top level fields and fields of the nested "event" object
+EVENT_FIELDS = {
+    'id': (None, 'id'),
+    'type': (None, 'type'),
+    'timestamp': ('event', 'timestamp'),
+    'customer_id': ('event', 'customer-id'),
+    'user_agent': ('event', 'user-agent'),
+    'ip': ('event', 'ip'),
+    'query': ('event', 'query'),
+    'page': ('event', 'page'),
+    'referrer': ('event', 'referrer'),
+}
+
+
+# Function to iterate over the raw JSON lines of an HTTP(S) URL or a local file without loading it whole
+def iter_event_lines(source=EVENTS_URL):
+    if source.startswith(('http://', 'https://')):
+        with requests.get(source, stream=True) as response:
+            # Check if the request was successful
+            if response.status_code != 200:
+                print(f"Failed to fetch data. Status code: {response.status_code}")
+                return
+            yield from response.iter_lines()
+    else:
+        with open(source, 'rb') as events_file:
+            yield from events_file
+
+
+# Function to turn the column buffers into a DataFrame chunk
+def build_event_chunk(columns):
+    chunk = pd.DataFrame(columns, columns=EVENT_COLUMNS)
+
+    # Convert the timestamp to pandas datetime format
+    chunk['timestamp'] = pd.to_datetime(chunk['timestamp'])
+
+    # Text columns get the string dtype even when a chunk holds only nulls, so every backend and chunk agrees
+    for column in ['type', 'user_agent', 'ip', 'query', 'page', 'referrer']:
+        chunk[column] = chunk[column].astype('str')
+    return chunk
+
+
+# Parser backend that decodes one line at a time with the given loads function into column buffers.
+# Malformed lines are reported and skipped; only events with a customer-id and an IP address are kept.
+def parse_event_lines(lines, loads=json.loads):
+    columns = {column: [] for column in EVENT_COLUMNS}
+
+    for line in lines:
+        try:
+            event = loads(line)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON: {e}")
+            continue
+
+        data = event['event']
+        if data.get('customer-id') is None or data.get('ip') is None:
+            continue
+
+        columns['id'].append(event['id'])
+        columns['type'].append(event['type'])
+        columns['timestamp'].append(data['timestamp'])
+        columns['customer_id'].append(data['customer-id'])
+        columns['user_agent'].append(data['user-agent'])
+        columns['ip'].append(data['ip'])
+        columns['query'].append(data.get('query', None))
+        columns['page'].append(data.get('page', None))
+        columns['referrer'].append(data.get('referrer', None))
+    return columns
+
+
+# Parser backend using orjson, which decodes straight from bytes
+def parse_event_lines_orjson(lines):
+    return parse_event_lines(lines, loads=orjson.loads)
+
+
+# Helper function to build the Arrow schema of the persisted fields; everything else is ignored while decoding
+def get_event_arrow_schema():
+    event_fields = [(field, pa.int64() if column == 'customer_id' else pa.string())
+                    for column, (parent, field) in EVENT_FIELDS.items() if parent == 'event']
+    return pa.schema([('id', pa.int64()), ('type', pa.string()), ('event', pa.struct(event_fields))])
+
+
+# Parser backend that decodes a whole block of lines at once with the pyarrow JSON reader.
+# A block containing a malformed line is handed to the line-by-line parser so errors are reported the same way;
+# so is one with a blank line, which the Arrow reader would skip without a word.
+def parse_event_lines_arrow(lines):
+    if not all(line.strip() for line in lines):
+        return parse_event_lines(lines, loads=orjson.loads if orjson is not None else json.loads)
+    block = b''.join(line if line.endswith(b'\n') else line + b'\n' for line in lines)
+    try:
+        table = pa_json.read_json(
+            io.BytesIO(block),
+            read_options=pa_json.ReadOptions(block_size=max(len(block), 1 << 20)),
+            parse_options=pa_json.ParseOptions(explicit_schema=get_event_arrow_schema(), unexpected_field_behavior='ignore'),
+        )
+    except pa.ArrowInvalid:
+        return parse_event_lines(lines, loads=orjson.loads if orjson is not None else json.loads)
+
+    event = table.column('event').combine_chunks()
+    keep = pc.and_(pc.is_valid(event.field('customer-id')), pc.is_valid(event.field('ip')))
+    columns = {}
+    for column, (parent, field) in EVENT_FIELDS.items():
+        values = table.column(field) if parent is None else event.field(field)
+        columns[column] = values.filter(keep).to_pandas()
+    return columns
+
+
+PARSERS = {
+    'pyarrow': parse_event_lines_arrow,
+    'orjson': parse_event_lines_orjson,
+    'json': parse_event_lines,
+}
+
+
+# Function to pick a parser backend by name, or from EVENT_PARSER / the fastest installed one
+def get_event_parser(name=None):
+    name = name or os.getenv('EVENT_PARSER')
+    if name is None:
+        name = 'pyarrow' if pa is not None else 'orjson' if orjson is not None else 'json'
+    if name == 'pyarrow' and pa is None or name == 'orjson' and orjson is None:
+        raise ImportError(f"The {name} parser backend is not installed")
+    return PARSERS[name]
+
+
+# Helper function to iterate over a source in blocks of lines, recording the time spent reading each block
+def iter_line_blocks(source, block_lines):
+    block = []
+    nbytes = 0
+    start = time.perf_counter()
+    for line in iter_event_lines(source):
+        block.append(line)
+        nbytes += len(line)
+        if len(block) == block_lines:
+            record_stage('fetch', time.perf_counter() - start, len(block), nbytes)
+            yield block
+            block = []
+            nbytes = 0
+            start = time.perf_counter()
+    if block:
+        record_stage('fetch', time.perf_counter() - start, len(block), nbytes)
+        yield block
+
+
+# Function to stream filtered events as fixed-size columnar DataFrame chunks. With deduplicate, an
+# event whose id was already streamed is dropped before it reaches sessionization or the loader.
+def stream_event_chunks(source=EVENTS_URL, chunk_size=100_000, parser=None, deduplicate=True):
+    parse = get_event_parser(parser)
+    id_set = EventIdSet() if deduplicate else None
+    pending = []
+    rows = 0
+
+    for lines in iter_line_blocks(source, chunk_size):
+        # Parsing includes the customer-id and IP address filter
+        with stage('parse', rows=len(lines)):
+            columns = parse(lines)
+        registry.inc('pipeline_rows_dropped_total', len(lines) - len(columns['id']))
+        if not len(columns['id']):
+            continue
+        chunk = build_event_chunk(columns)
+        if id_set is not None:
+            chunk = deduplicate_events(chunk, id_set)
+        pending.append(chunk)
+        rows += len(chunk)
+
+        # Hand over full chunks and keep the remainder, so memory is bounded by chunk_size
+        if rows >= chunk_size:
+            df = pd.concat(pending, ignore_index=True)
+            for start in range(0, rows - chunk_size + 1, chunk_size):
+                yield df.iloc[start:start + chunk_size].reset_index(drop=True)
+            remainder = df.iloc[rows - rows % chunk_size:].reset_index(drop=True)
+            pending = [remainder] if len(remainder) else []
+            rows = len(remainder)
+
+    if rows:
+        yield pd.concat(pending, ignore_index=True)
+
+
+# Function to load the filtered events of a source into a single DataFrame through the streaming path
+def load_events(source=EVENTS_URL, chunk_size=100_000, parser=None, deduplicate=True):
+    chunks = list(stream_event_chunks(source, chunk_size, parser, deduplicate))
+    if not chunks:
+        return build_event_chunk({column: [] for column in EVENT_COLUMNS})
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Function to fetch and parse the whole JSON feed into a pandas DataFrame in one go (the original
+# loader, see load_events for the streaming one)
+def fetch_and_transform_data():
+    
+    # Fetch the data from the URL
+    url = EVENTS_URL
+    with stage('fetch') as record:
+        response = requests.get(url)
+        record['bytes'] = len(response.content) if response.status_code == 200 else 0
+
+    # Check if the request was successful
+    if response.status_code == 200:
+        # Parse the data line by line as a JSON object
+        with stage('parse') as record:
+            events = []
+            lines = response.text.splitlines()
+            for line in lines:
+                try:
+                    event = json.loads(line)
+                    events.append(event)
+                except json.JSONDecodeError as e:
+                    print(f"Error decoding JSON: {e}")
+            record['rows'] = len(events)
+
+        # Filter events that have a non-null customer-id and a non-null IP address
+        with stage('filter') as record:
+            filtered_events = [event for event in events if event['event']['customer-id'] is not None and event['event']['ip'] is not None]
+            record['rows'] = len(filtered_events)
+        registry.inc('pipeline_rows_dropped_total', len(lines) - len(filtered_events))
+
+        # Create a pandas DataFrame from the filtered events
+        with stage('transform', rows=len(filtered_events)):
+            df = pd.DataFrame([{
+                'id': event['id'],
+                'type': event['type'],
+                'timestamp': event['event']['timestamp'],
+                'customer_id': event['event']['customer-id'],
+                'user_agent': event['event']['user-agent'],
+                'ip': event['event']['ip'],
+                'query': event['event'].get('query', None),
+                'page': event['event'].get('page', None),
+                'referrer': event['event'].get('referrer', None)
+            } for event in filtered_events])
+
+            # Convert the timestamp to pandas datetime format
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+
+        return df
+    else:
+        print(f"Failed to fetch data. Status code: {response.status_code}")
+        return None
+
+
+# Function to pack dotted IPv4 strings into uint32 values
+def pack_ipv4(ips):
+    octets = ips.str.split('.', n=3, expand=True).to_numpy(dtype=np.uint32)
+    packed = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+    return pd.Series(packed, index=ips.index)
+
+
+# Function to turn packed uint32 values back into dotted IPv4 strings
+def unpack_ipv4(packed):
+    index = getattr(packed, 'index', None)
+    packed = np.asarray(packed, dtype=np.uint32)
+    octets = [pd.Series((packed >> shift) & 255, index=index).astype(str) for shift in (24, 16, 8, 0)]
+    return octets[0] + '.' + octets[1] + '.' + octets[2] + '.' + octets[3]
+
+
+# Function to convert parsed events into the compact representation: dictionary-encoded strings,
+# integer ids, packed IPv4 addresses and int64 epoch-nanosecond timestamps
+def compact_events(df):
+    df = df.copy()
+    for column in ['type', 'user_agent', 'query', 'page', 'referrer']:
+        df[column] = df[column].astype('category')
+    df['id'] = pd.to_numeric(df['id'], downcast='integer')
+    df['customer_id'] = pd.to_numeric(df['customer_id'], downcast='integer')
+    try:
+        df['ip'] = pack_ipv4(df['ip'])
+    except ValueError:
+        # Not every address is IPv4, fall back to dictionary encoding
+        df['ip'] = df['ip'].astype('category')
+    df['timestamp'] = df['timestamp'].astype('datetime64[ns]').astype(np.int64)
+    return df
+
+
+# Function to turn compact columns back into the values the database expects; other frames pass through
+def expand_events(df):
+    if 'ip' in df.columns and df['ip'].dtype.kind == 'u':
+        df = df.assign(ip=unpack_ipv4(df['ip']))
+    if 'timestamp' in df.columns and df['timestamp'].dtype.kind in 'iu':
+        df = df.assign(timestamp=pd.to_datetime(df['timestamp'], unit='ns'))
+    return df
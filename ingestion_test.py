@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import pandas as pd
+import ingestion
+from ingestion import stream_event_chunks, load_events, compact_events, expand_events, PARSERS
+from sessionization import sessionize_data
+from benchmarks import generate_synthetic_events
+
+EVENT_LINES = [
+    b'{"id": 1, "type": "search", "event": {"user-agent": "Mozilla/5.0", "ip": "200.15.173.55", "customer-id": 1234, "timestamp": "2022-04-28T07:38:46.290271", "query": "Synchronized didactic task-force"}}',
+    b'{"id": 2, "type": "page_view", "event": {"user-agent": "Mozilla/5.0", "ip": "121.225.65.59", "customer-id": null, "timestamp": "2022-04-28T07:17:46.290271", "page": "https://xcc-webshop.com/cart"}}',
+    b'{"id": 3, "type": "page_view", "event": {"user-agent": "Mozilla/5.0", "ip": null, "customer-id": 5678, "timestamp": "2022-04-28T07:18:46.290271", "page": "https://xcc-webshop.com/cart"}}',
+    b'{"id": 4, "type": "page_view", "event": {"user-agent": "Mozilla/5.0", "ip": "121.225.65.59", "customer-id": 5678, "timestamp": "2022-04-28T07:19:46.290271", "page": "https://xcc-webshop.com", "referrer": "https://gonzalez.com"}}',
+    b'{"id": 5, "type": "placed_order", "event": {"user-agent": "Mozilla/5.0",',
+    b'{"id": 6, "type": "placed_order", "event": {"user-agent": "Mozilla/5.0", "ip": "121.225.65.59", "customer-id": 5678, "timestamp": "2022-04-28T07:20:46.290271"}}',
+]
+
+
+class TestIngestion(unittest.TestCase):
+
+    def test_stream_local_file_in_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.json')
+            with open(path, 'wb') as events_file:
+                events_file.write(b'\n'.join(EVENT_LINES) + b'\n')
+
+            chunks = list(stream_event_chunks(path, chunk_size=2))
+
+        # Null customer-id/ip and the malformed line are dropped, the rest is chunked by two
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        df = pd.concat(chunks, ignore_index=True)
+        self.assertEqual(df['id'].tolist(), [1, 4, 6])
+        self.assertEqual(df.loc[1, 'referrer'], "https://gonzalez.com")
+        self.assertEqual(df.loc[0, 'timestamp'], pd.Timestamp("2022-04-28T07:38:46.290271"))
+
+    def test_duplicate_ids_are_dropped_across_chunks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.json')
+            with open(path, 'wb') as events_file:
+                events_file.write(b'\n'.join(EVENT_LINES + [EVENT_LINES[0], EVENT_LINES[3]]) + b'\n')
+
+            deduplicated = load_events(path, chunk_size=2)
+            raw = load_events(path, chunk_size=2, deduplicate=False)
+
+        self.assertEqual(deduplicated['id'].tolist(), [1, 4, 6])
+        self.assertEqual(raw['id'].tolist(), [1, 4, 6, 1, 4])
+
+    def test_parser_backends_agree(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.json')
+            with open(path, 'wb') as events_file:
+                events_file.write(b'\n'.join(EVENT_LINES) + b'\n')
+
+            expected = load_events(path, chunk_size=2, parser='json')
+            for parser in PARSERS:
+                if parser == 'pyarrow' and ingestion.pa is None or parser == 'orjson' and ingestion.orjson is None:
+                    continue
+                with self.subTest(parser=parser), patch('builtins.print') as mock_print:
+                    df = load_events(path, chunk_size=2, parser=parser)
+
+                    # Same rows and dtypes, and the malformed line is still reported once
+                    pd.testing.assert_frame_equal(df, expected)
+                    self.assertEqual(mock_print.call_count, 1)
+                    self.assertIn("Error decoding JSON", mock_print.call_args[0][0])
+
+    # Test that blank lines are reported as malformed by every backend, as the original loader did
+    def test_blank_lines_are_reported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.json')
+            with open(path, 'wb') as events_file:
+                events_file.write(b'\n'.join([EVENT_LINES[0], b'', EVENT_LINES[3], b'   ', EVENT_LINES[5]]) + b'\n')
+
+            for parser in PARSERS:
+                if parser == 'pyarrow' and ingestion.pa is None or parser == 'orjson' and ingestion.orjson is None:
+                    continue
+                with self.subTest(parser=parser), patch('builtins.print') as mock_print:
+                    df = load_events(path, chunk_size=10, parser=parser)
+
+                    self.assertEqual(df['id'].tolist(), [1, 4, 6])
+                    self.assertEqual(mock_print.call_count, 2)
+                    for call in mock_print.call_args_list:
+                        self.assertIn("Error decoding JSON", call[0][0])
+
+    @patch('ingestion.requests.get')
+    def test_load_events_from_url(self, mock_get):
+        mock_response = mock_get.return_value.__enter__.return_value
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = iter(EVENT_LINES)
+
+        df = load_events('https://example.com/events.json', chunk_size=10)
+
+        mock_get.assert_called_once_with('https://example.com/events.json', stream=True)
+        self.assertEqual(df['customer_id'].tolist(), [1234, 5678, 5678])
+
+    @patch('ingestion.requests.get')
+    def test_failed_request_yields_no_chunks(self, mock_get):
+        mock_get.return_value.__enter__.return_value.status_code = 404
+
+        df = load_events('https://example.com/events.json')
+
+        self.assertEqual(len(df), 0)
+        self.assertIn('timestamp', df.columns)
+
+    def test_compact_events_round_trip(self):
+        df = generate_synthetic_events(2000, events_per_customer=20)
+
+        compact = compact_events(df)
+
+        # Packed and dictionary-encoded columns take far less memory
+        self.assertEqual(str(compact['ip'].dtype), 'uint32')
+        self.assertEqual(str(compact['timestamp'].dtype), 'int64')
+        self.assertEqual(str(compact['user_agent'].dtype), 'category')
+        self.assertLess(compact.memory_usage(deep=True).sum(), df.memory_usage(deep=True).sum() / 5)
+
+        # Expanding gives back the original values
+        expanded = expand_events(compact)
+        self.assertEqual(expanded['ip'].tolist(), df['ip'].tolist())
+        self.assertTrue((expanded['timestamp'] == df['timestamp']).all())
+
+        # Sessionization accepts the compact frame directly
+        self.assertEqual(
+            sessionize_data(compact, session_timeout=8)['session_id'].sort_index().tolist(),
+            sessionize_data(df, session_timeout=8)['session_id'].sort_index().tolist()
+        )
+
+if __name__ == '__main__':
+    unittest.main()
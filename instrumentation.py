@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in seconds, from 100 microseconds to a minute
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    'pipeline_stage_duration_seconds': ('histogram', "Duration of pipeline stages (fetch, parse, filter, transform, dedup, sessionize, copy, export)"),
+    'pipeline_stage_rows_total': ('counter', "Rows handled by pipeline stages"),
+    'pipeline_stage_bytes_total': ('counter', "Bytes handled by pipeline stages"),
+    'pipeline_rows_dropped_total': ('counter', "Rows dropped while parsing: malformed lines and events without a customer-id or IP address"),
+    'pipeline_duplicate_events_total': ('counter', "Events dropped because their id was already seen"),
+    'api_query_duration_seconds': ('histogram', "Latency of the database queries behind the API"),
+    'api_query_errors_total': ('counter', "Failed database queries behind the API"),
+    'db_pool_wait_seconds': ('histogram', "Time to get a pooled database connection, including opening a new one"),
+    'db_pool_errors_total': ('counter', "Failures to get a pooled database connection"),
+}
+
+# Structured logs: one JSON object per line on stderr. INSTRUMENTATION_LOG_LEVEL=WARNING keeps only errors.
+logger = logging.getLogger('webshop')
+if not logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(os.getenv('INSTRUMENTATION_LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+
+
+# Fixed-bucket histogram; observing a value is a binary search and two additions
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Process-wide store of counters and histograms, keyed by metric name and sorted label pairs
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter_value(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram_count(self, name, **labels):
+        with self.lock:
+            histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+            return histogram.count if histogram is not None else 0
+
+    # Function to render every metric in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count, h.buckets)) for key, h in self.histograms.items())
+
+        lines = []
+        described = set()
+        for (name, labels), value in counters:
+            describe_metric(lines, described, name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            describe_metric(lines, described, name)
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+# Helper function to write the HELP and TYPE lines the first time a metric is rendered
+def describe_metric(lines, described, name):
+    if name in described:
+        return
+    described.add(name)
+    metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Function to write a structured log line; the JSON is only built when the level is enabled
+def log_event(event, level=logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({'ts': round(time.time(), 6), 'event': event, **fields}, default=str))
+
+
+# Function to record a finished pipeline stage: its duration, rows and bytes, and a log line
+def record_stage(name, seconds, rows=None, nbytes=None):
+    registry.observe('pipeline_stage_duration_seconds', seconds, stage=name)
+    if rows is not None:
+        registry.inc('pipeline_stage_rows_total', rows, stage=name)
+    if nbytes is not None:
+        registry.inc('pipeline_stage_bytes_total', nbytes, stage=name)
+    log_event('stage', stage=name, seconds=round(seconds, 6), rows=rows, bytes=nbytes)
+
+
+# Context manager timing a pipeline stage. Row and byte counts known only at the end can be set on
+# the yielded dict, e.g. `with stage('parse') as record: ...; record['rows'] = len(df)`.
+@contextmanager
+def stage(name, rows=None, nbytes=None):
+    record = {'rows': rows, 'bytes': nbytes}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record_stage(name, time.perf_counter() - start, record['rows'], record['bytes'])
+
+
+# Context manager timing an API database query; failures are counted and logged before being re-raised
+@contextmanager
+def timed_query(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        registry.inc('api_query_errors_total', query=name)
+        log_event('query_error', level=logging.WARNING, query=name, error=str(e))
+        raise
+    finally:
+        registry.observe('api_query_duration_seconds', time.perf_counter() - start, query=name)
+
+
+# Function to render the metrics for the /metrics/internal endpoint
+def render_metrics():
+    return registry.render()
@@ -0,0 +1,41 @@
+import unittest
+from instrumentation import Registry, registry, stage, timed_query
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+
+    def test_prometheus_rendering(self):
+        metrics = Registry()
+        metrics.inc('pipeline_stage_rows_total', 10, stage='parse')
+        metrics.observe('api_query_duration_seconds', 0.003, query='order_metrics')
+        metrics.observe('api_query_duration_seconds', 2, query='order_metrics')
+        lines = metrics.render().splitlines()
+
+        self.assertIn('# TYPE pipeline_stage_rows_total counter', lines)
+        self.assertIn('pipeline_stage_rows_total{stage="parse"} 10', lines)
+        self.assertIn('# TYPE api_query_duration_seconds histogram', lines)
+        # Buckets are cumulative and end with +Inf
+        self.assertIn('api_query_duration_seconds_bucket{query="order_metrics",le="0.0025"} 0', lines)
+        self.assertIn('api_query_duration_seconds_bucket{query="order_metrics",le="0.005"} 1', lines)
+        self.assertIn('api_query_duration_seconds_bucket{query="order_metrics",le="+Inf"} 2', lines)
+        self.assertIn('api_query_duration_seconds_count{query="order_metrics"} 2', lines)
+
+    def test_stages_and_failed_queries_are_recorded(self):
+        with stage('parse', rows=5) as record:
+            record['bytes'] = 120
+        with self.assertRaises(ValueError):
+            with timed_query('order_metrics'):
+                raise ValueError("connection refused")
+
+        self.assertEqual(registry.histogram_count('pipeline_stage_duration_seconds', stage='parse'), 1)
+        self.assertEqual(registry.counter_value('pipeline_stage_rows_total', stage='parse'), 5)
+        self.assertEqual(registry.counter_value('pipeline_stage_bytes_total', stage='parse'), 120)
+        self.assertEqual(registry.counter_value('api_query_errors_total', query='order_metrics'), 1)
+        self.assertEqual(registry.histogram_count('api_query_duration_seconds', query='order_metrics'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# In-process TTL/LRU cache keyed on the data version published by the loader.
+# The version itself is polled at most once per version_check_interval seconds.
+class MetricsCache:
+
+    def __init__(self, max_entries=128, ttl=300, version_check_interval=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()  # key -> (stored_at, value)
+            self.version = None
+            self.version_checked_at = None
+            self.hits = 0
+            self.misses = 0
+
+    def current_version(self, fetch_version):
+        fresh, version = self.cached_version()
+        if fresh:
+            return version
+        version = fetch_version()
+        self.set_version(version)
+        return version
+
+    # The version split in a freshness check and an update, for callers that fetch it asynchronously
+    def cached_version(self):
+        with self.lock:
+            if self.version_checked_at is not None and time.monotonic() - self.version_checked_at < self.version_check_interval:
+                return True, self.version
+            return False, None
+
+    def set_version(self, version):
+        with self.lock:
+            self.version = version
+            self.version_checked_at = time.monotonic()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "data_version": self.version,
+            }
@@ -0,0 +1,96 @@
+import numpy as np
+
+NO_ORDER = np.iinfo(np.int64).max
+
+
+# Function with the semantics of PERCENTILE_CONT(fraction) WITHIN GROUP: linear interpolation
+# between the closest ranks, and None (NULL) for an empty group
+def percentile_cont(values, fraction=0.5):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, fraction * 100, method='linear'))
+
+
+# Helper function to turn datetimes into int64 epoch nanoseconds; int64 timestamps of the compact
+# representation pass through unchanged
+def as_epoch_ns(timestamps):
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == 'M':
+        return timestamps.astype('datetime64[ns]').view(np.int64)
+    return timestamps.astype(np.int64, copy=False)
+
+
+# Function to compute both order medians from one row per session and one row per ordering customer,
+# like the queries on the sessions and customer_first_orders tables: only sessions that started before
+# the customer's first order count
+def order_metrics_from_sessions(customer_ids, session_starts, durations, order_customer_ids, first_order_times):
+    customer_ids = np.asarray(customer_ids)
+    session_starts = as_epoch_ns(session_starts)
+    durations = np.asarray(durations, dtype=np.float64)
+    order_customer_ids = np.asarray(order_customer_ids)
+    first_order_times = as_epoch_ns(first_order_times)
+
+    # Look up every session's first order time with a binary search over the sorted customers
+    order = np.argsort(order_customer_ids, kind='stable')
+    order_customer_ids = order_customer_ids[order]
+    first_order_times = first_order_times[order]
+    positions = np.minimum(np.searchsorted(order_customer_ids, customer_ids), max(len(order_customer_ids) - 1, 0))
+    if len(order_customer_ids):
+        before = (order_customer_ids[positions] == customer_ids) & (session_starts < first_order_times[positions])
+    else:
+        before = np.zeros(len(customer_ids), dtype=bool)
+
+    _, sessions_before = np.unique(customer_ids[before], return_counts=True)
+    return percentile_cont(sessions_before), percentile_cont(durations[before])
+
+
+# Function to compute both order medians straight from sessionized events given as columnar arrays
+def order_metrics_from_events(customer_ids, session_ids, timestamps, is_order):
+    customer_ids = np.asarray(customer_ids)
+    session_ids = np.asarray(session_ids)
+    timestamps = as_epoch_ns(timestamps)
+    is_order = np.asarray(is_order, dtype=bool)
+    if len(customer_ids) == 0:
+        return None, None
+
+    # Group the events by customer and session
+    order = np.lexsort((session_ids, customer_ids))
+    customer_ids = customer_ids[order]
+    session_ids = session_ids[order]
+    timestamps = timestamps[order]
+    is_order = is_order[order]
+
+    new_customer = np.ones(len(customer_ids), dtype=bool)
+    new_customer[1:] = customer_ids[1:] != customer_ids[:-1]
+    new_session = new_customer.copy()
+    new_session[1:] |= session_ids[1:] != session_ids[:-1]
+
+    # One row per session: start and duration in minutes
+    session_rows = np.flatnonzero(new_session)
+    session_starts = np.minimum.reduceat(timestamps, session_rows)
+    durations = (np.maximum.reduceat(timestamps, session_rows) - session_starts) / (60 * 10**9)
+
+    # One row per customer: the first placed_order, if any
+    customer_rows = np.flatnonzero(new_customer)
+    first_orders = np.minimum.reduceat(np.where(is_order, timestamps, NO_ORDER), customer_rows)
+    ordered = first_orders != NO_ORDER
+
+    return order_metrics_from_sessions(
+        customer_ids[session_rows], session_starts, durations,
+        customer_ids[customer_rows][ordered], first_orders[ordered]
+    )
+
+
+# Function to compute the /metrics/orders payload from a sessionized events DataFrame
+def compute_order_metrics(df):
+    median_visits_before_order, median_session_duration_before_order = order_metrics_from_events(
+        df['customer_id'].to_numpy(),
+        df['session_id'].to_numpy(),
+        df['timestamp'].to_numpy(),
+        (df['type'] == 'placed_order').to_numpy(dtype=bool),
+    )
+    return {
+        "median_visits_before_order": median_visits_before_order,
+        "median_session_duration_minutes_before_order": median_session_duration_before_order
+    }
@@ -0,0 +1,55 @@
+import unittest
+import pandas as pd
+from metrics_engine import percentile_cont, order_metrics_from_sessions, compute_order_metrics
+from ingestion import compact_events
+from sessionization import sessionize_data, summarize_sessions
+from benchmarks import generate_synthetic_events
+
+
+# Row-by-row reference for the SQL queries: the sessions that started before each customer's first order
+def reference_order_metrics(df):
+    sessions = summarize_sessions(df)
+    first_orders = df[df['type'] == 'placed_order'].groupby('customer_id')['timestamp'].min()
+    before = sessions[sessions['session_start'] < sessions['customer_id'].map(first_orders)]
+    return before.groupby('customer_id').size().median(), before['duration_minutes'].median()
+
+
+class TestMetricsEngine(unittest.TestCase):
+
+    def test_percentile_cont_interpolates(self):
+        self.assertEqual(percentile_cont([1, 2, 3]), 2.0)
+        self.assertEqual(percentile_cont([4, 1, 2, 3]), 2.5)
+        self.assertEqual(percentile_cont([1, 2, 3, 4], 0.9), 3.7)
+        self.assertIsNone(percentile_cont([]))
+
+    def test_sessions_before_first_order(self):
+        metrics = order_metrics_from_sessions(
+            customer_ids=[1, 1, 1, 2, 2, 3],
+            session_starts=pd.to_datetime(["2022-04-28 10:00", "2022-04-28 11:00", "2022-04-28 12:00",
+                                           "2022-04-28 10:00", "2022-04-28 10:30", "2022-04-28 10:00"]),
+            durations=[5.0, 10.0, 1.0, 2.0, 4.0, 7.0],
+            order_customer_ids=[2, 1],
+            first_order_times=pd.to_datetime(["2022-04-28 10:30", "2022-04-28 12:00"]),
+        )
+
+        # Customer 1 has two sessions before ordering, customer 2 one (the order session itself does
+        # not count as it starts at the order time), customer 3 never ordered
+        self.assertEqual(metrics, (1.5, 5.0))
+
+    def test_no_orders(self):
+        metrics = order_metrics_from_sessions([1, 2], pd.to_datetime(["2022-04-28", "2022-04-29"]), [1.0, 2.0], [], pd.to_datetime([]))
+        self.assertEqual(metrics, (None, None))
+
+    def test_matches_reference_on_events(self):
+        df = sessionize_data(generate_synthetic_events(20000, events_per_customer=40), session_timeout=8)
+        median_visits, median_duration = reference_order_metrics(df)
+
+        metrics = compute_order_metrics(df)
+        self.assertEqual(metrics["median_visits_before_order"], median_visits)
+        self.assertAlmostEqual(metrics["median_session_duration_minutes_before_order"], median_duration)
+
+        # The compact representation gives the same result
+        self.assertEqual(compute_order_metrics(compact_events(df)), metrics)
+
+if __name__ == '__main__':
+    unittest.main()
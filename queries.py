@@ -0,0 +1,49 @@
+import json
+from sketches import TDigest
+
+# SQL shared by the Flask API (app.py) and the ASGI API (app_async.py)
+
+
+# SQL query for the data version the loader bumps after every successful load
+def get_data_version_query():
+    return "SELECT version FROM data_version;"
+
+
+# SQL query computing both order medians in a single pass over the sessions before the first order
+def get_order_metrics_query():
+    return """
+    WITH sessions_before_purchase AS (
+        SELECT 
+            s.customer_id,
+            s.duration_minutes
+        FROM sessions s
+        JOIN customer_first_orders fo 
+            ON s.customer_id = fo.customer_id
+        WHERE s.session_start < fo.first_order_time
+    ),
+    session_counts AS (
+        SELECT 
+            customer_id,
+            COUNT(*) AS session_count
+        FROM sessions_before_purchase
+        GROUP BY customer_id
+    )
+    SELECT
+        (SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY session_count) FROM session_counts) AS median_sessions_before_purchase,
+        (SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY duration_minutes) FROM sessions_before_purchase) AS median_session_duration_before_purchase;
+    """
+
+
+# SQL query for the persisted t-digests of the order metrics, answering ?mode=approx
+def get_order_metric_sketches_query():
+    return "SELECT name, sketch FROM order_metric_sketches;"
+
+
+# Function to answer both order medians from the (name, sketch) rows of the sketches query.
+# psycopg2 decodes the JSONB sketches, asyncpg hands them over as JSON text.
+def order_metrics_from_sketch_rows(rows):
+    sketches = {name: TDigest.from_dict(json.loads(sketch) if isinstance(sketch, str) else sketch) for name, sketch in rows}
+    return tuple(
+        sketches[name].quantile(0.5) if name in sketches else None
+        for name in ['sessions_before_order', 'session_duration_before_order']
+    )
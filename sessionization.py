@@ -0,0 +1,451 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+from instrumentation import stage
+
+
+# Function to express the session timeout in the unit of the timestamps: a timedelta for datetimes,
+# nanoseconds for the int64 epoch timestamps of the compact representation
+def session_threshold(timestamps, session_timeout):
+    if np.asarray(timestamps).dtype.kind in 'iu':
+        return int(session_timeout * 60 * 10**9)
+    return pd.Timedelta(minutes=session_timeout).to_timedelta64()
+
+
+# Function to turn the gaps between consecutive timestamps into minutes
+def gaps_in_minutes(timestamps):
+    gaps = np.diff(np.asarray(timestamps))
+    if gaps.dtype.kind in 'iu':
+        return gaps / (60 * 10**9)
+    return pd.Series(gaps).dt.total_seconds().fillna(0).to_numpy() / 60
+
+
+# Function to assign session ids over arrays already sorted by customer and timestamp
+def assign_session_ids(customer_ids, timestamps, session_timeout):
+    customer_ids = np.asarray(customer_ids)
+    timestamps = np.asarray(timestamps)
+    n = len(customer_ids)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Flag the first event of every customer
+    new_customer = np.empty(n, dtype=bool)
+    new_customer[0] = True
+    new_customer[1:] = customer_ids[1:] != customer_ids[:-1]
+
+    # Flag events that come more than session_timeout minutes after the previous event
+    # (NaT gaps compare as False, just like the original row-by-row comparison)
+    new_session = np.zeros(n, dtype=bool)
+    new_session[1:] = np.diff(timestamps) > session_threshold(timestamps, session_timeout)
+    new_session &= ~new_customer
+
+    # Count the session breaks and restart the count at 1 for each customer
+    breaks = np.cumsum(new_session)
+    customer_start = np.maximum.accumulate(np.where(new_customer, np.arange(n), 0))
+    return breaks - breaks[customer_start] + 1
+
+
+# Function to fingerprint the device of every event as an integer code of its user agent
+# (the codes of a compact, categorical column as they are)
+def device_fingerprints(user_agents):
+    if isinstance(user_agents.dtype, pd.CategoricalDtype):
+        return user_agents.cat.codes.to_numpy()
+    return pd.factorize(user_agents)[0]
+
+
+# Function to assign cross-device session ids, in the order of the input arrays. Events are first
+# sessionized per (customer, device) with the session timeout; the device sessions of a customer are
+# then merged when they overlap or one starts at most merge_window minutes after the others ended,
+# by sorting them on their start and sweeping with the running maximum of their ends.
+# Two sorts and a handful of passes over the arrays, so O(n log n) overall.
+def assign_device_session_ids(customer_ids, devices, timestamps, session_timeout, merge_window):
+    customer_ids = np.asarray(customer_ids)
+    devices = np.asarray(devices)
+    timestamps = np.asarray(timestamps)
+    n = len(customer_ids)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Device sessions: the timeout rule over events sorted by customer, device and timestamp
+    order = np.lexsort((timestamps, devices, customer_ids))
+    customers, sorted_devices, sorted_timestamps = customer_ids[order], devices[order], timestamps[order]
+    new_device_session = np.ones(n, dtype=bool)
+    new_device_session[1:] = (
+        (customers[1:] != customers[:-1]) | (sorted_devices[1:] != sorted_devices[:-1])
+        | (np.diff(sorted_timestamps) > session_threshold(timestamps, session_timeout))
+    )
+    device_session = np.cumsum(new_device_session) - 1
+    first_events = np.flatnonzero(new_device_session)
+    last_events = np.append(first_events[1:] - 1, n - 1)
+
+    # Sort the device sessions by customer and start, and sweep: a device session starts a new merged
+    # session unless it starts within merge_window of the latest end of the customer's earlier ones
+    by_start = np.lexsort((sorted_timestamps[first_events], customers[first_events]))
+    session_customers = customers[first_events][by_start]
+    starts = sorted_timestamps[first_events][by_start]
+    reach = pd.Series(sorted_timestamps[last_events][by_start]).groupby(session_customers).cummax().to_numpy()
+
+    new_customer = np.ones(len(by_start), dtype=bool)
+    new_customer[1:] = session_customers[1:] != session_customers[:-1]
+    new_merged = new_customer.copy()
+    new_merged[1:] |= starts[1:] - reach[:-1] > session_threshold(timestamps, merge_window)
+
+    # Number the merged sessions from 1 for each customer, in order of their start
+    merged = np.cumsum(new_merged)
+    customer_start = np.maximum.accumulate(np.where(new_customer, np.arange(len(by_start)), 0))
+    merged_ids = np.empty(len(by_start), dtype=np.int64)
+    merged_ids[by_start] = merged - merged[customer_start] + 1
+
+    device_session_ids = np.empty(n, dtype=np.int64)
+    device_session_ids[order] = merged_ids[device_session]
+    return device_session_ids
+
+
+# Function to group events by customer into sessions. With a device_merge_window (in minutes) the
+# events also get a device_session_id: sessions split per user agent and merged again when the
+# customer switches devices within the window (see assign_device_session_ids).
+def sessionize_data(df, session_timeout, device_merge_window=None):
+    with stage('sessionize', rows=len(df)):
+        # Sort the events by customer_id and timestamp
+        df = df.sort_values(by=['customer_id', 'timestamp'])
+
+        # Add session IDs to the DataFrame
+        df['session_id'] = assign_session_ids(df['customer_id'].to_numpy(), df['timestamp'].to_numpy(), session_timeout)
+        if device_merge_window is not None:
+            df['device_session_id'] = assign_device_session_ids(
+                df['customer_id'].to_numpy(), device_fingerprints(df['user_agent']), df['timestamp'].to_numpy(),
+                session_timeout, device_merge_window
+            )
+
+    return df
+
+
+# Original row-by-row implementation, kept as the reference for tests and benchmarks
+def sessionize_data_iterrows(df, session_timeout):
+    # Sort the events by customer_id and timestamp
+    df = df.sort_values(by=['customer_id', 'timestamp'])
+
+    # Initialize a list to hold session ids
+    session_ids = []
+
+    # Time threshold (in minutes) for session timeout
+    session_threshold = timedelta(minutes=session_timeout)
+
+    # Initialize variables to track the previous row
+    previous_customer_id = None
+    previous_timestamp = None
+    current_session_id = 1  # Start session ID at 1 for each customer
+
+    # Loop through each event and assign a session ID
+    for index, row in df.iterrows():
+        if row['customer_id'] != previous_customer_id:
+            current_session_id = 1  # Reset session ID for new customer
+        # If this is the same customer but the time difference is greater than the threshold, increment session ID
+        elif previous_timestamp is not None and (row['timestamp'] - previous_timestamp) > session_threshold:
+            current_session_id += 1
+
+        # Append the current session ID
+        session_ids.append(current_session_id)
+
+        # Update the previous customer and timestamp
+        previous_customer_id = row['customer_id']
+        previous_timestamp = row['timestamp']
+
+    # Add session IDs to the DataFrame
+    df['session_id'] = session_ids
+
+    return df
+
+
+# Function to derive session statistics for many candidate timeouts from a single sort
+def sweep_session_timeouts(df, timeouts, bins=120, hist_range=(0, 40)):
+    # Sort once and compute the inter-event gaps (in minutes) once
+    df = df.sort_values(by=['customer_id', 'timestamp'])
+    customer_ids = df['customer_id'].to_numpy()
+    gaps = np.zeros(len(df))
+    if len(df) > 1:
+        gaps[1:] = gaps_in_minutes(df['timestamp'].to_numpy())
+
+    new_customer = np.ones(len(df), dtype=bool)
+    new_customer[1:] = customer_ids[1:] != customer_ids[:-1]
+
+    stats = []
+    histograms = []
+    for timeout in timeouts:
+        # A session starts at every new customer and at every gap above the timeout
+        session_start = new_customer | (gaps > timeout)
+        session_keys = np.cumsum(session_start) - 1
+        session_count = int(session_keys[-1]) + 1 if len(df) else 0
+
+        # The duration of a session is the sum of the gaps inside it
+        durations = np.bincount(session_keys, weights=np.where(session_start, 0, gaps), minlength=session_count)
+
+        stats.append({
+            'timeout': timeout,
+            'sessions': session_count,
+            'events_per_session': len(df) / session_count if session_count else np.nan,
+            'mean_duration': durations.mean() if session_count else np.nan,
+            'median_duration': np.median(durations) if session_count else np.nan,
+            'p90_duration': np.percentile(durations, 90) if session_count else np.nan,
+            'max_duration': durations.max() if session_count else np.nan,
+        })
+
+        counts, edges = np.histogram(durations, bins=bins, range=hist_range)
+        histograms.append(pd.DataFrame({'timeout': timeout, 'bin_start': edges[:-1], 'bin_end': edges[1:], 'sessions': counts}))
+
+    return pd.DataFrame(stats), pd.concat(histograms, ignore_index=True)
+
+
+# Function to sessionize new events so they continue each customer's last known session.
+# last_sessions holds customer_id, session_id and session_end of every customer's latest session.
+def sessionize_incremental(df, last_sessions, session_timeout):
+    df = sessionize_data(df, session_timeout)
+    if len(df) == 0 or len(last_sessions) == 0:
+        return df
+
+    state = last_sessions.set_index('customer_id')
+    last_session_id = df['customer_id'].map(state['session_id'])
+    last_session_end = df['customer_id'].map(state['session_end'])
+
+    # The first new event reopens the last session when it falls within the timeout,
+    # otherwise the new sessions are numbered after it
+    first_timestamp = df.groupby('customer_id')['timestamp'].transform('min')
+    reopens = (first_timestamp - last_session_end) <= session_threshold(first_timestamp.to_numpy(), session_timeout)
+    offset = np.where(last_session_id.isna(), 0, np.where(reopens, last_session_id - 1, last_session_id))
+    df['session_id'] = df['session_id'] + offset.astype(np.int64)
+
+    return df
+
+
+# Function to split event positions into shards by a hash of the customer id, so every customer lands in one shard
+def partition_by_customer(df, shards):
+    shard_keys = pd.util.hash_array(df['customer_id'].to_numpy()) % np.uint64(shards)
+    return [np.flatnonzero(shard_keys == shard) for shard in range(shards)]
+
+
+# Worker task: sort one shard by customer and timestamp and assign its session ids, and its
+# cross-device session ids when given the device fingerprints and a merge window.
+# Only the key columns are shipped to the worker, not the whole rows.
+def sessionize_shard(customer_ids, timestamps, session_timeout, devices=None, device_merge_window=None):
+    order = np.lexsort((timestamps, customer_ids))
+    session_ids = assign_session_ids(customer_ids[order], timestamps[order], session_timeout)
+    if devices is None:
+        return order, session_ids, None
+    device_session_ids = assign_device_session_ids(customer_ids[order], devices[order], timestamps[order], session_timeout, device_merge_window)
+    return order, session_ids, device_session_ids
+
+
+# Function to sessionize customer shards in worker processes, yielding (shard, positions, session_ids,
+# device_session_ids) as shards complete; device_session_ids is None without a device_merge_window
+def iter_shard_session_ids(df, session_timeout, workers, shards, device_merge_window=None):
+    customer_ids = df['customer_id'].to_numpy()
+    timestamps = df['timestamp'].to_numpy()
+    devices = device_fingerprints(df['user_agent']) if device_merge_window is not None else None
+    parts = [(shard, positions) for shard, positions in enumerate(partition_by_customer(df, shards)) if len(positions)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                sessionize_shard, customer_ids[positions], timestamps[positions], session_timeout,
+                devices[positions] if devices is not None else None, device_merge_window
+            ): (shard, positions)
+            for shard, positions in parts
+        }
+        for future in as_completed(futures):
+            shard, positions = futures[future]
+            order, session_ids, device_session_ids = future.result()
+            yield shard, positions[order], session_ids, device_session_ids
+
+
+# Function to sessionize events in a pool of worker processes, hash-partitioned by customer.
+# Session ids only depend on a customer's own events, so every row gets the same id as with
+# sessionize_data; rows come back grouped by shard (in shard order), sorted by customer and timestamp.
+def sessionize_parallel(df, session_timeout, workers=None, shards=None, device_merge_window=None):
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(df) == 0:
+        return sessionize_data(df, session_timeout, device_merge_window)
+
+    with stage('sessionize', rows=len(df)):
+        # Several shards per worker keep the pool busy when shard sizes differ
+        shards = shards or workers * 4
+        results = {shard: result for shard, *result in iter_shard_session_ids(df, session_timeout, workers, shards, device_merge_window)}
+
+        # Reassemble deterministically, whatever order the workers finished in
+        ordered = [results[key] for key in sorted(results)]
+        sessionized_df = df.take(np.concatenate([positions for positions, _, _ in ordered]))
+        sessionized_df['session_id'] = np.concatenate([session_ids for _, session_ids, _ in ordered])
+        if device_merge_window is not None:
+            sessionized_df['device_session_id'] = np.concatenate([device_session_ids for _, _, device_session_ids in ordered])
+    return sessionized_df
+
+
+# Function to hand each sessionized customer shard to a consumer (e.g. the loader) as soon as it is
+# ready, without reassembling the full frame
+def iter_sessionized_shards(df, session_timeout, workers=None, shards=None, device_merge_window=None):
+    workers = workers or os.cpu_count()
+    for _, positions, session_ids, device_session_ids in iter_shard_session_ids(df, session_timeout, workers, shards or workers * 4, device_merge_window):
+        shard = df.take(positions)
+        shard['session_id'] = session_ids
+        if device_session_ids is not None:
+            shard['device_session_id'] = device_session_ids
+        yield shard
+
+
+SESSION_COLUMNS = ['customer_id', 'session_id', 'session_start', 'session_end', 'duration_minutes', 'event_count', 'has_order']
+
+
+# Helper function to build an empty sessions frame with the column dtypes of summarize_sessions
+def empty_sessions():
+    dtypes = ['int64', 'int64', 'datetime64[ns]', 'datetime64[ns]', 'float64', 'int64', 'bool']
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in zip(SESSION_COLUMNS, dtypes)})
+
+
+# Helper function to concatenate frames, skipping empty ones so they do not turn the dtypes into object
+def concat_non_empty(frames, ignore_index=False):
+    non_empty = [frame for frame in frames if len(frame)]
+    if len(non_empty) == 1:
+        return non_empty[0].reset_index(drop=True) if ignore_index else non_empty[0]
+    return pd.concat(non_empty or frames[:1], ignore_index=ignore_index)
+
+
+# Helper function to select the rows of a frame indexed by customer id as a frame with a customer_id column
+def rows_for_customers(frame, customer_ids):
+    return frame.loc[frame.index.intersection(customer_ids)].rename_axis('customer_id').reset_index()
+
+
+# Function to summarize sessionized events into one row per session, like the sessions table
+def summarize_sessions(df):
+    sessions = df.assign(has_order=df['type'] == 'placed_order').groupby(['customer_id', 'session_id'], as_index=False).agg(
+        session_start=('timestamp', 'min'),
+        session_end=('timestamp', 'max'),
+        event_count=('timestamp', 'size'),
+        has_order=('has_order', 'any'),
+    )
+    return finish_sessions(sessions)
+
+
+# Helper function to add the duration and put the session columns in table order
+def finish_sessions(sessions):
+    sessions = sessions.assign(duration_minutes=(sessions['session_end'] - sessions['session_start']).dt.total_seconds() / 60)
+    return sessions[SESSION_COLUMNS].reset_index(drop=True)
+
+
+# Sessionizer for events that arrive one at a time or in micro-batches, at most allowed_lateness
+# minutes out of order. Events are held back until the watermark (latest timestamp seen minus
+# allowed_lateness) passes them, then get the same session id as sessionize_data would give them.
+# A session is emitted once the watermark is more than session_timeout past its last event.
+#
+# Only open sessions are kept in memory. Customers whose sessions closed are remembered by their
+# last session id and end, unless lookup_last_sessions(customer_ids) can fetch those (e.g. from the
+# sessions table), in which case they are forgotten.
+class StreamingSessionizer:
+
+    def __init__(self, session_timeout, allowed_lateness=0, lookup_last_sessions=None):
+        self.session_timeout = session_timeout
+        self.allowed_lateness = pd.Timedelta(minutes=allowed_lateness)
+        self.lookup_last_sessions = lookup_last_sessions
+        self.pending = []
+        self.max_timestamp = None
+        self.open_sessions = empty_sessions().set_index('customer_id')
+        self.closed_sessions = self.open_sessions[['session_id', 'session_end']]
+        self.late_events = 0
+
+    def watermark(self):
+        if self.max_timestamp is None:
+            return None
+        return self.max_timestamp - self.allowed_lateness
+
+    def add_event(self, event):
+        return self.add(pd.DataFrame([event]))
+
+    # Function to add a micro-batch of events, returning the events that got their session id
+    # and the sessions that closed
+    def add(self, events):
+        watermark = self.watermark()
+        if watermark is not None:
+            # Events older than the watermark are beyond the lateness bound and are dropped
+            late = events['timestamp'] < watermark
+            self.late_events += int(late.sum())
+            events = events[~late]
+
+        if len(events):
+            self.pending.append(events)
+            latest = events['timestamp'].max()
+            self.max_timestamp = latest if self.max_timestamp is None else max(self.max_timestamp, latest)
+        return self.advance(self.watermark())
+
+    # Function to flush everything at the end of the stream
+    def close(self):
+        return self.advance(None)
+
+    def advance(self, watermark):
+        pending = pd.concat(self.pending) if self.pending else None
+        self.pending = []
+        if pending is None or len(pending) == 0:
+            ready = None
+        elif watermark is None:
+            ready = pending
+        else:
+            # Nothing can still arrive before the watermark, so these events are final
+            is_ready = (pending['timestamp'] <= watermark).to_numpy()
+            ready = pending[is_ready]
+            if not is_ready.all():
+                self.pending = [pending[~is_ready]]
+
+        events, closed = self.assign(ready)
+        expired = self.expire(watermark)
+        return events, concat_non_empty([closed, expired], ignore_index=True)
+
+    # Helper function to find where each customer's previous session ended
+    def last_sessions(self, customer_ids):
+        last = rows_for_customers(self.open_sessions, customer_ids)[['customer_id', 'session_id', 'session_end']]
+        others = pd.Index(customer_ids).difference(last['customer_id'])
+        if self.lookup_last_sessions is not None:
+            known = self.lookup_last_sessions(others.tolist()) if len(others) else None
+        else:
+            known = rows_for_customers(self.closed_sessions, others)
+        if known is not None:
+            last = concat_non_empty([last, known[['customer_id', 'session_id', 'session_end']]], ignore_index=True)
+        return last
+
+    def assign(self, ready):
+        if ready is None or len(ready) == 0:
+            return pd.DataFrame(), empty_sessions()
+
+        customer_ids = ready['customer_id'].unique()
+        events = sessionize_incremental(ready, self.last_sessions(customer_ids), self.session_timeout)
+
+        # Fold the new events into the open sessions they continue
+        batch_sessions = summarize_sessions(events)
+        continued = rows_for_customers(self.open_sessions, customer_ids)
+        sessions = concat_non_empty([continued, batch_sessions], ignore_index=True)
+        sessions = sessions.groupby(['customer_id', 'session_id'], as_index=False).agg(
+            session_start=('session_start', 'min'),
+            session_end=('session_end', 'max'),
+            event_count=('event_count', 'sum'),
+            has_order=('has_order', 'any'),
+        )
+        sessions = finish_sessions(sessions)
+
+        # Each customer's latest session stays open, the earlier ones were followed by a longer gap
+        latest = ~sessions['customer_id'].duplicated(keep='last').to_numpy()
+        self.open_sessions = concat_non_empty([
+            self.open_sessions.drop(index=continued['customer_id']),
+            sessions[latest].set_index('customer_id'),
+        ])
+        self.closed_sessions = self.closed_sessions.drop(index=self.closed_sessions.index.intersection(customer_ids))
+        return events, sessions[~latest].reset_index(drop=True)
+
+    # Function to close the open sessions that no future event can extend any more
+    def expire(self, watermark):
+        if watermark is None:
+            expired = np.ones(len(self.open_sessions), dtype=bool)
+        else:
+            expired = (watermark - self.open_sessions['session_end'] > pd.Timedelta(minutes=self.session_timeout)).to_numpy(dtype=bool)
+        sessions = self.open_sessions[expired].rename_axis('customer_id').reset_index()
+        self.open_sessions = self.open_sessions[~expired]
+        if self.lookup_last_sessions is None:
+            remembered = sessions.set_index('customer_id')[['session_id', 'session_end']]
+            self.closed_sessions = concat_non_empty([self.closed_sessions, remembered])
+        return sessions[SESSION_COLUMNS]
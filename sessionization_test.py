@@ -0,0 +1,181 @@
+import unittest
+import numpy as np
+import pandas as pd
+from sessionization import sessionize_data, sessionize_data_iterrows, sweep_session_timeouts, sessionize_incremental, sessionize_parallel, iter_sessionized_shards, StreamingSessionizer, summarize_sessions
+from benchmarks import generate_synthetic_events
+
+
+class TestSessionization(unittest.TestCase):
+
+    def test_matches_iterrows_implementation(self):
+        # Synthetic events with bursts and long pauses for many customers
+        df = generate_synthetic_events(5000, events_per_customer=25)
+
+        vectorized = sessionize_data(df, session_timeout=8)
+        reference = sessionize_data_iterrows(df, session_timeout=8)
+
+        # Same row order and exactly the same session ids
+        self.assertTrue(vectorized.index.equals(reference.index))
+        self.assertEqual(vectorized['session_id'].tolist(), reference['session_id'].tolist())
+
+    def test_session_ids_reset_per_customer(self):
+        df = pd.DataFrame({
+            "customer_id": [1, 1, 2, 2, 1],
+            "timestamp": pd.to_datetime([
+                "2022-04-28 10:00:00",
+                "2022-04-28 10:30:00",  # New session for customer 1
+                "2022-04-28 11:00:00",  # First event for customer 2 (Session 1)
+                "2022-04-28 11:08:00",  # Exactly 8 minutes later, same session
+                "2022-04-28 10:31:00",  # Out-of-order input, still session 2 for customer 1
+            ]),
+        })
+
+        sessionized_df = sessionize_data(df, session_timeout=8)
+
+        self.assertEqual(sessionized_df['session_id'].tolist(), [1, 2, 2, 1, 1])
+        self.assertEqual(sessionized_df['customer_id'].tolist(), [1, 1, 1, 2, 2])
+
+    def test_empty_dataframe(self):
+        df = pd.DataFrame({"customer_id": [], "timestamp": pd.to_datetime([])})
+
+        sessionized_df = sessionize_data(df, session_timeout=8)
+
+        self.assertEqual(len(sessionized_df), 0)
+        self.assertIn('session_id', sessionized_df.columns)
+
+    def test_sweep_matches_per_timeout_sessionization(self):
+        df = generate_synthetic_events(5000, events_per_customer=25)
+
+        stats, histograms = sweep_session_timeouts(df, timeouts=[1, 8, 60])
+
+        for timeout in [1, 8, 60]:
+            # Recompute the session durations the slow way for this timeout
+            sessionized_df = sessionize_data(df, session_timeout=timeout)
+            sessions = sessionized_df.groupby(['customer_id', 'session_id'])['timestamp'].agg(['min', 'max'])
+            durations = (sessions['max'] - sessions['min']).dt.total_seconds() / 60
+
+            row = stats[stats['timeout'] == timeout].iloc[0]
+            self.assertEqual(row['sessions'], len(sessions))
+            self.assertAlmostEqual(row['median_duration'], durations.median())
+            self.assertAlmostEqual(row['mean_duration'], durations.mean())
+
+            # The histogram counts every session that falls in the plotted range
+            histogram = histograms[histograms['timeout'] == timeout]
+            self.assertEqual(histogram['sessions'].sum(), (durations <= 40).sum())
+
+    def test_incremental_matches_full_sessionization(self):
+        df = generate_synthetic_events(5000, events_per_customer=25)
+        cutoff = df['timestamp'].quantile(0.7)
+        history = sessionize_data(df[df['timestamp'] <= cutoff], session_timeout=8)
+
+        # The latest session of every customer seen so far
+        last_sessions = history.groupby('customer_id').agg(session_id=('session_id', 'max'), session_end=('timestamp', 'max')).reset_index()
+        new_events = sessionize_incremental(df[df['timestamp'] > cutoff], last_sessions, session_timeout=8)
+
+        # History plus the incremental batch gives the same ids as one full run
+        combined = pd.concat([history, new_events]).sort_values(['customer_id', 'timestamp'])
+        full = sessionize_data(df, session_timeout=8)
+        self.assertEqual(combined['session_id'].tolist(), full['session_id'].tolist())
+
+    def test_parallel_matches_single_process(self):
+        df = generate_synthetic_events(5000, events_per_customer=25)
+
+        expected = sessionize_data(df, session_timeout=8)['session_id'].sort_index()
+        parallel = sessionize_parallel(df, session_timeout=8, workers=2, shards=5)
+
+        # Every row gets the same session id, and the output order is reproducible
+        self.assertEqual(parallel['session_id'].sort_index().tolist(), expected.tolist())
+        self.assertTrue(parallel.index.equals(sessionize_parallel(df, session_timeout=8, workers=2, shards=5).index))
+
+        # Streaming the shards covers every event exactly once
+        shards = list(iter_sessionized_shards(df, session_timeout=8, workers=2, shards=5))
+        streamed = pd.concat(shards)['session_id'].sort_index()
+        self.assertEqual(streamed.tolist(), expected.tolist())
+
+    def test_streaming_matches_batch(self):
+        df = generate_synthetic_events(5000, events_per_customer=25)
+
+        # Events arrive in micro-batches, up to 5 minutes out of order
+        rng = np.random.default_rng(0)
+        arrival = df['timestamp'] + pd.to_timedelta(rng.uniform(0, 5, len(df)), unit='min')
+        stream = df.iloc[np.argsort(arrival.to_numpy(), kind='stable')]
+
+        sessionizer = StreamingSessionizer(session_timeout=8, allowed_lateness=5)
+        steps = [sessionizer.add(stream.iloc[start:start + 250]) for start in range(0, len(stream), 250)]
+        steps.append(sessionizer.close())
+        events = pd.concat([events for events, _ in steps])
+        sessions = pd.concat([sessions for _, sessions in steps])
+
+        # Every event gets its batch session id and every session is emitted exactly once
+        batch = sessionize_data(df, session_timeout=8)
+        self.assertEqual(events.set_index('id')['session_id'].sort_index().tolist(), batch.set_index('id')['session_id'].sort_index().tolist())
+        pd.testing.assert_frame_equal(
+            sessions.sort_values(['customer_id', 'session_id']).reset_index(drop=True),
+            summarize_sessions(batch)
+        )
+        self.assertEqual(sessionizer.late_events, 0)
+        self.assertEqual(len(sessionizer.open_sessions), 0)
+
+    def test_streaming_emits_sessions_after_timeout(self):
+        sessionizer = StreamingSessionizer(session_timeout=8, allowed_lateness=2)
+        event = lambda event_id, customer_id, timestamp: {
+            "id": event_id, "type": "page_view", "customer_id": customer_id, "timestamp": pd.Timestamp(timestamp)
+        }
+
+        events, sessions = sessionizer.add_event(event(1, 7, "2022-04-28 10:00"))
+        self.assertEqual((len(events), len(sessions)), (0, 0))
+
+        # The watermark (10:06) passes event 1, but its session may still be extended
+        events, sessions = sessionizer.add_event(event(2, 8, "2022-04-28 10:08"))
+        self.assertEqual(events['id'].tolist(), [1])
+        self.assertEqual(len(sessions), 0)
+
+        # Events behind the watermark are dropped; at 10:18 both sessions have expired
+        sessionizer.add_event(event(3, 7, "2022-04-28 10:05"))
+        events, sessions = sessionizer.add_event(event(4, 8, "2022-04-28 10:20"))
+        self.assertEqual(sessionizer.late_events, 1)
+        self.assertEqual(events['id'].tolist(), [2])
+        self.assertEqual(sessions[['customer_id', 'session_id', 'event_count']].values.tolist(), [[7, 1, 1], [8, 1, 1]])
+
+        # Closing the stream assigns the held back event, which starts a second session
+        events, sessions = sessionizer.close()
+        self.assertEqual(events[['id', 'session_id']].values.tolist(), [[4, 2]])
+        self.assertEqual(sessions[['customer_id', 'session_id']].values.tolist(), [[8, 2]])
+
+    def test_device_sessions_merge_close_device_switches(self):
+        df = pd.DataFrame({
+            "customer_id": [1, 1, 1, 1, 1, 2, 2],
+            "user_agent": ["phone", "phone", "laptop", "laptop", "tablet", "phone", "laptop"],
+            "timestamp": pd.to_datetime([
+                "2022-04-28 10:00:00",
+                "2022-04-28 10:05:00",
+                "2022-04-28 10:03:00",  # Laptop while the phone session is still going: merged
+                "2022-04-28 10:09:00",
+                "2022-04-28 10:10:30",  # Tablet 90 seconds after the laptop: merged within 2 minutes
+                "2022-04-28 10:00:00",
+                "2022-04-28 10:04:00",  # Switch 4 minutes after the phone: a new session
+            ]),
+        })
+
+        merged = sessionize_data(df, session_timeout=8, device_merge_window=2)
+        self.assertEqual(merged['session_id'].tolist(), [1, 1, 1, 1, 1, 1, 1])
+        self.assertEqual(merged['device_session_id'].tolist(), [1, 1, 1, 1, 1, 1, 2])
+
+        # With a zero window only overlapping device sessions are merged
+        split = sessionize_data(df, session_timeout=8, device_merge_window=0)
+        self.assertEqual(split['device_session_id'].tolist(), [1, 1, 1, 1, 2, 1, 2])
+        self.assertNotIn('device_session_id', sessionize_data(df, session_timeout=8).columns)
+
+    def test_device_sessions_single_device_and_parallel(self):
+        df = generate_synthetic_events(5000, events_per_customer=25)
+
+        # With one device per customer the device sessions are the timeout sessions
+        single = sessionize_data(df.assign(user_agent='same'), session_timeout=8, device_merge_window=2)
+        self.assertEqual(single['device_session_id'].tolist(), single['session_id'].tolist())
+
+        expected = sessionize_data(df, session_timeout=8, device_merge_window=2)['device_session_id'].sort_index()
+        parallel = sessionize_parallel(df, session_timeout=8, workers=2, shards=5, device_merge_window=2)
+        self.assertEqual(parallel['device_session_id'].sort_index().tolist(), expected.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import math
+import numpy as np
+
+
+# Function to pick the t-digest compression for a target rank error around the median: a centroid there
+# holds at most pi / compression of the values, and a quantile is off by at most half a centroid
+def compression_for_rank_error(rank_error):
+    return max(20, math.ceil(math.pi / (2 * rank_error)))
+
+
+# Mergeable t-digest quantile sketch (merging variant with the arcsine scale function). Values are
+# summarized by at most about compression weighted centroids, which are small near the tails.
+# Centroids made of a single repeated value are kept apart as pure centroids, so small or
+# low-cardinality inputs (like session counts) stay exact.
+class TDigest:
+
+    def __init__(self, compression=100, means=None, weights=None, minimum=None, maximum=None, pure=None):
+        self.compression = compression
+        self.means = np.asarray(means if means is not None else [], dtype=np.float64)
+        self.weights = np.asarray(weights if weights is not None else [], dtype=np.float64)
+        self.pure = np.asarray(pure if pure is not None else np.ones(len(self.means)), dtype=bool)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.buffer = []
+
+    @property
+    def count(self):
+        return float(self.weights.sum()) + sum(len(values) for values in self.buffer)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values):
+            self.buffer.append(values)
+            # Bound the unmerged buffer to a few times the digest size
+            if sum(len(values) for values in self.buffer) > 5 * self.compression:
+                self.compress()
+        return self
+
+    def merge(self, other):
+        other.compress()
+        self.compress()
+        self.means = np.concatenate([self.means, other.means])
+        self.weights = np.concatenate([self.weights, other.weights])
+        self.pure = np.concatenate([self.pure, other.pure])
+        self.minimum = other.minimum if self.minimum is None else self.minimum if other.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else self.maximum if other.maximum is None else max(self.maximum, other.maximum)
+        self.compress(force=True)
+        return self
+
+    def scale(self, q):
+        return self.compression / (2 * math.pi) * np.arcsin(2 * np.clip(q, 0, 1) - 1)
+
+    def compress(self, force=False):
+        if not self.buffer and not force:
+            return
+        means = np.concatenate([self.means] + self.buffer)
+        weights = np.concatenate([self.weights] + [np.ones(len(values)) for values in self.buffer])
+        pure = np.concatenate([self.pure] + [np.ones(len(values), dtype=bool) for values in self.buffer])
+        self.buffer = []
+        if len(means) == 0:
+            return
+        if self.minimum is None or means.min() < self.minimum:
+            self.minimum = float(means.min())
+        if self.maximum is None or means.max() > self.maximum:
+            self.maximum = float(means.max())
+
+        # Ties collapse into one centroid first
+        means, inverse = np.unique(means, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights)
+        pure = np.bincount(inverse, weights=~pure) == 0
+        total = weights.sum()
+
+        # Merge neighbours whose left edge falls in the same unit of the scale function, so a centroid spans
+        # about one unit; a value that spans more than a unit on its own keeps its own centroid
+        right = np.cumsum(weights)
+        k_left = self.scale((right - weights) / total)
+        k_right = self.scale(right / total)
+        heavy = k_right - k_left > 1
+        starts = np.ones(len(means), dtype=bool)
+        starts[1:] = (np.floor(k_left[1:]) != np.floor(k_left[:-1])) | heavy[1:] | heavy[:-1]
+        starts = np.flatnonzero(starts)
+
+        single = np.diff(np.append(starts, len(means))) == 1
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.where(single, means[starts], np.add.reduceat(means * weights, starts) / self.weights)
+        self.pure = pure[starts] & single
+
+    # Function to estimate a quantile with the interpolation of PERCENTILE_CONT. A pure centroid holds
+    # its value over all the ranks it covers, a mixed one sits at the middle of them, so a digest of
+    # pure centroids gives the exact result.
+    def quantile(self, q):
+        self.compress()
+        if len(self.means) == 0:
+            return None
+
+        first_ranks = np.cumsum(self.weights) - self.weights
+        last_ranks = first_ranks + self.weights - 1
+        centers = (first_ranks + last_ranks) / 2
+        ranks = np.column_stack([np.where(self.pure, first_ranks, centers), np.where(self.pure, last_ranks, centers)]).ravel()
+        values = np.repeat(self.means, 2)
+        ranks = np.concatenate([[0], ranks, [self.weights.sum() - 1]])
+        values = np.concatenate([[self.minimum], values, [self.maximum]])
+        return float(np.interp(q * (self.weights.sum() - 1), ranks, values))
+
+    def to_dict(self):
+        self.compress()
+        return {
+            'compression': self.compression,
+            'means': self.means.tolist(),
+            'weights': self.weights.tolist(),
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'pure': self.pure.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['compression'], data['means'], data['weights'], data['minimum'], data['maximum'], data['pure'])
@@ -0,0 +1,42 @@
+import unittest
+import numpy as np
+from sketches import TDigest, compression_for_rank_error
+from metrics_engine import percentile_cont
+
+
+class TestTDigest(unittest.TestCase):
+
+    def test_small_and_low_cardinality_inputs_are_exact(self):
+        rng = np.random.default_rng(0)
+        for values in [rng.exponential(4, 7), rng.exponential(4, 10), rng.integers(1, 20, 100_001), [0.0, 0.0, 1.0, 5.0]]:
+            digest = TDigest(compression=100).add(values)
+            self.assertEqual(digest.quantile(0.5), percentile_cont(values))
+        self.assertIsNone(TDigest().quantile(0.5))
+
+    def test_rank_error_bound(self):
+        rng = np.random.default_rng(1)
+        values = rng.lognormal(1, 1, 500_000)
+        rank_error = 0.005
+        digest = TDigest(compression_for_rank_error(rank_error))
+        for part in np.array_split(values, 20):
+            digest.add(part)
+
+        # The digest stays small and the estimate is within the rank error of the true median
+        self.assertLess(len(digest.means), 2 * digest.compression)
+        self.assertLessEqual(abs((values < digest.quantile(0.5)).mean() - 0.5), rank_error)
+
+    def test_merge_and_serialize(self):
+        rng = np.random.default_rng(2)
+        values = rng.exponential(3, 100_000)
+        compression = compression_for_rank_error(0.005)
+        left = TDigest(compression).add(values[:30_000])
+        right = TDigest(compression).add(values[30_000:])
+
+        # Digests built separately (e.g. by every load) merge into one over all values
+        merged = TDigest.from_dict(left.to_dict()).merge(TDigest.from_dict(right.to_dict()))
+        self.assertEqual(merged.count, len(values))
+        self.assertLessEqual(abs((values < merged.quantile(0.5)).mean() - 0.5), 0.005)
+        self.assertEqual((merged.minimum, merged.maximum), (values.min(), values.max()))
+
+if __name__ == '__main__':
+    unittest.main()